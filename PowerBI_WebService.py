@@ -1,193 +1,226 @@
 import sys
 import os
 import time
-from urllib.parse import urlparse
 
 from pathlib import Path
 
 
 import win32api
 import win32security
-import ldap3
-import dns.resolver
-from ldap3.utils.conv import escape_filter_chars
 import yaml
 
 from flask import Flask, render_template, request, jsonify, redirect, url_for
-from flask_socketio import SocketIO
+from flask_socketio import SocketIO, emit
 from apscheduler.schedulers.background import BackgroundScheduler
 
-from app_helpers import extract_ucd_slot
-from techstop_shelf_assignment import process_slot_tickets, get_tickets
+from refresh_pipeline import refresh_pipeline
 from techstop_notify_automation import slot_new_device_task, normalize_optional_email
-from shelves_helper import shelves
-from api_client import run_call_sync
+from shelf_journal import shelf_journal
+from lock_helper import lock_manager
+from api_client import run_call_sync, start_loop
+from ldap_helper import get_email_for_samaccount
+from snapshot_helper import ticket_snapshots, loaner_snapshots, snapshot_response, extended_snapshot_response, diff_response
+from cache_helper import SingleFlight
 with open("config.yaml", "r") as f:
     config = yaml.safe_load(f)
 
-ldap_server = config["ldap"]["server"]
-search_base = config["ldap"]["search_base"]
-
 globalResponse = None
 globalLoanerData = None
-last_refresh_ts = 0.0
-MIN_REFRESH_SECONDS = 30  # throttle manual refreshes to at most once every 30 seconds
+refresh_config = config.get("ticket_sync", {})
+MIN_REFRESH_SECONDS = refresh_config.get("min_refresh_seconds", 30)  # a snapshot refreshed this recently is served as-is by /refresh-data
+REFRESH_WAIT_SECONDS = refresh_config.get("refresh_wait_seconds", 2)  # how long /refresh-data (or /get-data with no snapshot yet) waits for a refresh before answering
+MAX_STALE_SECONDS = refresh_config.get("max_stale_seconds", 600)  # /get-data revalidates in the background past this age
+loaner_config = config.get("loaner_cache", {})
+LOANER_MAX_STALE_SECONDS = loaner_config.get("max_stale_seconds", 600)  # loaner data older than this is refreshed before it is served
+LOANER_WAIT_SECONDS = loaner_config.get("wait_seconds", 15)  # how long a request waits for that refresh before serving what it has
 
 #app = Flask(__name__, static_url_path='/static', static_folder="E:\\website\\WWWRoot\\App\\static")
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
 
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Same-origin only unless config.yaml lists the dashboard's origins; "*" is never passed on (any site could open the socket)
+socketio_config = config.get("socketio", {})
+socketio = SocketIO(app, cors_allowed_origins=[origin for origin in socketio_config.get("cors_allowed_origins") or [] if origin != "*"] or None)
+SOCKETIO_CLIENT = os.path.exists(os.path.join(app.static_folder, "js", "socket.io.min.js"))
+if not SOCKETIO_CLIENT:
+    print("static/js/socket.io.min.js not found (see README); dashboards will poll /get-data instead of live updates")
 
 def setResponse():
+    """Run the staged refresh (fetch once, normalize, cleanup, reconcile, publish; see refresh_pipeline.py)."""
     global globalResponse
-    tickets = get_tickets()
-    formatted_response = {
-        "result": tickets
-    }
+    globalResponse = {"result": refresh_pipeline.run()}
 
-    for item in formatted_response["result"]:
-        slot, ucd = extract_ucd_slot(item.get('short_description', ''))
-        item["slot"] = slot
-        item["ucd"] = ucd
-    globalResponse = formatted_response
-    
-    # Build set of active ticket numbers
-    active_ticket_numbers = {str(ticket["number"]) for ticket in tickets}
-    
-    # Remove devices from closed tickets on all shelves
-    print("Cleaning up devices from closed tickets...")
-    total_removed = 0
-    for shelf in shelves.values():
-        removed = shelf.removeDevicesFromClosedTickets(active_ticket_numbers)
-        total_removed += removed
-    if total_removed > 0:
-        print(f"Total devices removed from closed tickets: {total_removed}")
-    
-    process_slot_tickets()
+def push_ticket_diff(snapshot, diff):
+    """Push every new snapshot version to connected dashboards as a diff of added, changed and removed tickets."""
+    if diff is not None: # the first snapshot reaches clients through the page or /get-data
+        socketio.emit("ticket_diff", diff.text)
+
+ticket_snapshots.subscribe(push_ticket_diff)
+
+@socketio.on("resync")
+def resyncTickets(message):
+    """
+    A (re)connected dashboard reports the version it has. If it's behind it gets the changes since that version,
+    or the whole current snapshot when that version is no longer in the diff history or came from another process.
+    """
+    snapshot = ticket_snapshots.current()
+    version = (message or {}).get("version")
+    if snapshot is None or version == snapshot.version:
+        return
+    diff = ticket_snapshots.changes_since(version) if isinstance(version, str) else None
+    if diff is not None:
+        emit("ticket_diff", diff.text)
+    else:
+        emit("ticket_snapshot", snapshot.text())
+
+ticket_refresh = SingleFlight(setResponse, name="ticket-refresh", # the scheduler, /get-data and /refresh-data all share one refresh at a time
+                              backoff=refresh_config.get("retry_backoff_seconds", 30), max_backoff=refresh_config.get("max_retry_backoff_seconds", 600))
+
+def tickets_unavailable():
+    """503 for a process with no ticket data yet; Retry-After is the failure backoff, or the refresh wait while one runs."""
+    retry_after = ticket_refresh.retry_in() or REFRESH_WAIT_SECONDS
+    return jsonify({"error": "Ticket data is not available yet"}), 503, refresh_headers({"Retry-After": str(max(int(retry_after + 0.5), 1))})
+
+def refresh_headers(extra: dict[str, str] = None):
+    """Marks a snapshot served while a newer one is being built, so clients know to pick it up on their next poll."""
+    return {"X-Refresh-In-Progress": "true" if ticket_refresh.in_flight else "false", **(extra or {})}
 
 def setLoanerResponse():
-    """Fetch and update loaner computer data from API."""
+    """Fetch loaner computer data from the API and publish it as a new loaner snapshot version (raises on failure, keeping the last data)."""
     global globalLoanerData
-    try:
-        # First, fetch all loaner computers
-        call_spec = {
-            "url": "http://configurationitem/table/computer?SystemID=SOAP-UI&ReferenceID=*&MaxRows=1000",
-            "headers": {
-                "accept": "application/json",
-                "QueryParams": "sysparm_query=nameLIKETSNBLOAN"
-            },
-            "method": "GET"
-        }
-        
-        response = run_call_sync(call_spec)
-        
-        # Fetch re-imaging tasks to identify loaners being re-imaged
-        reimaging_call_spec = {
-            "url": "http://configurationitem/table/task?SystemID=SOAP-UI&ReferenceID=*&MaxRows=100&KeyName=assignment_group&KeyValue=PAB TechStop Support",
-            "headers": {
-                "Accept": "application/json",
-                "QueryParams": "sysparm_query=short_description=Prepare Loaner&active=true"
-            },
-            "method": "GET"
-        }
-        
-        reimaging_response = run_call_sync(reimaging_call_spec)
-        
-        # Build set of CI names that are being re-imaged
-        reimaging_cis = set()
-        if reimaging_response and "result" in reimaging_response:
-            for task in reimaging_response["result"]:
-                cmdb_ci = task.get("cmdb_ci", "")
-                # Handle both string and object formats
-                if isinstance(cmdb_ci, dict):
-                    ci_name = cmdb_ci.get("value", "") or cmdb_ci.get("display_value", "")
-                else:
-                    ci_name = str(cmdb_ci) if cmdb_ci else ""
-                
-                if ci_name:
-                    reimaging_cis.add(ci_name.strip())
-        
-        if response and "result" in response:
-            loaners = []
-            for computer in response["result"]:
-                # Map computer data to loaner format
-                loaner_name = computer.get("name", "")
-                # Also check u_display_name for matching
-                display_name = computer.get("u_display_name", "") or loaner_name
-                
-                # Check if this loaner is in the re-imaging tasks
-                is_reimaging = (
-                    loaner_name in reimaging_cis or 
-                    display_name in reimaging_cis
-                )
+    # First, fetch all loaner computers
+    call_spec = {
+        "url": "http://configurationitem/table/computer?SystemID=SOAP-UI&ReferenceID=*&MaxRows=1000",
+        "headers": {
+            "accept": "application/json",
+            "QueryParams": "sysparm_query=nameLIKETSNBLOAN"
+        },
+        "method": "GET"
+    }
+    
+    response = run_call_sync(call_spec)
+    
+    # Fetch re-imaging tasks to identify loaners being re-imaged
+    reimaging_call_spec = {
+        "url": "http://configurationitem/table/task?SystemID=SOAP-UI&ReferenceID=*&MaxRows=100&KeyName=assignment_group&KeyValue=PAB TechStop Support",
+        "headers": {
+            "Accept": "application/json",
+            "QueryParams": "sysparm_query=short_description=Prepare Loaner&active=true"
+        },
+        "method": "GET"
+    }
+    
+    reimaging_response = run_call_sync(reimaging_call_spec)
+    
+    # Build set of CI names that are being re-imaged
+    reimaging_cis = set()
+    if reimaging_response and "result" in reimaging_response:
+        for task in reimaging_response["result"]:
+            cmdb_ci = task.get("cmdb_ci", "")
+            # Handle both string and object formats
+            if isinstance(cmdb_ci, dict):
+                ci_name = cmdb_ci.get("value", "") or cmdb_ci.get("display_value", "")
+            else:
+                ci_name = str(cmdb_ci) if cmdb_ci else ""
+            
+            if ci_name:
+                reimaging_cis.add(ci_name.strip())
+    
+    if response and "result" in response:
+        loaners = []
+        for computer in response["result"]:
+            # Map computer data to loaner format
+            loaner_name = computer.get("name", "")
+            # Also check u_display_name for matching
+            display_name = computer.get("u_display_name", "") or loaner_name
+            
+            # Check if this loaner is in the re-imaging tasks
+            is_reimaging = (
+                loaner_name in reimaging_cis or 
+                display_name in reimaging_cis
+            )
+            
+            # Determine status from hardware_substatus field, but override if re-imaging
+            if is_reimaging:
+                status = "re-imaging"
+            else:
+                hardware_substatus = computer.get("hardware_substatus", "").strip() if computer.get("hardware_substatus") else ""
                 
-                # Determine status from hardware_substatus field, but override if re-imaging
-                if is_reimaging:
-                    status = "re-imaging"
+                # Map hardware_substatus to loaner status
+                # "Available" or "Available-Used" -> "in stock"
+                # "In Use" -> "in use"
+                # Everything else -> "not found"
+                hardware_substatus_lower = hardware_substatus.lower()
+                if hardware_substatus_lower == "available" or hardware_substatus_lower == "available-used":
+                    status = "in stock"
+                elif not computer.get("assigned_to", "") == "" or hardware_substatus_lower == "in_use":
+                    status = "in use"
                 else:
-                    hardware_substatus = computer.get("hardware_substatus", "").strip() if computer.get("hardware_substatus") else ""
-                    
-                    # Map hardware_substatus to loaner status
-                    # "Available" or "Available-Used" -> "in stock"
-                    # "In Use" -> "in use"
-                    # Everything else -> "not found"
-                    hardware_substatus_lower = hardware_substatus.lower()
-                    if hardware_substatus_lower == "available" or hardware_substatus_lower == "available-used":
-                        status = "in stock"
-                    elif not computer.get("assigned_to", "") == "" or hardware_substatus_lower == "in_use":
-                        status = "in use"
-                    else:
-                        # If hardware_substatus doesn't match known values or is empty, set to "not found"
-                        status = "not found"
-                
-                # Get user assigned to (if in use)
-                user_assigned = ""
-                if status == "in use":
-                    # Try different possible field names for assigned user
-                    user_assigned = (
-                        computer.get("assigned_to", "")
-                    )
-                    # If it's a sys_id, you might want to look up the email
-                    # For now, we'll use the value as-is
-                
-                # Get date of return - adjust field name as needed
-                # Common custom fields: u_date_of_return, u_return_date, etc.
-                date_of_return = (
-                    computer.get("u_date_of_return", "") or
-                    computer.get("u_return_date", "") or
-                    computer.get("date_of_return", "") or
-                    ""
+                    # If hardware_substatus doesn't match known values or is empty, set to "not found"
+                    status = "not found"
+            
+            # Get user assigned to (if in use)
+            user_assigned = ""
+            if status == "in use":
+                # Try different possible field names for assigned user
+                user_assigned = (
+                    computer.get("assigned_to", "")
                 )
-                
-                # Format date if needed (ServiceNow often returns in YYYY-MM-DD format)
-                if date_of_return and len(date_of_return) > 10:
-                    date_of_return = date_of_return[:10]  # Take first 10 chars (YYYY-MM-DD)
-                
-                # Skip loaners with "not found" or null status - don't send to frontend
-                if status == "not found" or status is None or status.lower() == "null":
-                    continue
-                
-                loaners.append({
-                    "name": loaner_name,
-                    "status": status,
-                    "date_of_return": date_of_return,
-                    "user_assigned_to": user_assigned
-                })
+                # If it's a sys_id, you might want to look up the email
+                # For now, we'll use the value as-is
             
-            globalLoanerData = loaners
-        else:
-            print("Error: No result in loaner API response")
-            globalLoanerData = []
-    except Exception as e:
-        print(f"Error fetching loaner data: {e}")
-        globalLoanerData = []
+            # Get date of return - adjust field name as needed
+            # Common custom fields: u_date_of_return, u_return_date, etc.
+            date_of_return = (
+                computer.get("u_date_of_return", "") or
+                computer.get("u_return_date", "") or
+                computer.get("date_of_return", "") or
+                ""
+            )
+            
+            # Format date if needed (ServiceNow often returns in YYYY-MM-DD format)
+            if date_of_return and len(date_of_return) > 10:
+                date_of_return = date_of_return[:10]  # Take first 10 chars (YYYY-MM-DD)
+            
+            # Skip loaners with "not found" or null status - don't send to frontend
+            if status == "not found" or status is None or status.lower() == "null":
+                continue
+            
+            loaners.append({
+                "name": loaner_name,
+                "status": status,
+                "date_of_return": date_of_return,
+                "user_assigned_to": user_assigned
+            })
+        
+        globalLoanerData = loaners
+        loaner_snapshots.publish(loaners) # serialized, compressed and ETagged once per change, served as-is by /get-loaner-data
+    else:
+        raise ValueError("No result in loaner API response")
+
+loaner_refresh = SingleFlight(setLoanerResponse, name="loaner-refresh", # every page and the scheduler share one refresh at a time
+                              backoff=loaner_config.get("retry_backoff_seconds", 30), max_backoff=loaner_config.get("max_retry_backoff_seconds", 600))
+
+def fresh_loaner_snapshot():
+    """
+    The loaner snapshot, no older than loaner_cache.max_stale_seconds: a staler one is refreshed first (one
+    single-flight refresh however many requests are waiting, each waiting at most wait_seconds). After a failed
+    refresh the stale snapshot is served without waiting, and a background retry starts once the backoff is over.
+    None if the data has never loaded.
+    """
+    snapshot = loaner_snapshots.current()
+    if snapshot is not None and time.time() - loaner_refresh.last_success <= LOANER_MAX_STALE_SECONDS:
+        return snapshot
+    if loaner_refresh.failures and not loaner_refresh.in_flight:
+        if loaner_refresh.due(LOANER_MAX_STALE_SECONDS):
+            loaner_refresh.start()
+        return snapshot
+    loaner_refresh.wait(LOANER_WAIT_SECONDS)
+    return loaner_snapshots.current()
 
 def get_loaner_data():
-    """Get loaner computer data, refreshing if needed."""
-    global globalLoanerData
-    if globalLoanerData is None:
-        setLoanerResponse()
+    """Get loaner computer data from the cache, refreshing it if it is too stale."""
+    fresh_loaner_snapshot()
     return globalLoanerData if globalLoanerData is not None else []
 
 def get_username_from_windows_auth_header():
@@ -212,83 +245,6 @@ def get_username_from_windows_auth_header():
         if handle:
             win32api.CloseHandle(handle)
 
-def build_ldap_server():
-    """Build an ldap3 Server, preferring a real DC resolved from AD DNS SRV."""
-    raw_server = str(ldap_server).strip()
-    use_ssl = raw_server.lower().startswith("ldaps://")
-    ad_domain = ".".join(
-        part.split("=", 1)[1].strip()
-        for part in str(search_base).split(",")
-        if part.strip().lower().startswith("dc=")
-    )
-
-    host = None
-    port = None
-
-    if ad_domain:
-        try:
-            srv_name = f"_ldap._tcp.dc._msdcs.{ad_domain}"
-            answers = dns.resolver.resolve(srv_name, "SRV")
-            if answers:
-                host = str(answers[0].target).rstrip(".")
-        except Exception:
-            host = None
-
-    if not host:
-        host = raw_server
-        if "://" in raw_server:
-            parsed = urlparse(raw_server)
-            host = parsed.hostname or raw_server
-            port = parsed.port
-        elif ":" in raw_server and "/" not in raw_server:
-            host_part, port_part = raw_server.rsplit(":", 1)
-            if port_part.isdigit():
-                host = host_part
-                port = int(port_part)
-
-    server_kwargs = {"host": host, "use_ssl": use_ssl}
-    if port:
-        server_kwargs["port"] = port
-    return ldap3.Server(**server_kwargs)
-
-def get_email_for_samaccount(username):
-    """Lookup email attributes in AD using app pool identity (gMSA)."""
-    if not username:
-        return None
-
-    raw_username = str(username).strip()
-    if not raw_username:
-        return None
-
-    samaccount = raw_username.split("\\")[-1].split("@")[0].strip()
-    filters = []
-
-    if samaccount:
-        filters.append(f"(sAMAccountName={escape_filter_chars(samaccount)})")
-    if "@" in raw_username:
-        escaped_raw = escape_filter_chars(raw_username)
-        filters.append(f"(userPrincipalName={escaped_raw})")
-        filters.append(f"(mail={escaped_raw})")
-
-    if not filters:
-        return None
-
-    search_filter = filters[0] if len(filters) == 1 else f"(|{''.join(filters)})"
-
-    server = build_ldap_server()
-    conn = ldap3.Connection(
-        server,
-        authentication=ldap3.SASL,
-        sasl_mechanism="GSSAPI",
-        auto_bind=True
-    )
-    conn.search(search_base, search_filter, attributes=['mail', 'userPrincipalName'])
-
-    if conn.entries:
-        entry = conn.entries[0]
-        return entry.mail.value or entry.userPrincipalName.value
-    return None
-
 def get_request_user_email():
     """Get current request user's email from IIS token + LDAP."""
     username = get_username_from_windows_auth_header()
@@ -307,42 +263,59 @@ def pickUpHome():
 
 @app.route("/get-data")
 def getData():
-    if globalResponse == None:
-        setResponse()
-    return jsonify(globalResponse)
+    """
+    Current snapshot, stale-while-revalidate: past max_stale_seconds a background refresh is started (unless the
+    last one failed and is backing off) and the current snapshot is still served immediately. Only a process that
+    has no snapshot yet waits, at most refresh_wait_seconds, then answers 503 with Retry-After.
 
+    With ?since=<version> only the changes since that version are returned ({"from", "version", "added",
+    "changed", "removed"}), or the full snapshot (X-Full-Snapshot: true) when that version aged out of the history or isn't this
+    process's (the app restarted, or another worker served the earlier request).
+    """
+    if ticket_snapshots.current() is None:
+        if ticket_refresh.in_flight or ticket_refresh.retry_in() == 0:
+            ticket_refresh.wait(REFRESH_WAIT_SECONDS)
+        if ticket_snapshots.current() is None:
+            return tickets_unavailable()
+    elif ticket_refresh.due(MAX_STALE_SECONDS):
+        ticket_refresh.start()
+
+    since = request.args.get("since")
+    if since is not None:
+        diff = ticket_snapshots.changes_since(since)
+        if diff is not None:
+            return diff_response(diff, refresh_headers())
+        return snapshot_response(ticket_snapshots.current(), refresh_headers({"X-Full-Snapshot": "true"}))
+    return snapshot_response(ticket_snapshots.current(), refresh_headers())
+
+
+def refresh_response(throttled: bool, next_allowed_in: int):
+    """The current snapshot with /refresh-data's throttled and next_allowed_in keys (also sent as X-Throttled / X-Next-Allowed-In)."""
+    headers = refresh_headers({"X-Throttled": "true" if throttled else "false", "X-Next-Allowed-In": str(next_allowed_in)})
+    return extended_snapshot_response(ticket_snapshots.current(), {"throttled": throttled, "next_allowed_in": next_allowed_in}, headers)
 
 @app.route("/refresh-data")
 def refreshData():
-    """Force a fresh pull from ServiceNow by calling setResponse, then return latest data.
+    """Ask for a fresh pull from ServiceNow, then return the latest data.
 
-    This endpoint is throttled so it can't be spammed and hammer ServiceNow.
+    Refreshes are single-flight: a click joins the refresh already running (from the scheduler or another
+    click) instead of starting another. The request waits at most refresh_wait_seconds for it, then answers
+    with the current snapshot and X-Refresh-In-Progress: true; the next poll picks up the new version.
+    A snapshot refreshed within min_refresh_seconds is served as-is with throttled: true and next_allowed_in,
+    so the button can't be used to hammer ServiceNow. The same goes while a failed refresh is backing off.
     """
-    global last_refresh_ts
-
-    now = time.time()
-    # If we've refreshed too recently, just return the existing cached data
-    if last_refresh_ts and (now - last_refresh_ts) < MIN_REFRESH_SECONDS:
-        remaining = int(MIN_REFRESH_SECONDS - (now - last_refresh_ts))
-        payload = globalResponse or {"result": []}
-        return jsonify(
-            {
-                "result": payload.get("result", []),
-                "throttled": True,
-                "next_allowed_in": max(remaining, 0),
-            }
-        )
-
-    setResponse()
-    last_refresh_ts = now
-    payload = globalResponse or {"result": []}
-    return jsonify(
-        {
-            "result": payload.get("result", []),
-            "throttled": False,
-            "next_allowed_in": MIN_REFRESH_SECONDS,
-        }
-    )
+    age = time.time() - ticket_refresh.last_success
+    if not ticket_refresh.in_flight and ticket_refresh.retry_in() > 0:
+        if ticket_snapshots.current() is None:
+            return tickets_unavailable()
+        return refresh_response(True, int(ticket_refresh.retry_in() + 0.5))
+    if age < MIN_REFRESH_SECONDS and ticket_snapshots.current() is not None:
+        return refresh_response(True, max(int(MIN_REFRESH_SECONDS - age), 0))
+
+    ticket_refresh.wait(REFRESH_WAIT_SECONDS)
+    if ticket_snapshots.current() is None:
+        return tickets_unavailable()
+    return refresh_response(False, MIN_REFRESH_SECONDS)
 
 @app.route("/slotting-dashboard")
 def slotDashboard():
@@ -354,9 +327,11 @@ def slotDashboard():
         except Exception as e:
             print(f"Error fetching email for slotting dashboard: {e}")
 
+    snapshot = ticket_snapshots.current()
     data = {
         "email":  email,
-        "rows": globalResponse
+        "socketio_client": SOCKETIO_CLIENT,
+        "rows_json": snapshot.text() if snapshot is not None else '{"result":[],"version":null}'
     }
 
     return render_template("home.html", data=data)
@@ -374,10 +349,9 @@ def automatePickUp(taskNumber, userEmail):
         print(slotNumber)
         print(UCD)
         #return f"Customer: {requestedFor}<br>Device Name: {CI}<br>Slot: {slotNumber}<br>UCD: {UCD}"
-        for item in globalResponse["result"]:
-            if item["number"] == taskNumber:
-                item["slot"] = "" if str(slotNumber) == "-1" else slotNumber
-                item["ucd"] = UCD
+        slot = "" if str(slotNumber) == "-1" else slotNumber
+        # Patch a copy of the latest published rows under the publisher's lock, so a refresh finishing meanwhile isn't overwritten
+        ticket_snapshots.update(lambda rows: [dict(item, slot=slot, ucd=UCD) if item["number"] == taskNumber else item for item in rows])
 
         return jsonify({
             "requestedFor": requestedFor,
@@ -393,6 +367,19 @@ def automatePickUp(taskNumber, userEmail):
             "UCD": None
         })
 
+@app.route("/shelf-history")
+def shelfHistory():
+    """Slot dwell time, per-day intake and overflow events for the last ?days= days (default 30), from the journal rollups."""
+    if shelf_journal is None:
+        return jsonify({"error": "Shelf journal is disabled"}), 404
+    days = request.args.get("days", default=30, type=int)
+    return jsonify(shelf_journal.history(days=max(1, min(days, shelf_journal.history_days))))
+
+@app.route("/lock-metrics")
+def lockMetrics():
+    """Contention per shelf, shelf file and journal lock: reads, writes, waits, hold times and timeouts."""
+    return jsonify(lock_manager.metrics())
+
 @app.route("/loaner-dashboard")
 def loanerDashboard():
     """Loaner computer dashboard page."""
@@ -408,11 +395,11 @@ def loanerDashboard():
 
 @app.route("/get-loaner-data")
 def getLoanerData():
-    """API endpoint to get loaner data."""
-    # Refresh data on each request to ensure it's up to date
-    setLoanerResponse()
-    loaners = get_loaner_data()
-    return jsonify({"loaners": loaners})
+    """API endpoint to get loaner data: the cached snapshot (refreshed only past its max staleness), with ETag/304."""
+    snapshot = fresh_loaner_snapshot()
+    if snapshot is None:
+        return jsonify({"loaners": []})
+    return snapshot_response(snapshot)
 
 @app.route("/notify-loaner-return", methods=["POST"])
 def notifyLoanerReturn():
@@ -446,15 +433,15 @@ def notifyLoanerReturn():
             "error": str(e)
         }), 500
     
+start_loop() # Single background event loop shared by Flask handlers and scheduler jobs for all ServiceNow calls
 scheduler = BackgroundScheduler()
-scheduler.add_job(setResponse, 'interval', minutes=5)
-scheduler.add_job(setLoanerResponse, 'interval', minutes=5)
+scheduler.add_job(ticket_refresh.wait, 'interval', seconds=refresh_config.get("refresh_seconds", 300))
+scheduler.add_job(loaner_refresh.wait, 'interval', seconds=loaner_config.get("refresh_seconds", 300))
 scheduler.start()
-setResponse()
-setLoanerResponse()
+ticket_refresh.wait()
+loaner_refresh.wait()
 
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 5001))
-    app.run(host='localhost', port=port)
-
-    #socketio.run(app, debug=True)
+    # Same Werkzeug server app.run used, started through Flask-SocketIO so /socket.io/ is served alongside the app
+    socketio.run(app, host='localhost', port=port, allow_unsafe_werkzeug=True)
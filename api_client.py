@@ -1,54 +1,416 @@
 from dotenv import load_dotenv
 import os
+import atexit
+import queue
+import random
+import threading
+import time
+from urllib.parse import urlsplit, parse_qs
+import concurrent.futures
 import httpx
 import asyncio
+import yaml
+from result_stream import ResultStreamParser, project
+
+with open("config.yaml", "r") as f:
+    config = yaml.safe_load(f)
+
+api_config = config.get("api", {})
+
+try:
+    import h2  # noqa: F401  (httpx only negotiates HTTP/2 when the h2 package is installed)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Process-wide pooled client, shared by every call_api caller.
+# httpx.AsyncClient is bound to the event loop it first runs on, so we remember that loop
+# and build a fresh client if we are ever called from a different one.
+_client: httpx.AsyncClient = None
+_client_loop: asyncio.AbstractEventLoop = None
+
+# Dedicated background event loop that every sync caller submits coroutines to (see run_sync)
+_loop: asyncio.AbstractEventLoop = None
+_loop_thread: threading.Thread = None
+_loop_lock = threading.Lock()
+
+# Shared request scheduler for fan-out calls (see run_multiple_calls)
+_scheduler: "RequestScheduler" = None
+_scheduler_loop: asyncio.AbstractEventLoop = None
+
+
+def build_client() -> httpx.AsyncClient:
+    """Build the pooled AsyncClient from the api section of config.yaml."""
+    limits = httpx.Limits(
+        max_connections=api_config.get("max_connections", 20),
+        max_keepalive_connections=api_config.get("max_keepalive_connections", 10),
+        keepalive_expiry=api_config.get("keepalive_expiry", 30),
+    )
+    return httpx.AsyncClient(
+        timeout=api_config.get("timeout", 10),
+        limits=limits,
+        http2=bool(api_config.get("http2", True)) and HTTP2_AVAILABLE, # HTTP/2 is negotiated via ALPN, so plain http:// falls back to HTTP/1.1
+    )
+
+
+def get_client() -> httpx.AsyncClient:
+    """Return the shared client for the running event loop, creating it if needed."""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        _client = build_client()
+        _client_loop = loop
+    return _client
+
+
+async def close_client():
+    """Close the shared client (if it belongs to the running loop) and drop the reference."""
+    global _client, _client_loop
+    client = _client
+    if client is not None and _client_loop is asyncio.get_running_loop():
+        _client = None
+        _client_loop = None
+        await client.aclose()
+
+
+async def _send(client: httpx.AsyncClient, url: str, params=None, headers: dict[str, any]=None, method="GET") -> httpx.Response:
+    api_key = os.getenv("tibco_read_auth_token")
+    req_headers = dict(headers or {})
+    req_headers["Authorization"] = api_key
+    if method == "GET":
+        response = await client.get(url, params=params, headers=req_headers)
+    elif method == "POST":
+        response = await client.post(url, json=params, headers=req_headers)
+    elif method == "PUT":
+        req_headers["Authorization"] = os.getenv("tibco_write_auth_token") # update auth token to write
+        response = await client.put(url, json=params, headers=req_headers)
+    else:
+        raise ValueError(f"Unsupported method {method}")
+    response.raise_for_status()
+    return response
+
 
 async def call_api(url: str, params=None, headers: dict[str, any]=None, method="GET"):
-    async with httpx.AsyncClient(timeout=10) as client:
+    try:
+        response = await _send(get_client(), url, params=params, headers=headers, method=method)
+        return response.json()
+    except Exception as e: # HTTP errors, but also bad bodies or a missing token (None header value)
+        print(f"API call failed: {type(e).__name__}: {e}")
+        return None
+
+
+def new_result() -> dict[str, any]:
+    return {"status": "pending", "status_code": None, "data": None, "error": None, "attempts": 0, "bytes": 0}
+
+
+def _max_rows(url: str):
+    values = parse_qs(urlsplit(url).query).get("MaxRows")
+    return int(values[0]) if values and values[0].isdigit() else None
+
+
+def _page_spec(spec: dict[str, any], offset: int) -> dict[str, any]:
+    """The spec for the page starting at offset (the spec itself for the first page)."""
+    if offset == 0:
+        return spec
+    headers = dict(spec.get("headers") or {})
+    offset_param = f"{api_config.get('page_offset_param', 'sysparm_offset')}={offset}"
+    headers["QueryParams"] = f"{headers['QueryParams']}&{offset_param}" if headers.get("QueryParams") else offset_param
+    return {**spec, "headers": headers}
+
+
+def new_page(previous_first: dict = None) -> dict[str, any]:
+    return {"delivered": 0, "first": None, "previous_first": previous_first, "repeated": False}
+
+
+async def _stream_page(client: httpx.AsyncClient, spec: dict[str, any], result: dict[str, any], page: dict[str, any], on_record) -> dict[str, any]:
+    """
+    GET one page and pass each record of its result array to on_record as soon as it is parsed, keeping only
+    spec["fields"]. page carries progress across retries of the same page: records a failed attempt already
+    delivered are not passed again, and the page is abandoned (page["repeated"]) if it starts with the previous
+    page's first record. Returns page.
+    """
+    req_headers = dict(spec.get("headers") or {})
+    req_headers["Authorization"] = os.getenv("tibco_read_auth_token")
+    async with client.stream("GET", spec["url"], params=spec.get("params"), headers=req_headers) as response:
+        response.raise_for_status()
+        result["status_code"] = response.status_code
+        parser = ResultStreamParser()
+        seen = 0
+        async for chunk in response.aiter_bytes():
+            result["bytes"] += len(chunk)
+            for record in parser.feed(chunk):
+                record = project(record, spec.get("fields"))
+                seen += 1
+                if seen == 1:
+                    if page["previous_first"] is not None and record == page["previous_first"]:
+                        page["repeated"] = True
+                        return page
+                    page["first"] = record
+                if seen > page["delivered"]:
+                    page["delivered"] = seen
+                    on_record(record)
+        if not parser.found:
+            raise ValueError("response has no result array")
+        return page
+
+
+class RequestScheduler:
+    """
+    Bounded-concurrency, retrying executor for call specs.
+
+    - At most max_in_flight requests run at once, and at most max_per_host against any one host
+    - 429/5xx responses, timeouts and connection errors are retried with exponential backoff and full jitter
+      (a numeric Retry-After header on 429/503 is honoured as the minimum wait)
+    - Every spec has a deadline covering all of its attempts; a spec can override it with "deadline" (seconds)
+    - Failures never raise, every spec gets a result dict with an explicit status
+    """
+
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(self, max_in_flight: int = 8, max_per_host: int = 6, max_retries: int = 3,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0, deadline: float = 30.0):
+        self.max_in_flight = max_in_flight
+        self.max_per_host = max_per_host
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.deadline = deadline
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._host_limits: dict[str, asyncio.Semaphore] = {}
+
+    def _host_limit(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc.lower()
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.max_per_host)
+        return self._host_limits[host]
+
+    def _backoff(self, attempt: int, retry_after: str = None) -> float:
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if retry_after and retry_after.strip().isdigit():
+            delay = max(delay, min(float(retry_after), self.backoff_max))
+        return delay
+
+    async def _attempt(self, url: str, result: dict[str, any], request):
+        """Run request() under the concurrency limits and retry policy. Returns its value, or None once retries are exhausted."""
+        host_limit = self._host_limit(url)
+        attempt = 0
+        while True:
+            attempt += 1
+            result["attempts"] += 1
+            retry_after = None
+            async with host_limit, self._in_flight:
+                try:
+                    value = await request()
+                    result.update(status="ok", error=None)
+                    return value
+                except httpx.HTTPStatusError as e:
+                    result.update(status="error", status_code=e.response.status_code, error=str(e))
+                    if e.response.status_code not in self.RETRY_STATUS_CODES:
+                        return None
+                    retry_after = e.response.headers.get("Retry-After")
+                except (httpx.TimeoutException, httpx.TransportError) as e:
+                    result.update(status="error", error=f"{type(e).__name__}: {e}")
+                except Exception as e: # not retryable, e.g. a None header value when tibco_read_auth_token is unset
+                    result.update(status="error", error=f"{type(e).__name__}: {e}")
+                    return None
+            if attempt > self.max_retries:
+                return None
+            await asyncio.sleep(self._backoff(attempt - 1, retry_after))
+
+    async def stream_results(self, spec: dict[str, any], result: dict[str, any], on_record):
+        """
+        Stream the result array of a GET spec into on_record, one record at a time as it is parsed, projected to
+        spec["fields"] (all fields when omitted). Pages past the MaxRows in the URL are followed by adding the
+        configured offset parameter to QueryParams, up to max_pages; each page is retried on its own.
+        Outcome (status, bytes, attempts) is recorded in result. Status is "partial" when following stopped before
+        the last page: max_pages was reached, or a page repeated the previous one (a gateway ignoring the offset).
+        """
+        page_size = _max_rows(spec["url"])
+        max_pages = api_config.get("max_pages", 20)
+        offset = 0
+        previous_first = None
+        for _ in range(max_pages):
+            page_spec = _page_spec(spec, offset)
+            page = new_page(previous_first)
+            if await self._attempt(spec["url"], result, lambda: _stream_page(get_client(), page_spec, result, page, on_record)) is None:
+                return
+            if page["repeated"]:
+                result.update(status="partial", error=f"The page at offset {offset} repeats the previous page, is {api_config.get('page_offset_param', 'sysparm_offset')} ignored?")
+                return
+            if not page_size or page["delivered"] < page_size:
+                return
+            offset += page["delivered"]
+            previous_first = page["first"]
+        result.update(status="partial", error=f"Stopped following pages after {max_pages} page(s)")
+
+    async def _attempts(self, spec: dict[str, any], result: dict[str, any], on_record=None):
+        if spec.get("stream"):
+            if on_record is not None:
+                await self.stream_results(spec, result, on_record)
+                return
+            records = [] # no consumer to hand records to, so they are returned in data
+            await self.stream_results(spec, result, records.append)
+            if result["status"] in ("ok", "partial"):
+                result["data"] = {"result": records}
+            return
+        response = await self._attempt(spec["url"], result, lambda: _send(get_client(), spec["url"], params=spec.get("params"), headers=spec.get("headers"), method=spec.get("method", "GET")))
+        if response is not None:
+            result.update(status_code=response.status_code, data=response.json(), bytes=len(response.content))
+
+    async def run(self, spec: dict[str, any], on_record=None) -> dict[str, any]:
+        result = new_result()
         try:
-            api_key = os.getenv("tibco_read_auth_token")
-            req_headers = dict(headers)
-            req_headers["Authorization"] = api_key
-            if method == "GET":
-                response = await client.get(url, params=params, headers=req_headers)
-            elif method == "POST":
-                response = await client.post(url, json=params, headers=req_headers)
-            elif method == "PUT":
-                api_key = os.getenv("tibco_write_auth_token") # update auth token to write
-                req_headers = dict(headers)
-                req_headers["Authorization"] = api_key
-                response = await client.put(url, json=params, headers=req_headers)
-            response.raise_for_status()
-            return response.json()
-        except httpx.RequestError as e:
-            print(f"API call failed: {e}")
-            return None
-
-
-async def run_multiple_calls(call_specs : list[dict[str, any]]):
+            await asyncio.wait_for(self._attempts(spec, result, on_record), timeout=spec.get("deadline", self.deadline))
+        except asyncio.TimeoutError:
+            result.update(status="timeout", error=f"Deadline exceeded after {result['attempts']} attempt(s)")
+        except ValueError as e: # unparseable response body
+            result.update(status="error", data=None, error=f"Invalid JSON response: {e}")
+        except Exception as e:
+            result.update(status="error", data=None, error=f"{type(e).__name__}: {e}")
+        if result["status"] != "ok":
+            print(f"API call failed ({result['status']}) for {spec['url']}: {result['error']}")
+        return result
+
+    async def run_all(self, call_specs: list[dict[str, any]], on_record=None) -> list[dict[str, any]]:
+        """on_record(spec_index, record), when given, receives the records of stream specs instead of their result data."""
+        if on_record is None:
+            return await asyncio.gather(*(self.run(spec) for spec in call_specs))
+        return await asyncio.gather(*(self.run(spec, lambda record, index=index: on_record(index, record)) for index, spec in enumerate(call_specs)))
+
+
+def get_scheduler() -> RequestScheduler:
+    """Return the shared RequestScheduler for the running event loop (its semaphores are loop-bound like the client)."""
+    global _scheduler, _scheduler_loop
+    loop = asyncio.get_running_loop()
+    if _scheduler is None or _scheduler_loop is not loop:
+        _scheduler = RequestScheduler(
+            max_in_flight=api_config.get("max_in_flight", 8),
+            max_per_host=api_config.get("max_per_host", 6),
+            max_retries=api_config.get("max_retries", 3),
+            backoff_base=api_config.get("backoff_base", 0.5),
+            backoff_max=api_config.get("backoff_max", 8),
+            deadline=api_config.get("call_deadline", 30),
+        )
+        _scheduler_loop = loop
+    return _scheduler
+
+
+async def run_multiple_calls(call_specs : list[dict[str, any]], on_record=None):
     """
     call_specs: list of dicts like:
     [
         {"url": "...", "headers": {...}, "params": {...}, "method": "GET"},
-        {"url": "...", "headers": {...}, "params": {...}, "method": "POST"}
+        {"url": "...", "headers": {...}, "params": {...}, "method": "POST", "deadline": 15},
+        {"url": "...", "headers": {...}, "stream": True, "fields": ["number", "sys_id"]}
     ]
+    Specs with "stream" set are GETs whose result array is parsed while it downloads, projected to "fields"
+    and followed across pages (see RequestScheduler.stream_results). With on_record(spec_index, record) their
+    records go to it as they are parsed and data stays None, otherwise they are collected into data.
+
+    Returns one result dict per spec, in the same order:
+        {"status": "ok" | "partial" | "error" | "timeout", "status_code": int | None, "data": parsed JSON | None,
+         "error": str | None, "attempts": int, "bytes": int}
+    Failed specs do not affect the others, so callers get partial results.
     """
-    for spec in call_specs:
-        print(spec.get("headers"))
-    coros = [call_api(spec["url"], params=spec.get("params"), headers=spec.get("headers"), method=spec.get("method", "GET")) for spec in call_specs]
-    return await asyncio.gather(*coros)
+    return await get_scheduler().run_all(call_specs, on_record)
 
 
 async def run_call(call_spec: dict[str, any]):
     return await call_api(call_spec["url"], params=call_spec.get("params"), headers=call_spec.get("headers"), method=call_spec.get("method", "GET"))
 
 
+def _loop_worker(loop: asyncio.AbstractEventLoop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def start_loop() -> asyncio.AbstractEventLoop:
+    """Start (once) the dedicated background event loop that owns the pooled client."""
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None or _loop.is_closed() or _loop_thread is None or not _loop_thread.is_alive():
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop_worker, args=(_loop,), name="api-event-loop", daemon=True)
+            _loop_thread.start()
+        return _loop
+
+
+def run_sync(coro, timeout: float = None):
+    """
+    Submit a coroutine to the shared background loop and block until it finishes.
+    Flask request handlers and APScheduler jobs all share this loop and its connection pool.
+    """
+    if threading.current_thread() is _loop_thread:
+        coro.close()
+        raise RuntimeError("run_sync called from the api event loop thread; await the coroutine instead")
+    loop = start_loop()
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        return future.result(timeout=timeout if timeout is not None else api_config.get("sync_timeout", 120))
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+
 def run_calls_sync(call_specs):
-    return asyncio.run(run_multiple_calls(call_specs))
+    return run_sync(run_multiple_calls(call_specs))
+
+
+_STREAM_DONE = object()
+
+
+def iter_calls_sync(call_specs: list[dict[str, any]], results: list):
+    """
+    run_calls_sync for stream specs, as a generator: yields (spec_index, record) while the responses are parsed on
+    the shared loop, so records reach the caller one at a time instead of as lists. results receives the result
+    dict of every spec (data None for stream specs) once the generator is exhausted.
+    """
+    if threading.current_thread() is _loop_thread:
+        raise RuntimeError("iter_calls_sync called from the api event loop thread; use run_multiple_calls with on_record instead")
+    records = queue.SimpleQueue()
+
+    async def run():
+        try:
+            results.extend(await run_multiple_calls(call_specs, on_record=lambda index, record: records.put((index, record))))
+        finally:
+            records.put(_STREAM_DONE)
+
+    future = asyncio.run_coroutine_threadsafe(run(), start_loop())
+    deadline = time.monotonic() + api_config.get("sync_timeout", 120)
+    try:
+        while (item := records.get(timeout=max(deadline - time.monotonic(), 0))) is not _STREAM_DONE:
+            yield item
+        future.result()
+    except queue.Empty:
+        raise concurrent.futures.TimeoutError() from None
+    finally:
+        if not future.done():
+            future.cancel()
 
 
 def run_call_sync(call_spec: dict[str, any]):
-    return asyncio.run(run_call(call_spec))
+    return run_sync(run_call(call_spec))
 
-load_dotenv()
 
+@atexit.register
+def shutdown():
+    """Close the pooled client and stop the background loop on interpreter shutdown."""
+    global _loop, _loop_thread
+    with _loop_lock:
+        loop, thread = _loop, _loop_thread
+        _loop = None
+        _loop_thread = None
+    if loop is None or loop.is_closed():
+        return
+    if loop.is_running():
+        try:
+            asyncio.run_coroutine_threadsafe(close_client(), loop).result(timeout=5)
+        except Exception as e:
+            print(f"Error closing API client: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+        if thread is not None:
+            thread.join(timeout=5)
+    if not loop.is_running():
+        loop.close()
+
+load_dotenv()
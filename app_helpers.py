@@ -1,12 +1,79 @@
 import re
 import yaml
 import asyncio
-from shelves_helper import get_shelf, shelves
-from api_client import call_api
+from shelves_helper import get_shelf, shelves, shelf_transaction, shelf_locks_async, shelf_classifier
+from api_client import run_multiple_calls
+from cache_helper import TTLCache, MISSING
 
 with open("config.yaml", "r") as f:
     config = yaml.safe_load(f)
 
+cmdb_config = config.get("cmdb_cache", {})
+
+# CI display name (lowercased) -> [{"asset": ..., "sys_class_name": ...}, ...] ([] when the CI isn't in the CMDB)
+computer_cache = TTLCache(max_entries=cmdb_config.get("max_entries", 5000), ttl=cmdb_config.get("ttl_seconds", 86400))
+
+def ci_display_name(cmdb_ci):
+    if isinstance(cmdb_ci, dict):
+        return str(cmdb_ci.get("display_value") or cmdb_ci.get("value") or "").strip()
+    return str(cmdb_ci or "").strip()
+
+async def resolve_computers(display_names: list[str]):
+    """
+    Resolve CI display names to their computer records ({asset, sys_class_name} only), from computer_cache where possible.
+    Every uncached name is looked up with one u_display_nameIN... query per batch_size names (names containing a comma
+    can't go in an IN list, so they get a KeyName lookup of their own). Names not found in the CMDB are cached as []
+    for negative_ttl_seconds.
+
+    Returns {display_name: [computer, ...]}; a name is None if its lookup failed (nothing is cached for it).
+    """
+    names = {name: name.lower() for name in (ci_display_name(n) for n in display_names) if name}
+    found, missing = computer_cache.get_many(set(names.values()))
+    resolved = {name: found.get(key) for name, key in names.items()}
+    if not missing:
+        return resolved
+
+    missing_names = {name for name, key in names.items() if key in missing}
+    in_list_names = sorted(name for name in missing_names if "," not in name)
+    batch_size = cmdb_config.get("batch_size", 50)
+    specs = []
+    for i in range(0, len(in_list_names), batch_size):
+        specs.append({
+            "url": "http://configurationitem/table/computer?SystemID=SOAP-UI&ReferenceID=*&MaxRows=1000",
+            "headers": {
+                "accept": "application/json",
+                "QueryParams": f"sysparm_query=u_display_nameIN{','.join(in_list_names[i:i + batch_size])}"
+            },
+            "method": "GET",
+            "names": in_list_names[i:i + batch_size]
+        })
+    for name in sorted(missing_names - set(in_list_names)):
+        specs.append({
+            "url": f"http://configurationitem/table/computer?SystemID=SOAP-UI&ReferenceID=*&MaxRows=100&KeyName=u_display_name&KeyValue={name}",
+            "headers": {
+                "accept": "application/json"
+            },
+            "method": "GET",
+            "names": [name]
+        })
+
+    results = await run_multiple_calls(specs)
+    for spec, result in zip(specs, results):
+        if result["status"] != "ok" or not isinstance(result["data"], dict):
+            continue # leave unresolved (None) and uncached so the next lookup retries
+        computers_by_key: dict[str, list] = {names[name]: [] for name in spec["names"]}
+        for computer in result["data"].get("result", []):
+            key = ci_display_name(computer.get("u_display_name")).lower()
+            if len(spec["names"]) == 1 and key not in computers_by_key: # KeyName lookups may not echo u_display_name
+                key = names[spec["names"][0]]
+            if key in computers_by_key:
+                computers_by_key[key].append({"asset": computer.get("asset", ""), "sys_class_name": computer.get("sys_class_name", "")})
+        for name in spec["names"]:
+            computers = computers_by_key[names[name]]
+            computer_cache.set(names[name], computers, ttl=None if computers else cmdb_config.get("negative_ttl_seconds", 300))
+            resolved[name] = computers
+    return resolved
+
 def extract_ucd_slot(short_description: str = None):
     if not short_description:
         return None, None
@@ -59,27 +126,18 @@ async def assign_device_to_shelf(task: dict, override_mode: bool = None):
     
     # Override mode: assign to specific slot
     if override_mode:
-        # Validate task state for override mode
-        if str(task.get("state", "")) in ["Cancelled", "Closed", "Resolved"]:
+        placement = slot_placement(task)
+        if placement is None:
             return False, None, False
-        
-        # Extract slot number from description
-        slot_number_from_desc, ucd = extract_ucd_slot(task["short_description"])
-        if slot_number_from_desc is None:
+        _, display_name, slot_number = placement
+        shelf, _ = get_shelf(device=None, slot_number=slot_number)
+        if shelf is None: # the slot isn't on any shelf
             return False, None, False
         
-        # Get shelf based on slot number
-        shelf, slot_index = get_shelf(device=None, slot_number=int(slot_number_from_desc))
-        if shelf is None or slot_index is None:
-            return False, None, False
-        
-        # Use placeholder if display_name is empty
-        if display_name == "":
-            display_name = f"placeholder_device_{task['number']}"
-        
-        # Assign device to specific slot
-        shelf.assignDeviceWithSlot(display_name, int(slot_number_from_desc), ticket_number=str(task.get('number', ''))) # We don't use the slot_index here because it is zero indexed and assignDeviceWithSlot expects the slot number not the index/converts to zero based index
-        return shelf, int(slot_number_from_desc), False # Returns the shelf, the slot number (from description to add to short description), and False because it is not an overfill
+        # Assign device to specific slot (the lock is awaited on the loop, the shelf I/O runs in a worker thread)
+        async with shelf_locks_async(shelf):
+            await asyncio.to_thread(shelf.assignDeviceWithSlot, display_name, slot_number, str(task.get('number', ''))) # We don't use the slot_index here because it is zero indexed and assignDeviceWithSlot expects the slot number not the index/converts to zero based index
+        return shelf, slot_number, False # Returns the shelf, the slot number (from description to add to short description), and False because it is not an overfill
     
     # Auto-assign mode: let shelf choose the slot
     # Check if already slotted (should not happen in auto-assign mode)
@@ -106,16 +164,10 @@ async def assign_device_to_shelf(task: dict, override_mode: bool = None):
             }
         ]
     elif display_name != "" and key_words_found:
-        # If there is a CI, we use the CI to determine the type of device to slot
-        spec = {
-            "url": f"http://configurationitem/table/computer?SystemID=SOAP-UI&ReferenceID=*&MaxRows=100&KeyName=u_display_name&KeyValue={task['cmdb_ci']}",
-            "headers": {
-                "accept": "application/json"
-            },
-            "method": "GET"
-        }
-        response = await call_api(spec["url"], headers=spec["headers"], method=spec["method"])
-        computer_found = response["result"]
+        # If there is a CI, we use the CI to determine the type of device to slot (usually already cached by the refresh)
+        computer_found = (await resolve_computers([display_name])).get(ci_display_name(display_name))
+        if computer_found is None:
+            return False, "Cannot slot Device! Could not look up the Configuration item, please try again.", False
     
     if len(computer_found) == 0: # If there is no computer found, we return an error
         return False, "Cannot slot Device! Cannot determine what type of device this is, needs to be defined in the the config file via key words", False
@@ -125,38 +177,57 @@ async def assign_device_to_shelf(task: dict, override_mode: bool = None):
     if shelf is None: # If there is no shelf found, we return an error
         return False, "Could not find shelf for device", False
     
-    slot_index = shelf.assignDevice(display_name, ticket_number=str(task.get('number', ''))) # We don't use the slot_index here because it is zero indexed and assignDevice expects the slot number not the index/converts to zero based index
-    
-    # Handle overflow case (no available slots)
-    if slot_index is None: # If there is no slot found, that means the shelf is full and we need to assign the device to the overflow slot
-        display_name = f"placeholder_overfill_{task['number']}"
-        overfill_shelf, overfill_slot = resolve_overflow_shelf(computer_found)
-        if overfill_shelf is None:
-            return False, "Could not find overflow shelf for device", False
-        slot_to_use = overfill_slot if overfill_slot is not None else overfill_shelf.slot_start
-        overfill_shelf.assignDeviceWithSlot(display_name, slot_to_use, ticket_number=str(task.get('number', '')))  # Uses the configured overflow slot (or shelf start)
-        return overfill_shelf, slot_to_use, True
+    # The shelf and its overflow shelf change in one transaction, so another worker can't fill or change either in between
+    overfill_shelf, overfill_slot = resolve_overflow_shelf(computer_found)
+    async with shelf_locks_async(shelf, overfill_shelf): # Awaited without blocking the loop; the transaction itself runs in a worker thread
+        return await asyncio.to_thread(auto_assign_slot, task, display_name, shelf, overfill_shelf, overfill_slot)
+
+def auto_assign_slot(task: dict, display_name: str, shelf, overfill_shelf, overfill_slot):
+    """The auto-assign placement (blocking shelf I/O): the device's shelf, or its overflow slot when the shelf is full."""
+    with shelf_transaction(shelf, overfill_shelf):
+        slot_index = shelf.assignDevice(display_name, ticket_number=str(task.get('number', ''))) # We don't use the slot_index here because it is zero indexed and assignDevice expects the slot number not the index/converts to zero based index
+        
+        # Handle overflow case (no available slots)
+        if slot_index is None: # If there is no slot found, that means the shelf is full and we need to assign the device to the overflow slot
+            display_name = f"placeholder_overfill_{task['number']}"
+            if overfill_shelf is None:
+                return False, "Could not find overflow shelf for device", False
+            slot_to_use = overfill_slot if overfill_slot is not None else overfill_shelf.slot_start
+            overfill_shelf.assignDeviceWithSlot(display_name, slot_to_use, ticket_number=str(task.get('number', '')), overflow=True)  # Uses the configured overflow slot (or shelf start)
+            return overfill_shelf, slot_to_use, True
     
     # Return shelf, actual slot number (index + start), and overflow flag
     return shelf, (slot_index + shelf.slot_start), False
 
+def slot_placement(task: dict):
+    """
+    Where override mode would put a task's device: (ticket_number, display_name, slot_number) from the slot in its
+    short description, or None when the task is closed or has no slot. Whether the slot is on a shelf is left to
+    the caller (apply_slot_placements reports it as "no_shelf").
+    """
+    # Validate task state for override mode
+    if str(task.get("state", "")) in ["Cancelled", "Closed", "Resolved"]:
+        return None
+    
+    # Extract slot number from description
+    slot_number_from_desc, ucd = extract_ucd_slot(task["short_description"])
+    if slot_number_from_desc is None:
+        return None
+    
+    # Use placeholder if display_name is empty
+    display_name = task["cmdb_ci"]
+    if display_name == "":
+        display_name = f"placeholder_device_{task['number']}"
+    return str(task.get('number', '')), display_name, int(slot_number_from_desc)
+
 def resolve_overflow_shelf(device: list[dict]):
     """
-    Determine the overflow shelf and slot based on configured overflow_rules.
+    Determine the overflow shelf and slot based on configured overflow_rules (first matching rule wins).
     Returns (shelf_object_or_none, slot_number_or_none)
     """
-    rules = config.get("overflow_rules", [])
     if not device:
         return None, None
-    asset = str(device[0].get("asset", "")).lower()
-    sys_class = str(device[0].get("sys_class_name", "")).lower()
-    for rule in rules:
-        for kw in rule.get("keywords", []):
-            kw_lower = str(kw).lower()
-            if kw_lower in asset or kw_lower in sys_class:
-                shelf_name = rule.get("shelf")
-                shelf_obj = shelves.get(shelf_name)
-                if shelf_obj is None:
-                    continue
-                return shelf_obj, rule.get("slot")
-    return None, None
\ No newline at end of file
+    shelf_name, slot = shelf_classifier.overflow_for(device[0].get("asset", ""), device[0].get("sys_class_name", ""))
+    if shelf_name is None:
+        return None, None
+    return shelves[shelf_name], slot
\ No newline at end of file
@@ -0,0 +1,137 @@
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object() # returned by TTLCache.get for keys that are absent or expired (cached values may be None)
+
+class TTLCache:
+    """
+    Thread-safe cache with a per-entry time to live and an LRU size bound.
+    Entries can be given their own ttl, e.g. a shorter one for negative (not found) results.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[any, tuple[float, any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl: float = None):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_many(self, keys):
+        """Returns (found, missing): a dict of cached values and a list of keys that need fetching."""
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.get(key)
+            if value is MISSING:
+                missing.append(key)
+            else:
+                found[key] = value
+        return found, missing
+
+    def invalidate(self, key=MISSING):
+        """Drop one key, or everything when no key is given."""
+        with self._lock:
+            if key is MISSING:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+class SingleFlight:
+    """
+    Coalesces calls to `function`: at most one run is in flight, and callers arriving while it runs share it.
+    start() kicks a run off on a background thread (or joins the one in flight) and returns at once; wait() also
+    waits up to timeout for that run. last_success is when a run last finished without raising, last_attempt when
+    one last finished at all. After a failure, due() holds opportunistic refreshes back for backoff seconds,
+    doubling per consecutive failure up to max_backoff, so polling a broken upstream doesn't retry it back to back.
+    """
+
+    def __init__(self, function, name: str = "single-flight", backoff: float = 30, max_backoff: float = 600):
+        self.function = function
+        self.name = name
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._done: threading.Event = None # set when the run in flight finishes; None while idle
+        self.last_success = 0.0
+        self.last_attempt = 0.0
+        self.last_error: Exception = None
+        self.failures = 0 # consecutive failed runs
+        self.runs = 0
+        self.joined = 0
+
+    @property
+    def in_flight(self):
+        return self._done is not None
+
+    def start(self):
+        """Start a run unless one is in flight. Returns the Event that is set when that run finishes."""
+        with self._lock:
+            if self._done is not None:
+                self.joined += 1
+                return self._done
+            done = self._done = threading.Event()
+            self.runs += 1
+        threading.Thread(target=self._run, args=(done,), name=self.name, daemon=True).start()
+        return done
+
+    def _run(self, done: threading.Event):
+        try:
+            self.function()
+            self.last_success = time.time()
+            self.last_error = None
+            self.failures = 0
+        except Exception as e:
+            self.last_error = e
+            self.failures += 1
+            print(f"{self.name} failed ({self.failures} in a row, next try in {self.retry_delay():.0f}s or later): {e}")
+        finally:
+            self.last_attempt = time.time()
+            with self._lock:
+                self._done = None
+            done.set()
+
+    def wait(self, timeout: float = None):
+        """Start or join a run and wait up to timeout seconds for it. Returns True if it finished."""
+        return self.start().wait(timeout)
+
+    def retry_delay(self):
+        """The backoff after the current run of consecutive failures (0 when the last run succeeded)."""
+        return min(self.backoff * 2 ** (self.failures - 1), self.max_backoff) if self.failures else 0.0
+
+    def retry_in(self):
+        """Seconds until the failure backoff ends (0 when not backing off)."""
+        return max(self.last_attempt + self.retry_delay() - time.time(), 0.0) if self.failures else 0.0
+
+    def due(self, max_age: float):
+        """Whether a caller should start() a run: the last success is older than max_age and no backoff is pending."""
+        return time.time() - self.last_success > max_age and self.retry_in() == 0
+
+    def stats(self):
+        return {"in_flight": self.in_flight, "runs": self.runs, "joined": self.joined, "last_success": self.last_success,
+                "last_attempt": self.last_attempt, "failures": self.failures, "retry_in": round(self.retry_in(), 1),
+                "last_error": str(self.last_error) if self.last_error else None}
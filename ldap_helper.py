@@ -0,0 +1,247 @@
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import ldap3
+import dns.resolver
+from ldap3.core.exceptions import LDAPException
+from ldap3.utils.conv import escape_filter_chars
+import yaml
+
+from cache_helper import TTLCache, MISSING
+
+with open("config.yaml", "r") as f:
+    config = yaml.safe_load(f)
+
+ldap_config = config["ldap"]
+ldap_server = ldap_config["server"]
+search_base = ldap_config["search_base"]
+
+# username (lowercased) -> email, or None when AD has no match
+email_cache = TTLCache(max_entries=ldap_config.get("email_cache_max_entries", 1000), ttl=ldap_config.get("email_cache_ttl_seconds", 3600))
+
+_srv_lock = threading.Lock()
+_srv_cache = {"host": None, "expires": 0.0} # DC host from the AD DNS SRV record, kept for the record's TTL
+
+def get_ad_domain():
+    return ".".join(
+        part.split("=", 1)[1].strip()
+        for part in str(search_base).split(",")
+        if part.strip().lower().startswith("dc=")
+    )
+
+def resolve_dc_host(ad_domain: str):
+    """Resolve a DC from _ldap._tcp.dc._msdcs.<domain>, reusing the answer until its DNS TTL runs out."""
+    now = time.monotonic()
+    with _srv_lock:
+        if _srv_cache["expires"] > now:
+            return _srv_cache["host"]
+
+    host = None
+    ttl = ldap_config.get("srv_failure_ttl_seconds", 60) # retry a failed lookup sooner than a good answer expires
+    try:
+        answers = dns.resolver.resolve(f"_ldap._tcp.dc._msdcs.{ad_domain}", "SRV")
+        if answers:
+            best = sorted(answers, key=lambda answer: (answer.priority, -answer.weight))[0]
+            host = str(best.target).rstrip(".")
+            ttl = max(answers.rrset.ttl, ldap_config.get("srv_min_ttl_seconds", 30))
+    except Exception:
+        host = None
+
+    with _srv_lock:
+        _srv_cache["host"] = host
+        _srv_cache["expires"] = now + ttl
+    return host
+
+def build_ldap_server():
+    """Build an ldap3 Server, preferring a real DC resolved from AD DNS SRV."""
+    raw_server = str(ldap_server).strip()
+    use_ssl = raw_server.lower().startswith("ldaps://")
+    ad_domain = get_ad_domain()
+
+    host = None
+    port = None
+
+    if ad_domain:
+        host = resolve_dc_host(ad_domain)
+
+    if not host:
+        host = raw_server
+        if "://" in raw_server:
+            parsed = urlparse(raw_server)
+            host = parsed.hostname or raw_server
+            port = parsed.port
+        elif ":" in raw_server and "/" not in raw_server:
+            host_part, port_part = raw_server.rsplit(":", 1)
+            if port_part.isdigit():
+                host = host_part
+                port = int(port_part)
+
+    server_kwargs = {"host": host, "use_ssl": use_ssl}
+    if port:
+        server_kwargs["port"] = port
+    return ldap3.Server(**server_kwargs)
+
+def kerberos_connection():
+    """A new connection bound with the app pool identity (gMSA) over GSSAPI."""
+    return ldap3.Connection(
+        build_ldap_server(),
+        authentication=ldap3.SASL,
+        sasl_mechanism="GSSAPI",
+        auto_bind=True
+    )
+
+def mock_connection_factory(entries: dict[str, dict]):
+    """
+    Connection factory for a local stand-in directory (ldap3 MOCK_SYNC), e.g. for testing the pool and cache:
+        mock_connection_factory({"cn=jdoe,dc=srp,dc=gov": {"sAMAccountName": "jdoe", "mail": "jdoe@srpnet.com", "objectClass": "person"}})
+    """
+    def factory():
+        conn = ldap3.Connection(ldap3.Server("stand-in"), user="cn=stand-in", password="stand-in", client_strategy=ldap3.MOCK_SYNC)
+        conn.strategy.add_entry("cn=stand-in", {"userPassword": "stand-in", "objectClass": "person"})
+        for dn, attributes in entries.items():
+            conn.strategy.add_entry(dn, attributes)
+        conn.bind()
+        return conn
+    return factory
+
+class LdapConnectionPool:
+    """
+    Small pool of bound LDAP connections.
+
+    Connections are checked before reuse: closed or unbound ones are rebound (or replaced if that fails), and one
+    that sat idle longer than health_check_seconds is probed with a whoami first, since the DC may have dropped it.
+    A connection that raised while checked out is unbound and discarded instead of returned to the pool.
+    """
+
+    def __init__(self, connection_factory, size: int = 4, health_check_seconds: float = 60, acquire_timeout: float = 10):
+        self._factory = connection_factory
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle: list[tuple[ldap3.Connection, float]] = []
+        self._lock = threading.Lock()
+        self.health_check_seconds = health_check_seconds
+        self.acquire_timeout = acquire_timeout
+        self.created = 0
+        self.rebinds = 0
+        self.discarded = 0
+
+    def _discard(self, conn: ldap3.Connection):
+        self.discarded += 1
+        try:
+            conn.unbind()
+        except Exception:
+            pass
+
+    def _healthy(self, conn: ldap3.Connection, idle_since: float):
+        try:
+            if conn.closed or not conn.bound:
+                self.rebinds += 1
+                return conn.bind() # reopens a closed connection before binding
+            if time.monotonic() - idle_since > self.health_check_seconds:
+                conn.extend.standard.who_am_i() # any reply, even unwillingToPerform, proves the connection is alive
+                return not conn.closed
+        except LDAPException:
+            return False
+        return True
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, idle_since = self._idle.pop()
+            if self._healthy(conn, idle_since):
+                return conn
+            self._discard(conn)
+        self.created += 1
+        return self._factory()
+
+    @contextmanager
+    def connection(self):
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise TimeoutError("Timed out waiting for a pooled LDAP connection")
+        conn = None
+        try:
+            conn = self._checkout()
+            yield conn
+        except Exception:
+            if conn is not None:
+                self._discard(conn)
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                with self._lock:
+                    self._idle.append((conn, time.monotonic()))
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._lock:
+            return {"idle": len(self._idle), "created": self.created, "rebinds": self.rebinds, "discarded": self.discarded}
+
+ldap_pool = LdapConnectionPool(
+    kerberos_connection,
+    size=ldap_config.get("pool_size", 4),
+    health_check_seconds=ldap_config.get("health_check_seconds", 60),
+)
+atexit.register(ldap_pool.close)
+
+def build_search_filter(username):
+    raw_username = str(username).strip()
+    if not raw_username:
+        return None
+
+    samaccount = raw_username.split("\\")[-1].split("@")[0].strip()
+    filters = []
+
+    if samaccount:
+        filters.append(f"(sAMAccountName={escape_filter_chars(samaccount)})")
+    if "@" in raw_username:
+        escaped_raw = escape_filter_chars(raw_username)
+        filters.append(f"(userPrincipalName={escaped_raw})")
+        filters.append(f"(mail={escaped_raw})")
+
+    if not filters:
+        return None
+
+    return filters[0] if len(filters) == 1 else f"(|{''.join(filters)})"
+
+def get_email_for_samaccount(username, pool: LdapConnectionPool = None):
+    """Lookup email attributes in AD using app pool identity (gMSA), cached per username."""
+    if not username:
+        return None
+
+    search_filter = build_search_filter(username)
+    if search_filter is None:
+        return None
+
+    cache_key = str(username).strip().lower()
+    cached = email_cache.get(cache_key)
+    if cached is not MISSING:
+        return cached
+
+    pool = pool or ldap_pool
+    for attempt in range(2): # a pooled connection the DC dropped fails once, then a fresh one is used
+        try:
+            with pool.connection() as conn:
+                conn.search(search_base, search_filter, attributes=['mail', 'userPrincipalName'])
+                entries = conn.entries
+            break
+        except LDAPException:
+            if attempt == 1:
+                raise
+
+    email = None
+    if entries:
+        entry = entries[0]
+        email = entry.mail.value or entry.userPrincipalName.value
+    email_cache.set(cache_key, email, ttl=None if email else ldap_config.get("email_negative_ttl_seconds", 300))
+    return email
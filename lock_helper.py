@@ -0,0 +1,255 @@
+import asyncio
+import contextvars
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+
+from filelock import FileLock, Timeout
+import yaml
+
+with open("config.yaml", "r") as f:
+    config = yaml.safe_load(f)
+
+lock_config = config.get("locks", {})
+
+# Set while an async caller holds a lock, so the work it hands to asyncio.to_thread (which copies the context)
+# counts as the same owner and can re-enter the lock instead of deadlocking on it
+_async_owner = contextvars.ContextVar("lock_owner", default=None)
+
+def _current_owner():
+    return _async_owner.get() or threading.get_ident()
+
+class LockTimeout(TimeoutError):
+    pass
+
+class LockMetrics:
+    """Contention counters for one lock (outermost acquisitions only, re-entries aren't counted)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.acquired = {"read": 0, "write": 0}
+        self.contended = 0 # acquisitions that had to wait
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+
+    def record_acquire(self, mode: str, waited: float):
+        with self._lock:
+            self.acquired[mode] += 1
+            if waited > 0.001:
+                self.contended += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def record_release(self, held: float):
+        with self._lock:
+            self.hold_total += held
+            self.hold_max = max(self.hold_max, held)
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self):
+        with self._lock:
+            acquisitions = sum(self.acquired.values())
+            return {
+                "reads": self.acquired["read"],
+                "writes": self.acquired["write"],
+                "contended": self.contended,
+                "timeouts": self.timeouts,
+                "wait_avg_ms": round(self.wait_total / acquisitions * 1000, 2) if acquisitions else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 2),
+                "hold_avg_ms": round(self.hold_total / acquisitions * 1000, 2) if acquisitions else 0.0,
+                "hold_max_ms": round(self.hold_max * 1000, 2),
+            }
+
+class ShelfLock:
+    """
+    Readers-writer lock with bounded waits and contention metrics.
+
+    read() is shared between threads of this process; write() is exclusive, and when file_path is given it also
+    holds a FileLock so other worker processes are excluded too (reads don't need it, files are replaced atomically).
+    Both are reentrant for their owner, and a writer may also read. Waits are bounded by timeout and raise
+    LockTimeout instead of sleeping and retrying forever. Writers are preferred: while a writer waits, new readers
+    queue behind it (owners that already hold the lock can still re-enter), so a steady stream of reads can't
+    starve writes.
+
+    read_async()/write_async() never block the event loop: they poll with asyncio.sleep. The holder's context is
+    the owner, so shelf work passed to asyncio.to_thread inside the block re-enters the lock.
+    """
+
+    POLL_INTERVAL = 0.05 # how often a waiter re-checks a lock held by another process
+
+    def __init__(self, name: str, file_path: str = None, timeout: float = 30):
+        self.name = name
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._readers: dict[any, int] = {} # owner -> read depth
+        self._writer = None
+        self._writer_depth = 0
+        self._writers_waiting = 0
+        self._file_lock = FileLock(file_path) if file_path else None
+        self._held_since: dict[tuple[any, str], float] = {}
+        self.metrics = LockMetrics()
+
+    def _try_acquire(self, owner, exclusive: bool):
+        """One non-blocking attempt; returns whether this is the owner's outermost hold, or None if not acquired."""
+        if exclusive:
+            if self._writer not in (None, owner) or any(reader != owner for reader in self._readers):
+                return None
+            if self._writer_depth == 0 and self._file_lock is not None:
+                try:
+                    self._file_lock.acquire(timeout=0)
+                except Timeout:
+                    return None
+            self._writer = owner
+            self._writer_depth += 1
+            return self._writer_depth == 1
+        if self._writer not in (None, owner):
+            return None
+        if self._writers_waiting and self._writer != owner and owner not in self._readers: # let the waiting writer in first
+            return None
+        self._readers[owner] = self._readers.get(owner, 0) + 1
+        return self._readers[owner] == 1 and self._writer != owner
+
+    def _acquired(self, owner, mode: str, outermost: bool, started: float):
+        if outermost:
+            now = time.monotonic()
+            self.metrics.record_acquire(mode, now - started)
+            self._held_since[(owner, mode)] = now
+
+    def _timed_out(self, mode: str, timeout: float):
+        self.metrics.record_timeout()
+        return LockTimeout(f"Timed out after {timeout}s waiting for the {mode} lock on {self.name}")
+
+    def _writer_waits(self, waiting: bool):
+        """Count a writer in (or out of) _writers_waiting; call with self._cond held."""
+        self._writers_waiting += 1 if waiting else -1
+        if not waiting:
+            self._cond.notify_all() # readers held back for it may go now
+
+    def _release(self, owner, exclusive: bool):
+        mode = "write" if exclusive else "read"
+        with self._cond:
+            if exclusive:
+                self._writer_depth -= 1
+                outermost = self._writer_depth == 0
+                if outermost:
+                    self._writer = None
+                    if self._file_lock is not None:
+                        self._file_lock.release()
+            else:
+                self._readers[owner] -= 1
+                outermost = self._readers[owner] == 0
+                if outermost:
+                    del self._readers[owner]
+            held_since = self._held_since.pop((owner, mode), None) if outermost else None
+            self._cond.notify_all()
+        if held_since is not None:
+            self.metrics.record_release(time.monotonic() - held_since)
+
+    def _acquire(self, exclusive: bool, timeout: float = None):
+        owner = _current_owner()
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        with self._cond:
+            waiting = False
+            try:
+                while (outermost := self._try_acquire(owner, exclusive)) is None:
+                    if exclusive and not waiting:
+                        waiting = True
+                        self._writer_waits(True)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise self._timed_out("write" if exclusive else "read", timeout)
+                    self._cond.wait(min(remaining, self.POLL_INTERVAL))
+            finally:
+                if waiting:
+                    self._writer_waits(False)
+            self._acquired(owner, "write" if exclusive else "read", outermost, started)
+        return owner
+
+    async def _acquire_async(self, exclusive: bool, timeout: float = None):
+        owner = _current_owner()
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        delay = 0.001
+        waiting = False
+        try:
+            while True:
+                with self._cond:
+                    outermost = self._try_acquire(owner, exclusive)
+                    if outermost is not None:
+                        self._acquired(owner, "write" if exclusive else "read", outermost, started)
+                        return owner
+                    if exclusive and not waiting:
+                        waiting = True
+                        self._writer_waits(True)
+                if time.monotonic() - started >= timeout:
+                    raise self._timed_out("write" if exclusive else "read", timeout)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.POLL_INTERVAL)
+        finally:
+            if waiting:
+                with self._cond:
+                    self._writer_waits(False)
+
+    @contextmanager
+    def read(self, timeout: float = None):
+        owner = self._acquire(False, timeout)
+        try:
+            yield
+        finally:
+            self._release(owner, False)
+
+    @contextmanager
+    def write(self, timeout: float = None):
+        owner = self._acquire(True, timeout)
+        try:
+            yield
+        finally:
+            self._release(owner, True)
+
+    @asynccontextmanager
+    async def _hold_async(self, exclusive: bool, timeout: float = None):
+        token = _async_owner.set(object()) if _async_owner.get() is None else None
+        try:
+            owner = await self._acquire_async(exclusive, timeout)
+            try:
+                yield
+            finally:
+                self._release(owner, exclusive)
+        finally:
+            if token is not None:
+                _async_owner.reset(token)
+
+    def read_async(self, timeout: float = None):
+        return self._hold_async(False, timeout)
+
+    def write_async(self, timeout: float = None):
+        return self._hold_async(True, timeout)
+
+class LockManager:
+    """Creates and keeps one ShelfLock per name, and reports their metrics."""
+
+    def __init__(self, timeout: float = 30):
+        self.timeout = timeout
+        self._locks: dict[str, ShelfLock] = {}
+        self._guard = threading.Lock()
+
+    def get(self, name: str, file_path: str = None):
+        with self._guard:
+            if name not in self._locks:
+                self._locks[name] = ShelfLock(name, file_path, timeout=self.timeout)
+            return self._locks[name]
+
+    def metrics(self):
+        with self._guard:
+            locks = dict(self._locks)
+        return {name: lock.metrics.snapshot() for name, lock in sorted(locks.items())}
+
+lock_manager = LockManager(timeout=lock_config.get("timeout_seconds", 30))
@@ -0,0 +1,153 @@
+import json
+from collections import defaultdict
+
+API_BASE_URL = "http://configurationitem/table"
+MAX_ROWS = 1000
+
+# The only ticket fields the dashboard and slotting logic read (plus what ticket_store needs for delta sync).
+# Ticket queries are streamed and projected to these, so unused ServiceNow fields are never held in memory.
+TICKET_FIELDS = [
+    "number", "sys_id", "state", "short_description", "cmdb_ci", "assignment_group", "requested_for", "parent",
+    "sys_updated_on", "active",
+]
+
+# Class labels, as the original calls name them, to the stored class values. The original calls send the class as a
+# separate name=value parameter next to sysparm_query, which the gateway matches by label; inside an encoded query
+# ServiceNow compares the stored value, so merged clauses have to use sc_task / incident.
+SYS_CLASS_VALUES = {"Catalog Task": "sc_task", "Incident": "incident"}
+
+def ticket_query(table: str, assignment_group: str, short_description_like: str, sys_class_name: str):
+    """
+    One logical ticket query: active records in table for one assignment group (by name) whose
+    short description contains short_description_like (ServiceNow LIKE is a case-insensitive substring match).
+    sys_class_name is the class as the original calls named it (Catalog Task, Incident).
+    """
+    return {
+        "table": table,
+        "assignment_group": assignment_group,
+        "short_description_like": short_description_like,
+        "sys_class_name": sys_class_name,
+    }
+
+def to_call_spec(query: dict):
+    """The unplanned call spec for a single query (one upstream call per query, as get_tickets used to send)."""
+    return {
+        "url": f"{API_BASE_URL}/{query['table']}?SystemID=SOAP-UI&ReferenceID=*&MaxRows={MAX_ROWS}&KeyName=assignment_group&KeyValue={query['assignment_group']}",
+        "headers": {
+            "accept": "application/json",
+            "QueryParams": f"sysparm_query=short_descriptionLIKE{query['short_description_like']}&active=true&sys_class_name={query['sys_class_name']}"
+        },
+        "method": "GET",
+        "stream": True,
+        "fields": TICKET_FIELDS
+    }
+
+def plan_queries(queries: list[dict], combine_with_nq: bool = True, updated_since: str = None, known_sys_ids: dict[str, list[str]] = None,
+                 sys_ids_per_call: int = 100):
+    """
+    Merge ticket queries into the fewest upstream calls that return the same union of tickets.
+
+    Queries are grouped by (table, sys_class_name). Within a group, every LIKE term is bucketed by the exact
+    set of assignment groups it is queried for, and each bucket becomes one encoded-query clause:
+        active=true^sys_class_name=...^assignment_group.nameINg1,g2^short_descriptionLIKEt1^ORshort_descriptionLIKEt2
+    Since bucket groups x bucket terms is exactly the set of original (group, term) pairs, the union is unchanged.
+    assignment_group is a reference field, so groups are matched on the dot-walked name, as KeyValue does, and the
+    class label is swapped for its value (SYS_CLASS_VALUES).
+    With combine_with_nq the clauses of a table are joined with ^NQ into a single call, otherwise one call per clause.
+
+    Delta mode (updated_since set, a ServiceNow "YYYY-MM-DD HH:MM:SS" timestamp) swaps the active=true filter for
+    sys_updated_on>=updated_since, so deactivated and closed records come back too and can be removed by the caller.
+    known_sys_ids ({table: [sys_id, ...]}) adds sys_idIN calls per table so records already held locally are
+    returned even if they were edited out of every LIKE term. They are split into calls of at most sys_ids_per_call
+    ids (never combined with ^NQ) so the QueryParams header stays bounded however many tickets are held.
+
+    Returns a list of {"table": table, "spec": call_spec, "queries": [original queries covered by this call]}.
+    """
+    by_table: dict[tuple, list[dict]] = defaultdict(list)
+    for query in queries:
+        by_table[(query["table"], query["sys_class_name"])].append(query)
+
+    filter_clause = f"sys_updated_on>={updated_since}" if updated_since else "active=true"
+    planned = []
+    known_tables = set()
+    for (table, sys_class_name), table_queries in by_table.items():
+        groups_by_term: dict[str, set] = defaultdict(set)
+        for query in table_queries:
+            groups_by_term[query["short_description_like"]].add(query["assignment_group"])
+
+        terms_by_groups: dict[frozenset, list[str]] = defaultdict(list)
+        for term, groups in groups_by_term.items():
+            terms_by_groups[frozenset(groups)].append(term)
+
+        clauses = []
+        for groups, terms in terms_by_groups.items():
+            covered = [q for q in table_queries if q["assignment_group"] in groups and q["short_description_like"] in terms]
+            like = "^OR".join(f"short_descriptionLIKE{term}" for term in terms)
+            clause = f"{filter_clause}^sys_class_name={SYS_CLASS_VALUES.get(sys_class_name, sys_class_name)}^assignment_group.nameIN{','.join(sorted(groups))}^{like}"
+            clauses.append((clause, covered))
+
+        if combine_with_nq:
+            clauses = [("^NQ".join(clause for clause, _ in clauses), [q for _, covered in clauses for q in covered])]
+
+        if updated_since and known_sys_ids and known_sys_ids.get(table) and table not in known_tables:
+            known_tables.add(table)
+            sys_ids = sorted(known_sys_ids[table])
+            for start in range(0, len(sys_ids), sys_ids_per_call):
+                clauses.append((f"{filter_clause}^sys_idIN{','.join(sys_ids[start:start + sys_ids_per_call])}", []))
+
+        for clause, covered in clauses:
+            planned.append({
+                "table": table,
+                "spec": {
+                    "url": f"{API_BASE_URL}/{table}?SystemID=SOAP-UI&ReferenceID=*&MaxRows={MAX_ROWS}",
+                    "headers": {
+                        "accept": "application/json",
+                        "QueryParams": f"sysparm_query={clause}"
+                    },
+                    "method": "GET",
+                    "stream": True,
+                    "fields": TICKET_FIELDS
+                },
+                "queries": covered,
+            })
+    return planned
+
+def _display_value(value):
+    if isinstance(value, dict):
+        return str(value.get("display_value") or value.get("value") or "").strip()
+    return str(value or "").strip()
+
+def query_matches(ticket: dict, query: dict):
+    """
+    Whether ticket would have been returned by query on its own (used to estimate the unplanned transfer).
+    Table and class are not checked, a planned call only covers queries for its own table and class.
+    """
+    return (
+        _display_value(ticket.get("assignment_group")) == query["assignment_group"]
+        and str(query["short_description_like"]).lower() in str(ticket.get("short_description", "")).lower()
+    )
+
+def unplanned_ticket_bytes(ticket: dict, queries: list[dict]):
+    """
+    Estimated bytes the unplanned fan-out would have spent on ticket, returned by a call covering queries:
+    it is counted once per original query it matches, since that is how many times it would have been transferred.
+    """
+    matches = sum(1 for query in queries if query_matches(ticket, query))
+    return len(json.dumps(ticket)) * max(matches, 1)
+
+def savings_report(queries: list[dict], planned: list[dict], results: list[dict], estimated_ticket_bytes: int):
+    """
+    Report how many upstream calls and bytes the plan saved this refresh.
+    estimated_ticket_bytes is unplanned_ticket_bytes summed over the returned tickets (added up as they stream in).
+    """
+    planned_bytes = sum(result.get("bytes", 0) for result in results)
+    # Each unplanned call also returns an envelope even when empty
+    estimated_unplanned_bytes = estimated_ticket_bytes + len(json.dumps({"result": []})) * len(queries)
+    return {
+        "unplanned_calls": len(queries),
+        "planned_calls": len(planned),
+        "calls_saved": len(queries) - len(planned),
+        "planned_bytes": planned_bytes,
+        "estimated_unplanned_bytes": estimated_unplanned_bytes,
+        "estimated_bytes_saved": max(estimated_unplanned_bytes - planned_bytes, 0),
+    }
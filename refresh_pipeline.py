@@ -0,0 +1,87 @@
+import time
+
+from app_helpers import extract_ucd_slot
+from techstop_shelf_assignment import process_slot_tickets, sync_tickets
+from techstop_notify_automation import prefetch_requesters
+from ticket_store import ticket_store
+from shelves_helper import remove_closed_ticket_devices
+from snapshot_helper import ticket_snapshots
+
+class RefreshPipeline:
+    """
+    A refresh as named stages run in order: each stage takes the previous stage's output and returns its own.
+    Every stage is timed; the timings of the last run are kept in last_run and logged in one line.
+    A failing stage stops the run (and re-raises) unless it is optional, in which case its input is passed on.
+    """
+
+    def __init__(self, stages: list[tuple[str, callable, bool]]):
+        self.stages = stages # (name, function, optional)
+        self.last_run: dict = None
+
+    def run(self, value=None):
+        run = {"started_at": time.time(), "stages": {}, "failed": None}
+        started = time.perf_counter()
+        try:
+            for name, stage, optional in self.stages:
+                stage_started = time.perf_counter()
+                try:
+                    value = stage(value)
+                except Exception as e:
+                    if not optional:
+                        run["failed"] = name
+                        print(f"Refresh stage {name} failed: {e}")
+                        raise
+                    print(f"Refresh stage {name} failed, continuing: {e}")
+                finally:
+                    run["stages"][name] = round((time.perf_counter() - stage_started) * 1000, 1)
+        finally:
+            run["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            self.last_run = run
+            print("Refresh: " + ", ".join(f"{name} {ms}ms" for name, ms in run["stages"].items()) + f" (total {run['total_ms']}ms)")
+        return value
+
+def fetch_stage(_):
+    """The only ServiceNow fan-out of a refresh: bring ticket_store up to date and return its tickets."""
+    return sync_tickets()
+
+def normalize_stage(tickets: list[dict]):
+    """Parse the slot and UCD out of every short description."""
+    for item in tickets:
+        slot, ucd = extract_ucd_slot(item.get('short_description', ''))
+        item["slot"] = slot
+        item["ucd"] = ucd
+    return tickets
+
+def cleanup_stage(tickets: list[dict]):
+    """Remove devices of closed tickets from every shelf (skipped if some ticket query failed, a missing ticket may still be open)."""
+    if not ticket_store.last_sync_complete:
+        print("Skipping closed-ticket cleanup, last ticket sync was incomplete")
+        return tickets
+    total_removed = remove_closed_ticket_devices(ticket_store.active_ticket_numbers()) # only shelves holding a closed ticket are touched
+    if total_removed > 0:
+        print(f"Total devices removed from closed tickets: {total_removed}")
+    return tickets
+
+def reconcile_stage(tickets: list[dict]):
+    """Slot every PAB ticket that has a slot in its short description, from the tickets already fetched."""
+    process_slot_tickets(tickets)
+    return tickets
+
+def publish_stage(tickets: list[dict]):
+    """Serialize and compress the dashboard snapshot once, served as-is by /get-data, /refresh-data and the page bootstrap."""
+    ticket_snapshots.publish(tickets)
+    return tickets
+
+def prefetch_requesters_stage(tickets: list[dict]):
+    """Warm user_cache (requester emails from the ServiceNow user table, table/user on the gateway) so Notify clicks don't wait on that lookup."""
+    prefetch_requesters(tickets)
+    return tickets
+
+refresh_pipeline = RefreshPipeline([
+    ("fetch", fetch_stage, False),
+    ("normalize", normalize_stage, False),
+    ("cleanup", cleanup_stage, True), # shelf problems shouldn't keep fresh tickets off the dashboard
+    ("reconcile", reconcile_stage, True),
+    ("publish", publish_stage, False),
+    ("prefetch_requesters", prefetch_requesters_stage, True),
+])
@@ -0,0 +1,99 @@
+import codecs
+import json
+import re
+
+# Characters that matter while scanning: structure outside strings, quote/escape inside strings
+_STRUCTURE = re.compile(r'["{}\[\]]')
+_STRING_END = re.compile(r'["\\]')
+
+class ResultStreamParser:
+    """
+    Incremental parser for ServiceNow responses shaped like {"result": [ {...}, {...}, ... ], ...}.
+
+    Feed it raw response chunks as they arrive; every call returns the objects of the result array that
+    were completed by that chunk, so only one record (plus the unparsed tail of the chunk) is buffered at a time.
+    Everything outside the result array is skipped without being materialized.
+    """
+
+    def __init__(self, key: str = "result"):
+        self.key = key
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._string_start = None
+        self._last_key = None # last string completed at depth 1, i.e. the key of the next top-level value
+        self._array_depth = None # depth inside the result array once it is found
+        self._item_start = None
+        self.done = False
+        self.found = False
+
+    def feed(self, data: bytes) -> list[dict]:
+        if self.done:
+            return []
+        self._buf += self._decoder.decode(data)
+        items = []
+        buf = self._buf
+        pos = self._pos
+        while pos < len(buf):
+            if self._in_string:
+                match = _STRING_END.search(buf, pos)
+                if match is None:
+                    pos = len(buf)
+                    break
+                if match.group() == "\\":
+                    if match.end() >= len(buf): # escaped character not received yet
+                        pos = match.start()
+                        break
+                    pos = match.end() + 1
+                    continue
+                self._in_string = False
+                if self._depth == 1 and self._string_start is not None:
+                    self._last_key = buf[self._string_start:match.start()]
+                pos = match.end()
+                continue
+
+            match = _STRUCTURE.search(buf, pos)
+            if match is None:
+                pos = len(buf)
+                break
+            char = match.group()
+            pos = match.end()
+            if char == '"':
+                self._in_string = True
+                self._string_start = pos
+            elif char in "{[":
+                if char == "[" and self._depth == 1 and self._array_depth is None and self._last_key == self.key:
+                    self._array_depth = 2
+                    self.found = True
+                elif char == "{" and self._array_depth is not None and self._depth == self._array_depth:
+                    self._item_start = match.start()
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if self._array_depth is not None:
+                    if char == "}" and self._depth == self._array_depth and self._item_start is not None:
+                        items.append(json.loads(buf[self._item_start:pos]))
+                        self._item_start = None
+                    elif char == "]" and self._depth == self._array_depth - 1:
+                        self.done = True
+                        break
+
+        # Keep only what is still needed: the current record, or nothing between records
+        keep_from = self._item_start if self._item_start is not None else pos
+        if self._in_string and self._item_start is None:
+            keep_from = min(keep_from, self._string_start) if self._string_start is not None else keep_from
+        self._buf = buf[keep_from:]
+        self._pos = pos - keep_from
+        if self._item_start is not None:
+            self._item_start -= keep_from
+        if self._string_start is not None:
+            self._string_start -= keep_from
+        return items
+
+def project(item: dict, fields: list[str] = None) -> dict:
+    """Keep only the listed fields of a record (all of them when fields is empty)."""
+    if not fields:
+        return item
+    return {field: item[field] for field in fields if field in item}
@@ -0,0 +1,97 @@
+import functools
+import re
+from bisect import bisect_right
+
+# overflow_rules may point at a shelf_assignment keyword list instead of repeating it: shelf_assignment["elite_book"][0]
+_KEYWORDS_REFERENCE = re.compile(r"""^\s*shelf_assignment\[\s*["']([^"']+)["']\s*\]\s*\[\s*0\s*\]\s*$""")
+
+class ShelfClassifier:
+    """
+    Device -> shelf and slot number -> shelf lookups, compiled once from config.yaml.
+
+    shelf_name_for keeps get_shelf's rule that the last matching shelf_assignment entry wins (so "zbook g11" goes
+    to the more specific entry listed later), overflow_for keeps overflow_rules' first match wins, and slot_owner
+    finds the shelf holding a slot number by bisecting the sorted slot ranges.
+
+    Keywords are lowercased and deduplicated once, and each keyword maps straight to the entry/rule that decides the
+    result. A device's asset and class are lowercased once and scanned with plain substring checks (faster in CPython
+    than a combined regex alternation), and results are memoized per distinct (asset, class), since the same models
+    come up over and over, so lookups stay flat as keywords are added.
+    """
+
+    def __init__(self, shelf_assignment: dict, overflow_rules: list[dict], shelf_ranges: dict[str, tuple[int, int]], cache_size: int = 4096):
+        # keyword -> index of the last shelf_assignment entry listing it
+        self._assignments = []
+        self._assignment_by_keyword: dict[str, int] = {}
+        for index, (keywords, shelf_name) in enumerate(shelf_assignment.values()):
+            self._assignments.append(shelf_name)
+            for keyword in keywords:
+                self._assignment_by_keyword[str(keyword).lower()] = index
+
+        # keyword -> index of the first overflow rule listing it (rules for unknown shelves never match)
+        self._overflow = []
+        self._overflow_by_keyword: dict[str, int] = {}
+        for rule in overflow_rules:
+            if rule.get("shelf") not in shelf_ranges:
+                continue
+            for keyword in self._rule_keywords(rule, shelf_assignment):
+                self._overflow_by_keyword.setdefault(str(keyword).lower(), len(self._overflow))
+            self._overflow.append((rule.get("shelf"), rule.get("slot")))
+
+        self._keywords = tuple(dict.fromkeys([*self._assignment_by_keyword, *self._overflow_by_keyword]))
+        self._match = functools.lru_cache(maxsize=cache_size)(self._match_uncached)
+
+        # Non-empty slot ranges sorted by first slot number, for bisect
+        ranges = sorted((start, start + count - 1, name) for name, (start, count) in shelf_ranges.items() if count > 0)
+        for (_, end, name), (next_start, _, next_name) in zip(ranges, ranges[1:]):
+            if next_start <= end:
+                print(f"Warning: slot ranges of {name} and {next_name} overlap")
+        self._range_starts = [start for start, _, _ in ranges]
+        self._ranges = ranges
+
+    @staticmethod
+    def _rule_keywords(rule: dict, shelf_assignment: dict):
+        keywords = rule.get("keywords", [])
+        if isinstance(keywords, str):
+            reference = _KEYWORDS_REFERENCE.match(keywords)
+            if reference and reference.group(1) in shelf_assignment:
+                return shelf_assignment[reference.group(1)][0]
+            return [keywords]
+        return keywords
+
+    def _match_uncached(self, asset: str, sys_class_name: str):
+        """(deciding shelf_assignment index, deciding overflow rule index) for lowercased texts, None where nothing matched."""
+        assignment = None
+        overflow = None
+        for keyword in self._keywords:
+            if keyword in asset or keyword in sys_class_name:
+                index = self._assignment_by_keyword.get(keyword)
+                if index is not None and (assignment is None or index > assignment):
+                    assignment = index
+                index = self._overflow_by_keyword.get(keyword)
+                if index is not None and (overflow is None or index < overflow):
+                    overflow = index
+        return assignment, overflow
+
+    def shelf_name_for(self, asset: str, sys_class_name: str):
+        """Name of the shelf a device belongs on (last matching shelf_assignment entry), or None."""
+        assignment, _ = self._match(str(asset).lower(), str(sys_class_name).lower())
+        return self._assignments[assignment] if assignment is not None else None
+
+    def overflow_for(self, asset: str, sys_class_name: str):
+        """(shelf name, slot number or None) of the first matching overflow rule, or (None, None)."""
+        _, overflow = self._match(str(asset).lower(), str(sys_class_name).lower())
+        return self._overflow[overflow] if overflow is not None else (None, None)
+
+    def classify(self, devices: list[tuple[str, str]]):
+        """Batch shelf_name_for over (asset, sys_class_name) pairs."""
+        return [self.shelf_name_for(asset, sys_class_name) for asset, sys_class_name in devices]
+
+    def slot_owner(self, slot_number: int):
+        """(shelf name, zero based index) of the shelf holding slot_number, or (None, None)."""
+        position = bisect_right(self._range_starts, slot_number) - 1
+        if position >= 0:
+            start, end, name = self._ranges[position]
+            if slot_number <= end:
+                return name, slot_number - start
+        return None, None
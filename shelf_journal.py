@@ -0,0 +1,253 @@
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+import yaml
+
+from lock_helper import lock_manager
+from slot_model import Occupant, decode_slots, encode_slots
+
+with open("config.yaml", "r") as f:
+    config = yaml.safe_load(f)
+
+journal_config = config.get("shelf_journal", {})
+
+def _day(ts: float):
+    return time.strftime("%Y-%m-%d", time.localtime(ts))
+
+def _occupancy_key(shelf: str, slot: int, device: str, ticket: str):
+    return f"{shelf}|{slot}|{str(device).lower()}|{ticket or ''}"
+
+class ShelfJournal:
+    """
+    Append-only log of shelf changes (journal.log, one JSON record per line) plus a periodic snapshot.
+
+    Records are "assign" / "remove" events written by Shelf whenever it persists, and, with the journal storage
+    backend, "slots" records carrying the new contents of the changed slots. Every compact_every records the current
+    state and rollups are written to snapshot.json and the journal starts over, so a process starting up loads one
+    snapshot and replays only the tail. Worker processes append under the journal's lock_helper write lock (which
+    includes a FileLock) and catch up on each other's records by reading the journal from where they last stopped.
+
+    History is kept as rollups that are updated as records are applied (intake per day and shelf, dwell time per day
+    and shelf, overflow counts and recent overflow events), so history() never reads the raw journal.
+    """
+
+    def __init__(self, directory: str = "ShelfJSON/journal", compact_every: int = 1000, history_days: int = 90, overflow_events_kept: int = 200):
+        self.directory = directory
+        self.compact_every = compact_every
+        self.history_days = history_days
+        self.overflow_events_kept = overflow_events_kept
+        self._journal_path = f"{directory}/journal.log"
+        self._snapshot_path = f"{directory}/snapshot.json"
+        os.makedirs(directory, exist_ok=True)
+        self._lock = lock_manager.get(f"journal:{directory}", f"{directory}/journal.lock")
+        self._snapshot_version = None
+        self._offset = 0 # bytes of journal.log already applied
+        self._reset()
+
+    def _reset(self):
+        self.seq = 0
+        self._records_since_snapshot = 0
+        self.state: dict[str, list[list[Occupant]]] = {} # shelf -> slots, from "slots" records
+        self.state_seq: dict[str, int] = {} # shelf -> seq of its last "slots" record (the journal backend's version)
+        self.rollups = {
+            "intake": {}, # day -> shelf -> devices placed
+            "dwell": {}, # day -> shelf -> [devices removed, total seconds on the shelf, longest seconds]
+            "overflow": {}, # day -> overflow placements
+            "overflow_events": [], # most recent overflow placements
+            "placed": {}, # shelf|slot|device|ticket -> when it was placed, for devices still on a shelf
+        }
+
+    def _file_version(self, path):
+        try:
+            stat = os.stat(path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _load_snapshot(self):
+        self._reset()
+        self._offset = 0
+        self._snapshot_version = self._file_version(self._snapshot_path)
+        if self._snapshot_version is None:
+            return
+        with open(self._snapshot_path, "r") as file:
+            snapshot = json.load(file)
+        self.seq = snapshot["seq"]
+        self.state = {name: decode_slots(slots) for name, slots in snapshot["shelves"].items()}
+        self.state_seq = snapshot["state_seq"]
+        self.rollups = snapshot["rollups"]
+
+    def catch_up(self):
+        """Apply records appended since the last call (by any process); reload everything if the journal was compacted."""
+        with self._lock.write():
+            self._catch_up()
+
+    def _catch_up(self):
+        if self._file_version(self._snapshot_path) != self._snapshot_version:
+            self._load_snapshot()
+        try:
+            with open(self._journal_path, "rb") as file:
+                file.seek(self._offset)
+                data = file.read()
+        except FileNotFoundError:
+            return
+        complete = data[:data.rfind(b"\n") + 1] # a torn last line (crash mid-append) is ignored
+        for line in complete.splitlines():
+            if line.strip():
+                self._apply(json.loads(line))
+        self._offset += len(complete)
+
+    def _apply(self, record: dict):
+        if record["seq"] <= self.seq:
+            return
+        self.seq = record["seq"]
+        self._records_since_snapshot += 1
+        shelf = record["shelf"]
+        op = record["op"]
+        if op == "slots":
+            slots = self.state.get(shelf)
+            if slots is None or len(slots) != record["size"]:
+                slots = self.state[shelf] = [[] for _ in range(record["size"])]
+            for slot_index, occupants in record["slots"].items():
+                slots[int(slot_index)] = decode_slots([occupants])[0]
+            self.state_seq[shelf] = record["seq"]
+            return
+
+        rollups = self.rollups
+        day = _day(record["ts"])
+        key = _occupancy_key(shelf, record["slot"], record["device"], record.get("ticket"))
+        if op == "assign":
+            intake = rollups["intake"].setdefault(day, {})
+            intake[shelf] = intake.get(shelf, 0) + 1
+            rollups["placed"][key] = record["ts"]
+            if record.get("overflow"):
+                rollups["overflow"][day] = rollups["overflow"].get(day, 0) + 1
+                rollups["overflow_events"].append({field: record.get(field) for field in ("ts", "shelf", "slot", "device", "ticket")})
+                del rollups["overflow_events"][:-self.overflow_events_kept]
+        elif op == "remove":
+            placed_at = rollups["placed"].pop(key, None)
+            if placed_at is not None:
+                seconds = max(0.0, record["ts"] - placed_at)
+                dwell = rollups["dwell"].setdefault(day, {}).setdefault(shelf, [0, 0.0, 0.0])
+                dwell[0] += 1
+                dwell[1] += seconds
+                dwell[2] = max(dwell[2], seconds)
+
+    def _append(self, records: list[dict]):
+        """Number, write and apply records; caller holds the write lock."""
+        self._catch_up()
+        lines = []
+        for record in records:
+            record["seq"] = self.seq + len(lines) + 1
+            lines.append(json.dumps(record, separators=(",", ":")))
+        with open(self._journal_path, "a") as file:
+            file.write("\n".join(lines) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        self._catch_up()
+        if self._records_since_snapshot >= self.compact_every:
+            self._compact()
+
+    def record(self, shelf: str, events: list[dict]):
+        """Append assign/remove events (dicts with op, ts, slot, device, ticket and overflow or reason)."""
+        if not events:
+            return
+        with self._lock.write():
+            self._append([{"shelf": shelf, **event} for event in events])
+
+    def record_slots(self, shelf: str, slots: list[list[Occupant]], changed=None):
+        """Append the contents of the changed slot indices (all when changed is None). Returns the shelf's new version."""
+        changed = range(len(slots)) if changed is None else sorted(changed)
+        encoded = encode_slots([slots[slot_index] for slot_index in changed])
+        with self._lock.write():
+            self._append([{
+                "shelf": shelf, "op": "slots", "ts": time.time(), "size": len(slots),
+                "slots": {str(slot_index): occupants for slot_index, occupants in zip(changed, encoded)},
+            }])
+            return self.state_seq[shelf]
+
+    def _compact(self):
+        """Write the applied state and rollups as the new snapshot and start an empty journal; caller holds the write lock."""
+        cutoff = _day(time.time() - self.history_days * 86400)
+        for rollup in ("intake", "dwell", "overflow"):
+            for day in [day for day in self.rollups[rollup] if day < cutoff]:
+                del self.rollups[rollup][day]
+
+        snapshot = {
+            "seq": self.seq,
+            "shelves": {name: encode_slots(slots) for name, slots in self.state.items()},
+            "state_seq": self.state_seq,
+            "rollups": self.rollups,
+        }
+        temp_file_path = self._snapshot_path + ".tmp"
+        with open(temp_file_path, "w") as file:
+            json.dump(snapshot, file, separators=(",", ":"))
+        os.replace(temp_file_path, self._snapshot_path)
+        open(self._journal_path, "w").close()
+        self._snapshot_version = self._file_version(self._snapshot_path)
+        self._offset = 0
+        self._records_since_snapshot = 0
+
+    def compact(self):
+        with self._lock.write():
+            self._catch_up()
+            self._compact()
+
+    def history(self, days: int = 30):
+        """
+        Shelf history for the last `days` days, from the rollups:
+            intake    - {day: {shelf: devices placed}}
+            dwell     - {shelf: {"removed", "average_hours", "longest_hours"}} for devices picked up or cleaned up
+            overflow  - {"per_day": {day: placements}, "recent": [overflow events, newest last]}
+            occupied  - {shelf: {"devices", "oldest_hours"}} for devices still on a shelf
+        """
+        self.catch_up()
+        with self._lock.read():
+            cutoff = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+            intake = {day: dict(counts) for day, counts in sorted(self.rollups["intake"].items()) if day >= cutoff}
+
+            dwell = {}
+            for day, by_shelf in self.rollups["dwell"].items():
+                if day < cutoff:
+                    continue
+                for shelf, (count, total, longest) in by_shelf.items():
+                    totals = dwell.setdefault(shelf, [0, 0.0, 0.0])
+                    totals[0] += count
+                    totals[1] += total
+                    totals[2] = max(totals[2], longest)
+
+            now = time.time()
+            occupied = {}
+            for key, placed_at in self.rollups["placed"].items():
+                shelf = key.split("|", 1)[0]
+                current = occupied.setdefault(shelf, {"devices": 0, "oldest_hours": 0.0})
+                current["devices"] += 1
+                current["oldest_hours"] = max(current["oldest_hours"], round((now - placed_at) / 3600, 1))
+
+            cutoff_ts = time.mktime(datetime.strptime(cutoff, "%Y-%m-%d").timetuple())
+            return {
+                "days": days,
+                "intake": intake,
+                "dwell": {
+                    shelf: {"removed": count, "average_hours": round(total / count / 3600, 1), "longest_hours": round(longest / 3600, 1)}
+                    for shelf, (count, total, longest) in dwell.items() if count
+                },
+                "overflow": {
+                    "per_day": {day: count for day, count in sorted(self.rollups["overflow"].items()) if day >= cutoff},
+                    "recent": [event for event in self.rollups["overflow_events"] if event["ts"] >= cutoff_ts],
+                },
+                "occupied": occupied,
+            }
+
+def shelf_event(op: str, slot_number: int, occupant: Occupant, **details):
+    """An event for ShelfJournal.record, stamped now."""
+    return {"op": op, "ts": time.time(), "slot": slot_number, "device": occupant.device, "ticket": occupant.ticket, **details}
+
+shelf_journal = ShelfJournal(
+    journal_config.get("directory", "ShelfJSON/journal"),
+    compact_every=journal_config.get("compact_every", 1000),
+    history_days=journal_config.get("history_days", 90),
+    overflow_events_kept=journal_config.get("overflow_events_kept", 200),
+) if journal_config.get("enabled", False) else None
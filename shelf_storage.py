@@ -0,0 +1,423 @@
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from contextlib import contextmanager, ExitStack
+
+import yaml
+
+from lock_helper import lock_manager, ShelfLock
+from slot_model import Occupant, new_slots, decode_slots, encode_slots
+from shelf_journal import ShelfJournal, shelf_journal
+
+with open("config.yaml", "r") as f:
+    config = yaml.safe_load(f)
+
+shelf_state_config = config.get("shelf_state", {})
+
+class JsonShelfStorage:
+    """
+    One JSON file per shelf under ShelfJSON/, guarded by a lock_helper lock per file: reads share it, writes hold
+    it exclusively (plus the file's FileLock, for other worker processes). Files are written in the canonical
+    slot_model format and legacy files are read transparently. Every write rewrites the whole file; the version
+    is the file's (mtime_ns, size).
+    """
+
+    REPLACE_RETRY_SECONDS = 2 # Windows refuses to replace a file another process has open for reading
+
+    def __init__(self, directory: str = "ShelfJSON"):
+        self.directory = directory
+
+    def _path(self, name):
+        return f"{self.directory}/{name}"
+
+    def _lock_for(self, name) -> ShelfLock:
+        return lock_manager.get(f"file:{name}", self._path(name) + ".lock")
+
+    def version(self, name):
+        try:
+            stat = os.stat(self._path(name))
+            return (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def read(self, name, number_of_slots):
+        """Returns (version, slots), or (None, None) when the shelf has no stored state. number_of_slots=None skips the size check."""
+        with self._lock_for(name).read(): # Raises LockTimeout if a writer holds the file too long
+            if not os.path.exists(self._path(name)):
+                return None, None
+            with open(self._path(name), 'r') as file:
+                version = self.version(name)
+                slots = json.load(file)
+        if number_of_slots is not None and len(slots) != number_of_slots:
+            raise ValueError("Slot count mismatch")
+        return version, decode_slots(slots)
+
+    def write(self, name, slots, changed: set[int] = None):
+        """Persist slots (changed is ignored, the whole file is rewritten). Returns the new version."""
+        with self._lock_for(name).write(): # Raises LockTimeout if the file stays locked
+            temp_file_path = self._path(name) + '.tmp'
+            with open(temp_file_path, 'w') as file:
+                json.dump(encode_slots(slots), file, separators=(",", ":"))
+            deadline = time.monotonic() + self.REPLACE_RETRY_SECONDS
+            while True:
+                try:
+                    os.replace(temp_file_path, self._path(name))
+                    break
+                except PermissionError:
+                    if time.monotonic() >= deadline:
+                        raise
+                    time.sleep(0.05)
+            return self.version(name)
+
+    @contextmanager
+    def transaction(self, names):
+        """Hold every named file's lock (in name order, so transactions can't deadlock) until the block ends."""
+        with ExitStack() as stack:
+            for name in sorted(set(names)):
+                stack.enter_context(self._lock_for(name).write())
+            yield
+
+class SqliteShelfStorage:
+    """
+    All shelves in one SQLite database (WAL mode): one row per occupant, indexed by ticket and by lowercased device,
+    and a version per shelf that every write bumps. Saving a shelf only rewrites the rows of the slots that changed.
+
+    Worker processes serialize writes on the database lock (waiting up to busy_timeout) instead of sleeping on
+    file locks, and transaction() makes changes to several shelves commit or roll back together.
+    A shelf that isn't in the database yet is imported from `legacy` (the JSON files) the first time it is read.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS shelves (
+            name TEXT PRIMARY KEY,
+            number_of_slots INTEGER NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS occupants (
+            shelf TEXT NOT NULL,
+            slot INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            device TEXT,
+            device_key TEXT,
+            ticket TEXT,
+            PRIMARY KEY (shelf, slot, position)
+        );
+        CREATE INDEX IF NOT EXISTS occupants_ticket ON occupants (ticket);
+        CREATE INDEX IF NOT EXISTS occupants_device ON occupants (device_key);
+    """
+
+    def __init__(self, path: str = "ShelfJSON/shelves.db", busy_timeout: float = 30, legacy: JsonShelfStorage = None):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.legacy = legacy
+        self._local = threading.local() # sqlite3 connections can't be shared between threads
+        self._connection().executescript(self.SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None) # transactions are explicit
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self, names=None):
+        """BEGIN IMMEDIATE (take the write lock up front); nested blocks join the outer transaction."""
+        conn = self._connection()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def version(self, name):
+        row = self._connection().execute("SELECT version FROM shelves WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _rows(name, slot_index, occupants: list[Occupant]):
+        for position, occupant in enumerate(occupants):
+            yield (name, slot_index, position, occupant.device, occupant.key, occupant.ticket)
+
+    def read(self, name, number_of_slots):
+        """Returns (version, slots), or (None, None) when the shelf has no stored state."""
+        conn = self._connection()
+        row = conn.execute("SELECT number_of_slots, version FROM shelves WHERE name = ?", (name,)).fetchone()
+        if row is None and self.legacy is not None and migrate_json_to_sqlite([name], self.legacy, self):
+            row = conn.execute("SELECT number_of_slots, version FROM shelves WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None, None
+        if row[0] != number_of_slots:
+            raise ValueError("Slot count mismatch")
+
+        slots = new_slots(number_of_slots)
+        query = "SELECT slot, device, ticket FROM occupants WHERE shelf = ? ORDER BY slot, position"
+        for slot_index, device, ticket in conn.execute(query, (name,)):
+            slots[slot_index].append(Occupant(device, ticket))
+        return row[1], slots
+
+    def write(self, name, slots, changed: set[int] = None):
+        """Persist the rows of the changed slot indices (every slot when changed is None). Returns the new version."""
+        with self.transaction() as conn:
+            exists = conn.execute("SELECT 1 FROM shelves WHERE name = ?", (name,)).fetchone() is not None
+            if changed is None or not exists:
+                changed = range(len(slots))
+                conn.execute("DELETE FROM occupants WHERE shelf = ?", (name,))
+                conn.execute("INSERT OR REPLACE INTO shelves (name, number_of_slots, version) VALUES (?, ?, COALESCE((SELECT version FROM shelves WHERE name = ?), 0))", (name, len(slots), name))
+            else:
+                conn.executemany("DELETE FROM occupants WHERE shelf = ? AND slot = ?", [(name, slot_index) for slot_index in changed])
+            conn.executemany(
+                "INSERT INTO occupants (shelf, slot, position, device, device_key, ticket) VALUES (?, ?, ?, ?, ?, ?)",
+                [row for slot_index in changed for row in self._rows(name, slot_index, slots[slot_index])],
+            )
+            conn.execute("UPDATE shelves SET version = version + 1 WHERE name = ?", (name,))
+            return conn.execute("SELECT version FROM shelves WHERE name = ?", (name,)).fetchone()[0]
+
+class JournalShelfStorage:
+    """
+    Shelf state kept in the ShelfJournal itself: a save appends the changed slots to the journal, and a shelf's
+    version is the seq of its last record. Startup loads the journal snapshot and replays the tail, instead of
+    reading each shelf's file; shelves the journal hasn't seen yet are imported from `legacy` on first read.
+    """
+
+    def __init__(self, journal: ShelfJournal, legacy: JsonShelfStorage = None):
+        self.journal = journal
+        self.legacy = legacy
+
+    def version(self, name):
+        self.journal.catch_up()
+        return self.journal.state_seq.get(name)
+
+    def read(self, name, number_of_slots):
+        """Returns (version, slots), or (None, None) when the shelf has no stored state."""
+        with self.transaction([name]):
+            self.journal.catch_up()
+            if name not in self.journal.state and self.legacy is not None:
+                _, legacy_slots = self.legacy.read(name, None)
+                if legacy_slots is not None:
+                    self.journal.record_slots(name, legacy_slots)
+                    print(f"Imported {name} ({len(legacy_slots)} slots) into the shelf journal")
+            slots = self.journal.state.get(name)
+            if slots is None:
+                return None, None
+            if len(slots) != number_of_slots:
+                raise ValueError("Slot count mismatch")
+            return self.journal.state_seq[name], [list(occupants) for occupants in slots]
+
+    def write(self, name, slots, changed: set[int] = None):
+        """Append the changed slot indices (every slot when changed is None). Returns the new version."""
+        return self.journal.record_slots(name, slots, changed)
+
+    @contextmanager
+    def transaction(self, names=None):
+        """Hold the journal's lock, so no other thread or process appends until the block ends."""
+        with self.journal._lock.write():
+            yield
+
+class SharedMemoryShelfStorage:
+    """
+    Every shelf's slots published in one memory-mapped file that all worker processes map, in front of a durable
+    backend (`inner`). Layout: seq (u64), payload length (u32), padding to 16 bytes, then a JSON payload
+    {shelf: {"version", "source", "slots"}}.
+
+    The header is a seqlock: a writer (holding the region's exclusive lock) makes seq odd, writes the payload and
+    makes seq even again, so readers copy the payload without any lock and retry if seq was odd or moved meanwhile.
+    Readers parse the payload only when seq changed since they last looked, so a version check is one header read.
+    A shelf's version is the seq that published it. Saves go to `inner` first and are then published; saves inside
+    transaction() are published together when it commits, and not at all if it rolls back.
+    """
+
+    HEADER = struct.Struct("<QI")
+    SEQ = struct.Struct("<Q")
+    LENGTH = struct.Struct("<I")
+    HEADER_SIZE = 16
+    STUCK_SECONDS = 1 # seq odd for this long means a writer died mid-publish
+
+    def __init__(self, inner, path: str = "ShelfJSON/shelves.shm", size_bytes: int = 8 * 1024 * 1024):
+        self.inner = inner
+        self.path = path
+        self._lock = lock_manager.get(f"shm:{path}", path + ".lock")
+        with self._lock.write():
+            open(path, "ab").close()
+            if os.path.getsize(path) < size_bytes:
+                with open(path, "r+b") as file:
+                    file.truncate(size_bytes) # new pages read as zeros: seq 0, empty payload
+        self._file = open(path, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self.capacity = len(self._map) - self.HEADER_SIZE
+        self._parsed = (None, {}) # (seq, state) of the last payload this process parsed
+        self._verified: set[str] = set() # shelves whose published copy was checked against inner once
+        self._local = threading.local() # saves staged by the transaction running on this thread
+
+    def _seq(self):
+        return self.SEQ.unpack_from(self._map, 0)[0]
+
+    def _snapshot(self):
+        """The published state, parsed at most once per seq."""
+        started = time.monotonic()
+        while True:
+            seq, length = self.HEADER.unpack_from(self._map, 0)
+            parsed_seq, state = self._parsed
+            if seq == parsed_seq:
+                return state
+            if seq % 2 == 0:
+                payload = self._map[self.HEADER_SIZE:self.HEADER_SIZE + length]
+                if self._seq() == seq: # nothing was published while we copied
+                    state = json.loads(payload) if length else {}
+                    self._parsed = (seq, state)
+                    return state
+            if time.monotonic() - started > self.STUCK_SECONDS:
+                self._repair(seq)
+                started = time.monotonic()
+            time.sleep(0)
+
+    def _repair(self, stuck_seq):
+        """Clear a region a writer left mid-publish, so shelves are imported from inner again."""
+        with self._lock.write():
+            if self._seq() == stuck_seq and stuck_seq % 2:
+                print(f"Warning: {self.path} was left mid-write, clearing it")
+                self.LENGTH.pack_into(self._map, 8, 0)
+                self.SEQ.pack_into(self._map, 0, stuck_seq + 1)
+
+    def _payload(self, updates: dict):
+        state = dict(self._snapshot())
+        state.update(updates)
+        payload = json.dumps(state, separators=(",", ":")).encode()
+        if len(payload) > self.capacity:
+            raise ValueError(f"Shelf state ({len(payload)} bytes) doesn't fit in {self.path}, raise shelf_state.shared_memory_size_bytes")
+        return payload
+
+    def _publish(self, updates: dict):
+        """Publish the current state with `updates` merged in; caller holds the write lock. Returns the new version."""
+        seq = self._seq()
+        for entry in updates.values():
+            entry["version"] = seq + 2
+        payload = self._payload(updates)
+        self.SEQ.pack_into(self._map, 0, seq + 1) # odd: readers retry until the payload is complete
+        self.LENGTH.pack_into(self._map, 8, len(payload))
+        self._map[self.HEADER_SIZE:self.HEADER_SIZE + len(payload)] = payload
+        self.SEQ.pack_into(self._map, 0, seq + 2)
+        return seq + 2
+
+    @staticmethod
+    def _plain(version):
+        return json.loads(json.dumps(version)) # inner versions as they read back from the payload (tuples become lists)
+
+    def version(self, name):
+        entry = self._snapshot().get(name)
+        return entry["version"] if entry else None
+
+    def read(self, name, number_of_slots):
+        """Returns (version, slots) from shared memory, importing the shelf from inner if it isn't published yet."""
+        entry = self._snapshot().get(name)
+        if entry is not None and name not in self._verified:
+            self._verified.add(name)
+            if self._plain(self.inner.version(name)) != entry["source"]: # changed while shared memory was off
+                entry = None
+        if entry is None:
+            return self._import(name, number_of_slots)
+        if len(entry["slots"]) != number_of_slots:
+            raise ValueError("Slot count mismatch")
+        return entry["version"], decode_slots(entry["slots"])
+
+    def _import(self, name, number_of_slots):
+        with self._lock.write():
+            source, slots = self.inner.read(name, number_of_slots)
+            if slots is None:
+                return None, None
+            return self._publish({name: {"source": self._plain(source), "slots": encode_slots(slots)}}), slots
+
+    def write(self, name, slots, changed: set[int] = None):
+        """Save to inner, then publish (or stage until the transaction commits). Returns the new version."""
+        with self._lock.write():
+            staged = getattr(self._local, "staged", None)
+            entry = {"version": self._seq() + 2, "source": None, "slots": encode_slots(slots)}
+            self._payload({**(staged or {}), name: entry}) # refuse before inner is written if it can't be published
+            entry["source"] = self._plain(self.inner.write(name, slots, changed))
+            if staged is not None:
+                staged[name] = entry
+                return entry["version"] # the seq the commit will publish
+            return self._publish({name: entry})
+
+    @contextmanager
+    def transaction(self, names):
+        """Hold the region's write lock and inner's transaction; the block's saves are published together after inner commits."""
+        if getattr(self._local, "staged", None) is not None: # nested: join the outer transaction
+            with self.inner.transaction(names):
+                yield
+            return
+        with self._lock.write():
+            self._local.staged = {}
+            try:
+                with self.inner.transaction(names):
+                    yield
+                staged = self._local.staged
+            finally:
+                self._local.staged = None
+            if staged:
+                self._publish(staged)
+
+def migrate_json_to_sqlite(names, source: JsonShelfStorage, target: SqliteShelfStorage, overwrite: bool = False):
+    """
+    Copy shelves from the JSON files into SQLite. Shelves already in the database are left alone unless overwrite
+    is set, so running it again is harmless. Returns the names that were imported.
+    """
+    imported = []
+    for name in names:
+        try:
+            _, slots = source.read(name, None)
+        except ValueError: # unreadable file, nothing to import
+            continue
+        if slots is None:
+            continue
+        with target.transaction() as conn:
+            if not overwrite and conn.execute("SELECT 1 FROM shelves WHERE name = ?", (name,)).fetchone():
+                continue
+            target.write(name, slots)
+        imported.append(name)
+        print(f"Imported {name} ({len(slots)} slots) into {target.path}")
+    return imported
+
+def build_durable_storage(state_config: dict):
+    json_storage = JsonShelfStorage(state_config.get("json_directory", "ShelfJSON"))
+    if state_config.get("backend", "json") == "journal":
+        if shelf_journal is None:
+            raise ValueError("shelf_state.backend journal needs shelf_journal.enabled")
+        return JournalShelfStorage(shelf_journal, legacy=json_storage)
+    if state_config.get("backend", "json") == "sqlite":
+        return SqliteShelfStorage(
+            state_config.get("sqlite_path", "ShelfJSON/shelves.db"),
+            busy_timeout=state_config.get("sqlite_busy_timeout_seconds", 30),
+            legacy=json_storage,
+        )
+    return json_storage
+
+def build_shelf_storage(state_config: dict):
+    storage = build_durable_storage(state_config)
+    if state_config.get("shared_memory", False):
+        return SharedMemoryShelfStorage(
+            storage,
+            state_config.get("shared_memory_path", "ShelfJSON/shelves.shm"),
+            size_bytes=state_config.get("shared_memory_size_bytes", 8 * 1024 * 1024),
+        )
+    return storage
+
+shelf_storage = build_shelf_storage(shelf_state_config)
+
+if __name__ == "__main__": # One-shot migration: python shelf_storage.py
+    json_storage = JsonShelfStorage(shelf_state_config.get("json_directory", "ShelfJSON"))
+    durable_storage = getattr(shelf_storage, "inner", shelf_storage)
+    sqlite_storage = durable_storage if isinstance(durable_storage, SqliteShelfStorage) else SqliteShelfStorage(shelf_state_config.get("sqlite_path", "ShelfJSON/shelves.db"))
+    imported = migrate_json_to_sqlite(config["shelf_objects"].keys(), json_storage, sqlite_storage)
+    print(f"Migrated {len(imported)} shelf file(s) to {sqlite_storage.path}")
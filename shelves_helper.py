@@ -1,171 +1,418 @@
 from __future__ import annotations
 
-import json
-from collections.abc import Sequence
+import atexit
+import functools
+import heapq
+import threading
 import time
-from filelock import FileLock, Timeout
-import os
+from contextlib import contextmanager, asynccontextmanager, ExitStack, AsyncExitStack
 import yaml
 
+from lock_helper import lock_manager
+from shelf_storage import shelf_storage
+from slot_model import Occupant, new_slots, over_capacity
+from shelf_classifier import ShelfClassifier
+from shelf_journal import shelf_journal, shelf_event
+
 with open("config.yaml", "r") as f:
     config = yaml.safe_load(f)
 
+shelf_state_config = config.get("shelf_state", {})
+IN_MEMORY_MODE = shelf_state_config.get("mode", "file") == "memory"
+
 shelves: dict[str, Shelf] = {}
 
+_transaction_state = threading.local() # shelves touched by the shelf_transaction running on this thread
+
+def _locked(method):
+    """Run a Shelf method under the shelf's exclusive lock so a load-modify-save cycle is atomic within the process."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.write():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def _shared(method):
+    """Run a read-only Shelf method under the shelf's shared lock (after reloading it, exclusively, if it changed)."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._refresh()
+        with self._lock.read():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class WriteBehindPersister:
+    """
+    Coalesces shelf writes for in-memory mode. A mutated shelf is marked dirty and flushed to shelf_storage later,
+    so any number of mutations between flushes cost one write. Durability is configurable:
+        immediate - write-through on every save (memory is only a read cache)
+        interval  - flush every flush_interval_seconds (a crash loses at most that much)
+        shutdown  - flush only on shutdown or an explicit flush()
+    """
+
+    def __init__(self, flush_interval: float = 2.0, durability: str = "interval"):
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self._pending: dict[str, Shelf] = {}
+        self._lock = threading.Lock()
+        self._thread: threading.Thread = None
+
+    def schedule(self, shelf: Shelf):
+        if self.durability == "immediate":
+            shelf.flush()
+            return
+        with self._lock:
+            self._pending[shelf.file_name] = shelf
+            if self.durability == "interval" and (self._thread is None or not self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._run, name="shelf-write-behind", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for shelf in pending.values():
+            try:
+                shelf.flush()
+            except Exception as e:
+                print(f"Error flushing {shelf.file_name}: {e}")
+                with self._lock:
+                    self._pending.setdefault(shelf.file_name, shelf) # retry on the next flush
+
+shelf_persister = WriteBehindPersister(
+    flush_interval=shelf_state_config.get("flush_interval_seconds", 2),
+    durability=shelf_state_config.get("durability", "interval"),
+)
+atexit.register(shelf_persister.flush)
+
 class Shelf:
+    """
+    A physical shelf. slots holds one list of Occupant records per slot (an empty list is a free slot); a slot can
+    hold more than number_of_devices_per_slot devices only through override placements.
+    """
+
     def __init__(self, slotsNumber, file_name, slot_start, device_name, number_of_devices_per_slot):
         self.number_of_slots = slotsNumber
         self.file_name = file_name
-        self.slots = [None] * (self.number_of_slots)
+        self.slots: list[list[Occupant]] = new_slots(self.number_of_slots)
         self.slot_start = slot_start
         self.device_name = device_name
         self.number_of_devices_per_slot = number_of_devices_per_slot
+        self._lock = lock_manager.get(f"shelf:{file_name}") # readers-writer lock with bounded waits and metrics
+        self._loaded = False # in-memory mode: slots hold the authoritative state once loaded
+        self._dirty = False # in-memory mode: slots changed since the last write to disk
+        self._disk_version = None # shelf_storage version as this process last read or wrote it
+        self._unsaved: set[int] = set() # slot indices changed since the last write, so storage can write just those
+        self._base: list[list[Occupant]] = new_slots(self.number_of_slots) # slots as last read from or written to storage
+        self._events: list[dict] = [] # assign/remove events not yet written to shelf_journal
+        self._rebuildIndex()
+
+    def _rebuildIndex(self):
+        """
+        Rebuild the free-capacity index from self.slots (after a load). _free_heap is a min-heap of slot indices that
+        may still have room; entries for slots that filled up since they were pushed are dropped lazily by _nextFreeIndex.
+        """
+        self._free_heap = [i for i, occupants in enumerate(self.slots) if len(occupants) < self.number_of_devices_per_slot]
+        heapq.heapify(self._free_heap)
+        self._in_heap = [len(occupants) < self.number_of_devices_per_slot for occupants in self.slots]
+
+        # Reverse index: ticket number / lowercased device name -> {(slot_index, position)}
+        self._by_ticket: dict[str, set[tuple[int, int]]] = {}
+        self._by_device: dict[str, set[tuple[int, int]]] = {}
+        self._slot_keys: list[list[tuple[str, str]]] = [[] for _ in self.slots] # what each slot contributed to the maps
+        for i in range(len(self.slots)):
+            self._indexSlot(i)
+
+    def _indexSlot(self, slot_index):
+        """Replace slot_index's entries in the ticket/device reverse index with its current contents."""
+        for ticket, device in self._slot_keys[slot_index]:
+            for index, key in ((self._by_ticket, ticket), (self._by_device, device)):
+                locations = index.get(key) if key else None
+                if locations: # a key repeated within the slot was already cleared by its first occurrence
+                    locations.difference_update({location for location in locations if location[0] == slot_index})
+                    if not locations:
+                        del index[key]
+
+        keys = []
+        for position, occupant in enumerate(self.slots[slot_index]):
+            ticket = str(occupant.ticket) if occupant.ticket else None
+            device = occupant.key
+            if ticket:
+                self._by_ticket.setdefault(ticket, set()).add((slot_index, position))
+            if device:
+                self._by_device.setdefault(device, set()).add((slot_index, position))
+            keys.append((ticket, device))
+        self._slot_keys[slot_index] = keys
+
+    def _slotChanged(self, slot_index):
+        """Update the free-capacity and reverse indexes after self.slots[slot_index] was modified."""
+        if len(self.slots[slot_index]) < self.number_of_devices_per_slot and not self._in_heap[slot_index]:
+            heapq.heappush(self._free_heap, slot_index)
+            self._in_heap[slot_index] = True
+        self._indexSlot(slot_index)
+        self._unsaved.add(slot_index)
+
+    @_shared
+    def findTicket(self, ticket_number):
+        """Sorted (slot number, position) pairs holding devices for ticket_number."""
+        return sorted((i + self.slot_start, position) for i, position in self._by_ticket.get(str(ticket_number), ()))
+
+    @_shared
+    def findDevice(self, device):
+        """Sorted (slot number, position) pairs holding device (case-insensitive)."""
+        return sorted((i + self.slot_start, position) for i, position in self._by_device.get(str(device).lower(), ()))
+
+    @_shared
+    def indexedTickets(self):
+        """Every ticket number with a device on this shelf."""
+        return set(self._by_ticket)
+
+    def _nextFreeIndex(self):
+        while self._free_heap and len(self.slots[self._free_heap[0]]) >= self.number_of_devices_per_slot:
+            self._in_heap[heapq.heappop(self._free_heap)] = False
+        return self._free_heap[0] if self._free_heap else None
+
+    @_locked
+    def nextFreeSlot(self):
+        """Slot number (not index) assignDevice would use next, or None when the shelf is full."""
+        if self.number_of_devices_per_slot <= 0: return None
+        self.loadSlots()
+        slot_index = self._nextFreeIndex() # drops stale heap entries, so this needs the exclusive lock
+        return None if slot_index is None else slot_index + self.slot_start
+
+    def _readSlots(self):
+        try:
+            version, slots = shelf_storage.read(self.file_name, self.number_of_slots)
+        except ValueError: # slot count mismatch or unreadable state
+            return new_slots(self.number_of_slots)
+        if slots is None:
+            return new_slots(self.number_of_slots)
+        self.slots = slots
+        self._base = [list(occupants) for occupants in slots]
+        self._rebuildIndex()
+        self._unsaved = set()
+        self._loaded = True
+        self._disk_version = version
+        return slots
+
+    def _writeSlots(self):
+        unsaved, self._unsaved = self._unsaved, set()
+        try:
+            self._disk_version = shelf_storage.write(self.file_name, self.slots, unsaved)
+        except Exception:
+            self._unsaved |= unsaved
+            raise
+        for i in unsaved:
+            self._base[i] = list(self.slots[i])
+        events, self._events = self._events, []
+        if shelf_journal is not None:
+            shelf_journal.record(self.file_name, events)
+
+    def _refresh(self):
+        """Reload under the exclusive lock unless the in-memory slots are known to be current (for _shared methods)."""
+        if IN_MEMORY_MODE and self._loaded and shelf_storage.version(self.file_name) == self._disk_version:
+            return
+        with self._lock.write():
+            self.loadSlots()
 
     def loadSlots(self):
-        while True:
-            try:
-                with FileLock(f"ShelfJSON/{self.file_name}" + ".lock"): # Locks the JSON file 
-                    if os.path.exists(f"ShelfJSON/{self.file_name}"):
-                        with open(f"ShelfJSON/{self.file_name}", 'r') as file:
-                            slots = json.load(file)
-                            if len(slots) != self.number_of_slots:
-                                raise ValueError("Slot count mismatch")
-                            self.slots = slots
-                            return slots
-                break
-            except Timeout:
-                print("File is locked cannot load! Retrying in 5 seconds...")
-                time.sleep(5)  # Wait before retrying
-            except (FileNotFoundError, ValueError, json.JSONDecodeError):
-                return [None] * self.number_of_slots
+        """
+        File mode: re-read from shelf_storage. In-memory mode: the in-memory slots are the source of truth, and they
+        are only re-read if another process changed the shelf (its storage version no longer matches ours).
+        """
+        touched = getattr(_transaction_state, "shelves", None)
+        if touched is not None and self in touched: # loaded when the transaction began, and may hold unsaved changes
+            return self.slots
+        if not IN_MEMORY_MODE:
+            return self._readSlots()
+        with self._lock.write():
+            if self._loaded and shelf_storage.version(self.file_name) == self._disk_version:
+                return self.slots
+            if self._loaded and self._dirty:
+                self._mergeStored()
+                return self.slots
+            return self._readSlots()
+
+    def _mergeStored(self):
+        """
+        In-memory mode, when another process wrote the shelf while this one has unsaved changes: re-read storage and
+        re-apply only this process's changes per slot (the occupants it added or removed since _base), so the other
+        process's writes are kept instead of overwritten. An added device the other process already put in another
+        slot (per the stored reverse index) is dropped rather than shelved twice.
+        """
+        version, stored = shelf_storage.read(self.file_name, self.number_of_slots) # a failed read refuses the flush
+        stored = stored if stored is not None else new_slots(self.number_of_slots)
+        stored_at = {occupant.key: i for i, occupants in enumerate(stored) for occupant in occupants if occupant.key}
+        merged = [list(occupants) for occupants in stored]
+        dropped = []
+        for i in sorted(self._unsaved):
+            base, local = self._base[i], self.slots[i]
+            removed = [occupant for occupant in base if occupant not in local]
+            added = []
+            for occupant in local:
+                if occupant in base or occupant in stored[i]:
+                    continue
+                elsewhere = stored_at.get(occupant.key)
+                if elsewhere is not None and elsewhere != i and occupant not in self._base[elsewhere]:
+                    dropped.append((i, occupant))
+                    print(f"Warning: {occupant.device} was put in slot {elsewhere + self.slot_start} of {self.file_name} by another process; dropping this process's placement in slot {i + self.slot_start}")
+                    continue
+                added.append(occupant)
+            merged[i] = [occupant for occupant in stored[i] if occupant not in removed] + added
+            if stored[i] != base:
+                print(f"Warning: slot {i + self.slot_start} of {self.file_name} was also changed by another process; merged both changes")
+        for i in over_capacity(merged, self.number_of_devices_per_slot):
+            if len(stored[i]) <= self.number_of_devices_per_slot and len(self.slots[i]) <= self.number_of_devices_per_slot:
+                print(f"Warning: slot {i + self.slot_start} of {self.file_name} holds {len(merged[i])} device(s) after merging both processes' placements, max is {self.number_of_devices_per_slot}")
+        self._events = [event for event in self._events
+                        if not (event["op"] == "assign" and any(event["slot"] == i + self.slot_start and event["device"] == occupant.device for i, occupant in dropped))]
+        self.slots = merged
+        self._base = [list(occupants) for occupants in stored]
+        self._rebuildIndex()
+        self._unsaved = {i for i in self._unsaved if merged[i] != stored[i]}
+        self._disk_version = version
 
     def saveSlots(self):
-        while True:
-            try:
-                with FileLock(f"ShelfJSON/{self.file_name}" + ".lock"): # Locks the JSON file 
-                    temp_file_path = f"ShelfJSON/{self.file_name}" + '.tmp'
-                    with open(temp_file_path, 'w') as file:
-                        json.dump(self.slots, file)
-                    os.replace(temp_file_path, f"ShelfJSON/{self.file_name}")
-                break
-            except Timeout:
-                print("File is locked cannot save! Retrying in 5 seconds...")
-                time.sleep(5)  # Wait before retrying
-
-    def assignDeviceWithSlot(self, device, slot, ticket_number):
+        """
+        File mode: write to shelf_storage now. In-memory mode: mark dirty and let shelf_persister write it.
+        Inside a shelf_transaction the write is deferred to the end of the transaction.
+        """
+        touched = getattr(_transaction_state, "shelves", None)
+        if touched is not None and self in touched:
+            touched[self] = True
+            return
+        if not IN_MEMORY_MODE:
+            self._writeSlots()
+            return
+        with self._lock.write():
+            self._dirty = True
+        shelf_persister.schedule(self)
+
+    def flush(self):
+        """Write pending in-memory changes to disk, merged with any the other processes made since this one last read it."""
+        with self._lock.write():
+            if not self._dirty:
+                return
+            with shelf_storage.transaction([self.file_name]): # no other process can write between the check and the write
+                if shelf_storage.version(self.file_name) != self._disk_version:
+                    self._mergeStored()
+                self._writeSlots()
+            self._dirty = False
+
+    @_locked
+    def assignDeviceWithSlot(self, device, slot, ticket_number, overflow=False):
         if self.number_of_devices_per_slot <= 0: return -1
         self.loadSlots()
+        slot_index, status = self._placeWithSlot(device, slot, ticket_number, overflow)
+        if status == "assigned":
+            self.saveSlots()
+        return slot_index
+
+    @_locked
+    def assignDevicesWithSlots(self, placements: list[tuple[str, int, str]]):
+        """
+        Apply many (device, slot, ticket_number) placements with one load and at most one save.
+        Returns a (slot_index, status) pair per placement, status being "assigned", "present" or "invalid_slot".
+        """
+        if self.number_of_devices_per_slot <= 0: return [(-1, "invalid_slot")] * len(placements)
+        self.loadSlots()
+        results = [self._placeWithSlot(device, slot, ticket_number) for device, slot, ticket_number in placements]
+        if any(status == "assigned" for _, status in results):
+            self.saveSlots()
+        return results
+
+    def _placeWithSlot(self, device, slot, ticket_number, overflow=False):
+        """Put device into a specific slot in memory (no load/save). Returns (slot_index, status)."""
         slot = int(slot)
         
         # Check if slot is within valid range (must be >= slot_start and < slot_start + number_of_slots)
         if slot < self.slot_start:
             print(f"{device} {slot} Slot number is less than shelf start slot {self.slot_start}!")
-            return None
+            return None, "invalid_slot"
         
         slot_index = slot - self.slot_start
         if slot_index >= len(self.slots):
             print(f"{device} {slot} Slot number is larger than current slots available!")
-            return None
+            return None, "invalid_slot"
         
         # Validate slot_index is non-negative (should be caught above, but double-check)
         if slot_index < 0:
             print(f"{device} {slot} Invalid slot index calculated: {slot_index}")
-            return None
-        
-        # Store device with ticket number (new format only)
-        device_entry = {"device": device, "ticket": ticket_number}
+            return None, "invalid_slot"
         
         # Check if adding device would exceed max devices per slot (warning only, since this is an override)
-        if not self.slots[slot_index] == None:
-            current_count = len(self.slots[slot_index]) if isinstance(self.slots[slot_index], list) else 1
-            
-            # Extract device names for comparison
-            existing_devices = []
-            if isinstance(self.slots[slot_index], list):
-                for d in self.slots[slot_index]:
-                    existing_devices.append(d.get("device", "") if isinstance(d, dict) else "")
-            else:
-                existing_devices.append(self.slots[slot_index].get("device", "") if isinstance(self.slots[slot_index], dict) else "")
-            
-            if str(device).lower() in [str(d).lower() for d in existing_devices if d]:
+        occupants = self.slots[slot_index]
+        if occupants:
+            if any(i == slot_index for i, _ in self._by_device.get(str(device).lower(), ())):
                 print(f"Device '{device}' already present in slot {slot}; skipping.")
-                return slot_index
-
-            if current_count >= self.number_of_devices_per_slot and self.number_of_devices_per_slot > 0:
-                print(f"Warning: Slot {slot} already has {current_count} device(s), max is {self.number_of_devices_per_slot}. Adding anyway (override mode).")
-            
-            newDevices = []
-            if isinstance(self.slots[slot_index], list):
-                for slottedDevice in self.slots[slot_index]:
-                    newDevices.append(slottedDevice)
-            else:
-                newDevices.append(self.slots[slot_index])
-            newDevices.append(device_entry)
-            self.slots[slot_index] = newDevices
-        else:
-            self.slots[slot_index] = device_entry
-        
-        self.saveSlots()
+                return slot_index, "present"
+
+            if len(occupants) >= self.number_of_devices_per_slot and self.number_of_devices_per_slot > 0:
+                print(f"Warning: Slot {slot} already has {len(occupants)} device(s), max is {self.number_of_devices_per_slot}. Adding anyway (override mode).")
+        occupant = Occupant(device, ticket_number)
+        occupants.append(occupant)
+        self._slotChanged(slot_index)
+        self._events.append(shelf_event("assign", slot, occupant, overflow=overflow))
         print(f"Device '{device}' assigned to slot {slot} (override)")
-        return slot_index
+        return slot_index, "assigned"
+
+    @contextmanager
+    def _claimingSlot(self):
+        """
+        Hold a storage transaction while a free slot is picked and saved. Another process can't fill the slot between
+        the load and the write, and in-memory mode writes the claim through instead of leaving it to shelf_persister:
+        a merge would otherwise keep both processes' devices in the one slot. A shelf_transaction already holds one.
+        """
+        touched = getattr(_transaction_state, "shelves", None)
+        if touched is not None and self in touched:
+            yield
+            return
+        with shelf_storage.transaction([self.file_name]):
+            yield
+            if self._dirty:
+                self._writeSlots()
+                self._dirty = False
 
+    @_locked
     def assignDevice(self, device, ticket_number):
         if self.number_of_devices_per_slot <= 0: return -1
-        self.loadSlots()
-        
-        # Store device with ticket number (new format only)
-        device_entry = {"device": device, "ticket": ticket_number}
-        
-        if self.number_of_devices_per_slot > 1:
-            for i in range(0, len(self.slots)):
-                if self.slots[i] == None:
-                    self.slots[i] = device_entry
-                    self.saveSlots()
-                    print(f"Device '{device}' assigned to slot {i + self.slot_start}")
-                    return i
-                else:
-                    # Slot is not empty - check if it can accommodate more devices
-                    if isinstance(self.slots[i], list):
-                        # Slot is a list - check if it has room
-                        if len(self.slots[i]) < self.number_of_devices_per_slot:
-                            # Has room - add device to list
-                            self.slots[i].append(device_entry)
-                            self.saveSlots()
-                            print(f"Device '{device}' assigned to slot {i + self.slot_start}")
-                            return i
-                        else:
-                            # Slot is full - continue to next slot
-                            continue
-                    else:
-                        # Slot has a single device - convert to list and add device
-                        newDevices = [self.slots[i], device_entry]
-                        self.slots[i] = newDevices
-                        self.saveSlots()
-                        print(f"Device '{device}' assigned to slot {i + self.slot_start}")
-                        return i    
-        else:
-            for i in range(0, len(self.slots)):
-                if self.slots[i] == None:
-                    self.slots[i] = device_entry
-                    self.saveSlots()
-                    print(f"Device '{device}' assigned to slot {i + self.slot_start}")
-                    return i
-                
-        print(f"No empty slots available\n{self.file_name}")
-        return None
+        with self._claimingSlot():
+            self.loadSlots() # in-memory mode: catches up with (and merges into) the stored version first
+
+            # Lowest slot with room, from the free-capacity index instead of scanning every slot
+            i = self._nextFreeIndex()
+            if i is None:
+                print(f"No empty slots available\n{self.file_name}")
+                return None
 
+            occupant = Occupant(device, ticket_number)
+            self.slots[i].append(occupant)
+            self._slotChanged(i)
+            self._events.append(shelf_event("assign", i + self.slot_start, occupant, overflow=False))
+            self.saveSlots()
+        print(f"Device '{device}' assigned to slot {i + self.slot_start}")
+        return i
+
+    @_locked
     def removeDevice(self, slot):
         if self.number_of_devices_per_slot <= 0: return -1
         self.loadSlots()
-        if 0 <= slot < len(self.slots) and not self.slots[slot] == None:
-            device = self.slots[slot]                
-            self.slots[slot] = None
+        if 0 <= slot < len(self.slots) and self.slots[slot]:
+            removed = self.slots[slot]
+            self.slots[slot] = []
+            self._slotChanged(slot)
+            self._events.extend(shelf_event("remove", slot + self.slot_start, occupant, reason="manual") for occupant in removed)
             self.saveSlots()
-            print(f"Device '{device}' removed from slot {slot}")
-            return device
+            print(f"Device '{', '.join(occupant.device for occupant in removed)}' removed from slot {slot}")
+            return removed
         print("Invalid slot or slot already empty")
         return None
     
+    @_locked
     def removeDevicesFromClosedTickets(self, active_ticket_numbers: set):
         """
         Remove devices from shelves that are associated with closed tickets.
@@ -173,47 +420,24 @@ class Shelf:
         """
         self.loadSlots()
         removed_count = 0
-        modified = False
-        
-        for slot_index, slot_content in enumerate(self.slots):
-            if slot_content is None:
-                continue
-            
-            # Handle single device
-            if not isinstance(slot_content, list):
-                if isinstance(slot_content, dict):
-                    ticket = slot_content.get("ticket")
-                    if ticket and ticket not in active_ticket_numbers:
-                        device_name = slot_content.get("device", "")
-                        self.slots[slot_index] = None
-                        modified = True
-                        removed_count += 1
-                        print(f"Removed device '{device_name}' from slot {slot_index + self.slot_start} (ticket {ticket} is closed)")
-                continue
-            
-            # Handle list of devices
-            preserved_devices = []
-            for device_entry in slot_content:
-                if isinstance(device_entry, dict):
-                    ticket = device_entry.get("ticket")
-                    if ticket and ticket not in active_ticket_numbers:
-                        device_name = device_entry.get("device", "")
-                        removed_count += 1
-                        print(f"Removed device '{device_name}' from slot {slot_index + self.slot_start} (ticket {ticket} is closed)")
-                        continue
-                preserved_devices.append(device_entry)
-            
-            # Update slot if devices were removed
-            if len(preserved_devices) != len(slot_content):
-                if len(preserved_devices) == 0:
-                    self.slots[slot_index] = None
-                elif len(preserved_devices) == 1:
-                    self.slots[slot_index] = preserved_devices[0]
-                else:
-                    self.slots[slot_index] = preserved_devices
-                modified = True
-        
-        if modified:
+
+        # Only slots holding an indexed ticket that is no longer active need to be visited
+        closed_tickets = self._by_ticket.keys() - active_ticket_numbers
+        affected_slots = sorted({i for ticket in closed_tickets for i, _ in self._by_ticket[ticket]})
+
+        for slot_index in affected_slots:
+            preserved = []
+            for occupant in self.slots[slot_index]:
+                if occupant.ticket and str(occupant.ticket) in closed_tickets:
+                    removed_count += 1
+                    print(f"Removed device '{occupant.device}' from slot {slot_index + self.slot_start} (ticket {occupant.ticket} is closed)")
+                    self._events.append(shelf_event("remove", slot_index + self.slot_start, occupant, reason="closed"))
+                    continue
+                preserved.append(occupant)
+            self.slots[slot_index] = preserved
+            self._slotChanged(slot_index)
+
+        if affected_slots:
             self.saveSlots()
         
         if removed_count > 0:
@@ -221,60 +445,148 @@ class Shelf:
         
         return removed_count
 
+    @_shared
     def displaySlots(self):
         if self.number_of_devices_per_slot <= 0: return -1
-        self.loadSlots()
-        for i, device in enumerate(self.slots, 0):
-            if device == None:
-                status = "Empty"
-            elif isinstance(device, Sequence) and not isinstance(device, str):
-                first = True
-                status = ""
-                for slottedDevice in device:
-                    device_name = slottedDevice.get("device", "") if isinstance(slottedDevice, dict) else ""
-                    if first:
-                        first = False
-                        status = device_name
-                    else:
-                        status = status + f", {device_name}"
-            else:
-                status = device.get("device", "") if isinstance(device, dict) else ""
+        for i, occupants in enumerate(self.slots, 0):
+            status = ", ".join(occupant.device or "" for occupant in occupants) if occupants else "Empty"
             print(f"Slot {i + self.slot_start}: {status}")
 
 # Function that returns the shelf that a device should be assigned to
 # It can use either the device or slot_number to find which shelf it pertains to
 # The device doesn't necessarily have to be assigned or unassigned to the shelf to find its correct shelf assignment
 def get_shelf(device: list = None, slot_number: int = None):
-    shelf_assignment: str = None
     shelf: Shelf = None
     
-    # Device based assignment
+    # Device based assignment (last matching shelf_assignment entry wins, for example "zbook g11" goes to the z_book shelf)
+    # The name found isn't always a slotting shelf, for example the "mac" shelf, but we return it so that the user can then be emailed
     if device is not None:
-        for shelf_assignment_list in config["shelf_assignment"].values():
-            for device_asset_name in shelf_assignment_list[0]:
-                if str(device_asset_name).lower() in str(device[0]["asset"]).lower() or str(device_asset_name).lower() in str(device[0]["sys_class_name"]).lower():
-                    shelf_assignment = shelf_assignment_list[1] # We don't use "key" here because we have different shelf names we're finding, for example the "mac" shelf, which isn't a shelf but we return it so that the user can then be emailed
-                    # We don't break here because it may find another shelf that is more applicable to be assigned to (for example "zbook g11")
-                    
-    # Assign shelf by name if found
-    if shelf_assignment is not None:
-        shelf = shelves[shelf_assignment]
+        shelf_assignment = shelf_classifier.shelf_name_for(device[0]["asset"], device[0]["sys_class_name"])
+        if shelf_assignment is not None:
+            shelf = shelves[shelf_assignment]
 
     # Slot number based assignment
     if slot_number is not None:
-        for shelf_iter in shelves.values():
-            start = shelf_iter.slot_start
-            end = start + shelf_iter.number_of_slots - 1
-            if slot_number >= start and slot_number <= end:
-                shelf = shelf_iter
-                slot_number -= start # Converts the slot number to zero based index
-                break
+        shelf_name, slot_index = shelf_classifier.slot_owner(slot_number)
+        if shelf_name is not None:
+            shelf = shelves[shelf_name]
+            slot_number = slot_index # Converts the slot number to zero based index
 
     return shelf, slot_number
 
+def get_shelves(devices: list[list]):
+    """Batch form of get_shelf(device=...): the shelf (or None) for each device, classified in one call."""
+    names = shelf_classifier.classify([(device[0]["asset"], device[0]["sys_class_name"]) for device in devices])
+    return [shelves[name] if name is not None else None for name in names]
+
+def find_ticket(ticket_number):
+    """Every (shelf, slot number, position) holding a device for ticket_number, across all shelves."""
+    return [(shelf, slot, position) for shelf in shelves.values() for slot, position in shelf.findTicket(ticket_number)]
+
+def find_device(device):
+    """Every (shelf, slot number, position) holding device (case-insensitive), across all shelves."""
+    return [(shelf, slot, position) for shelf in shelves.values() for slot, position in shelf.findDevice(device)]
+
+def remove_closed_ticket_devices(active_ticket_numbers: set):
+    """Remove devices of tickets that are shelved but no longer active, on every shelf. Returns the number removed."""
+    active_ticket_numbers = {str(ticket) for ticket in active_ticket_numbers}
+    total_removed = 0
+    for shelf in shelves.values():
+        if shelf.indexedTickets() - active_ticket_numbers:
+            total_removed += shelf.removeDevicesFromClosedTickets(active_ticket_numbers)
+    return total_removed
+
+# How much a placement status says about a ticket, so a ticket placed twice (or also skipped) reports what happened
+PLACEMENT_STATUS_RANK = {"skipped": 0, "no_shelf": 1, "invalid_slot": 2, "present": 3, "assigned": 4}
+
+def report_placement(report: dict, ticket_number: str, entry: dict):
+    """Record entry for ticket_number in a placement report unless it already has a more significant status."""
+    current = report.get(ticket_number)
+    if current is None or PLACEMENT_STATUS_RANK[entry["status"]] > PLACEMENT_STATUS_RANK[current["status"]]:
+        report[ticket_number] = entry
+
+def apply_slot_placements(placements: list[tuple[str, str, int]]):
+    """
+    Batch form of assignDeviceWithSlot for a whole refresh: placements are (ticket_number, device, slot_number).
+    They are grouped by shelf and applied in one pass per shelf, so each shelf is loaded and saved at most once.
+    Returns {ticket_number: {"shelf": file_name or None, "slot": slot_number, "status": ...}}, where status is
+    "assigned", "present" (already in that slot), "invalid_slot" or "no_shelf"; a ticket with several placements
+    reports the most significant (see report_placement).
+    """
+    report = {}
+    by_shelf: dict[Shelf, list[tuple[str, str, int]]] = {}
+    for ticket_number, device, slot_number in placements:
+        shelf, _ = get_shelf(slot_number=int(slot_number))
+        if shelf is None:
+            report_placement(report, ticket_number, {"shelf": None, "slot": int(slot_number), "status": "no_shelf"})
+            continue
+        by_shelf.setdefault(shelf, []).append((ticket_number, device, int(slot_number)))
+
+    for shelf, shelf_placements in by_shelf.items():
+        results = shelf.assignDevicesWithSlots([(device, slot_number, ticket_number) for ticket_number, device, slot_number in shelf_placements])
+        for (ticket_number, _, slot_number), (_, status) in zip(shelf_placements, results):
+            report_placement(report, ticket_number, {"shelf": shelf.file_name, "slot": slot_number, "status": status})
+    return report
+
+@contextmanager
+def shelf_transaction(*transaction_shelves: Shelf):
+    """
+    Make changes to several shelves atomic, e.g. trying a device's own shelf and falling back to its overflow shelf.
+    Holds the shelves' locks and a storage transaction for the whole block; saves inside the block are written
+    together when it ends, and an exception rolls storage back and reloads the shelves. Nested calls join the outer one.
+    """
+    transaction_shelves = sorted({shelf for shelf in transaction_shelves if shelf is not None}, key=lambda shelf: shelf.file_name)
+    if getattr(_transaction_state, "shelves", None) is not None:
+        missing = [shelf for shelf in transaction_shelves if shelf not in _transaction_state.shelves]
+        if missing:
+            raise RuntimeError(f"Nested shelf_transaction can't add shelves: {[shelf.file_name for shelf in missing]}")
+        yield
+        return
+
+    with ExitStack() as stack:
+        for shelf in transaction_shelves: # always locked in name order
+            stack.enter_context(shelf._lock.write())
+            shelf.flush() # pending write-behind changes go out first, so a rollback can't lose them
+        try:
+            with shelf_storage.transaction([shelf.file_name for shelf in transaction_shelves]):
+                for shelf in transaction_shelves:
+                    shelf.loadSlots()
+                _transaction_state.shelves = {shelf: False for shelf in transaction_shelves} # shelf -> saved inside the block
+                yield
+                for shelf, saved in _transaction_state.shelves.items():
+                    if saved:
+                        shelf._writeSlots()
+                        shelf._dirty = False
+        except BaseException:
+            for shelf in transaction_shelves:
+                shelf._loaded = False # drop the half-applied in-memory changes
+                shelf._events = []
+                shelf._readSlots()
+            raise
+        finally:
+            _transaction_state.shelves = None
+
+@asynccontextmanager
+async def shelf_locks_async(*locked_shelves: Shelf):
+    """
+    Hold the shelves' exclusive locks from a coroutine without blocking the event loop. Shelf work passed to
+    asyncio.to_thread inside the block runs as the lock holder, so it re-enters the locks instead of waiting.
+    """
+    async with AsyncExitStack() as stack:
+        for shelf in sorted({shelf for shelf in locked_shelves if shelf is not None}, key=lambda shelf: shelf.file_name):
+            await stack.enter_async_context(shelf._lock.write_async())
+        yield
+
 if not shelves: # Clause so that importing into other scripts doesn't re-initialize shelf objects
     for key, value in config["shelf_objects"].items():
         shelf_object = Shelf(value[0], key, value[1], value[2], value[3])  # Create a shelf with given slots, file_name, slotting start number, # of slots per device
         shelves[key] = shelf_object # Store shelf in dictionary
 
+    # Keyword matching and slot ranges compiled once, instead of re-scanned on every lookup
+    shelf_classifier = ShelfClassifier(
+        config["shelf_assignment"],
+        config.get("overflow_rules", []),
+        {name: (shelf.slot_start, shelf.number_of_slots) for name, shelf in shelves.items()},
+    )
+
 #shelves["phone_shelf"].displaySlots()
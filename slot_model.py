@@ -0,0 +1,59 @@
+class Occupant:
+    """One device in a slot. ticket is None for legacy entries that only recorded the device name."""
+
+    __slots__ = ("device", "ticket", "key")
+
+    def __init__(self, device: str, ticket: str = None):
+        self.device = device
+        self.ticket = ticket
+        self.key = str(device).lower() if device else None # lowercased device name, for lookups and duplicate checks
+
+    def __eq__(self, other):
+        return isinstance(other, Occupant) and self.device == other.device and self.ticket == other.ticket
+
+    def __repr__(self):
+        return f"Occupant({self.device!r}, {self.ticket!r})"
+
+def new_slots(number_of_slots: int) -> list[list[Occupant]]:
+    """
+    Empty shelf state: one occupant list per slot (an empty list is a free slot). Slots are plain lists, not
+    fixed-capacity arrays, because override placements may exceed number_of_devices_per_slot; the capacity is
+    enforced where a slot is picked (Shelf.assignDevice) and stored slots are checked against it (over_capacity).
+    """
+    return [[] for _ in range(number_of_slots)]
+
+def decode_occupant(entry) -> Occupant:
+    if isinstance(entry, list): # canonical [device, ticket]
+        return Occupant(entry[0], entry[1] if len(entry) > 1 else None)
+    if isinstance(entry, dict): # legacy {"device": ..., "ticket": ...}
+        return Occupant(entry.get("device", ""), entry.get("ticket"))
+    return Occupant(entry) # bare device name (no ticket)
+
+def decode_slots(raw: list) -> list[list[Occupant]]:
+    """
+    Read stored slots in any format this app has written: the canonical list of occupants per slot, or the legacy
+    None / {"device", "ticket"} / device name / list-of-those per slot.
+    """
+    slots = []
+    for slot_content in raw:
+        if slot_content is None:
+            slots.append([])
+        elif isinstance(slot_content, list):
+            slots.append([decode_occupant(entry) for entry in slot_content if entry is not None])
+        else:
+            slots.append([decode_occupant(slot_content)])
+    return slots
+
+def over_capacity(slots: list[list[Occupant]], capacity: int):
+    """Indices of slots holding more than capacity occupants (only override placements should put them there)."""
+    return [i for i, occupants in enumerate(slots) if len(occupants) > capacity]
+
+def encode_occupant(occupant: Occupant):
+    return [occupant.device, occupant.ticket] if occupant.ticket else occupant.device
+
+def encode_slots(slots: list[list[Occupant]]) -> list:
+    """
+    Canonical format: a list per slot of [device, ticket] pairs (just the device name when there is no ticket),
+    e.g. [[], [["PC123", "SCTASK001"]], ["PC456"]].
+    """
+    return [[encode_occupant(occupant) for occupant in occupants] for occupants in slots]
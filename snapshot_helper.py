@@ -0,0 +1,235 @@
+import gzip
+import hashlib
+import json
+import secrets
+import threading
+import time
+from collections import deque
+
+import yaml
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError: # brotli is optional, gzip is always available
+    brotli = None
+
+with open("config.yaml", "r") as f:
+    config = yaml.safe_load(f)
+
+# Escapes that keep the JSON valid while making it safe to inline in a <script> tag (same set as Flask's tojson)
+_HTML_SAFE = str.maketrans({"<": "\\u003c", ">": "\\u003e", "&": "\\u0026", "'": "\\u0027"})
+
+class Snapshot:
+    """
+    Immutable, pre-serialized version of the dashboard data.
+
+    The payload is serialized once (HTML-safe, so the same text can be inlined into home.html), compressed once
+    per encoding, and identified by a strong ETag derived from its content. version is the publisher's
+    "<epoch>.<n>" token, which clients treat as opaque.
+    """
+
+    __slots__ = ("version", "digest", "etag", "body", "gzip_body", "brotli_body", "created_at")
+
+    def __init__(self, result_text: str, version: str, digest: str, field: str = "result"):
+        self.version = version
+        self.digest = digest
+        self.etag = f"{version}-{digest[:16]}" # unquoted, as werkzeug's ETags container expects
+        self.body = f'{{"{field}":{result_text},"version":{json.dumps(version)}}}'.encode("utf-8")
+        self.gzip_body = gzip.compress(self.body, compresslevel=6)
+        self.brotli_body = brotli.compress(self.body, quality=5) if brotli is not None else None
+        self.created_at = time.time()
+
+    def text(self):
+        return self.body.decode("utf-8")
+
+def serialize_rows(result: list):
+    """Serialize each row once (HTML-safe); joined they are the result's JSON, and alone they are diff entries."""
+    return [json.dumps(row, separators=(",", ":"), default=str).translate(_HTML_SAFE) for row in result]
+
+def row_key(row: dict):
+    """Identity of a ticket row across snapshots."""
+    return str(row.get("number") or row.get("sys_id") or "")
+
+class SnapshotDiff:
+    """
+    Tickets added, changed and removed between two snapshot versions, keyed by row_key, with rows kept serialized.
+    text is the JSON sent to clients: {"from", "version", "added", "changed", "removed"}.
+    """
+
+    __slots__ = ("from_version", "version", "added", "changed", "removed", "text")
+
+    def __init__(self, from_version: str, version: str, added: dict[str, str], changed: dict[str, str], removed: list[str]):
+        self.from_version = from_version
+        self.version = version
+        self.added = added
+        self.changed = changed
+        self.removed = removed
+        self.text = (
+            f'{{"from":{json.dumps(from_version)},"version":{json.dumps(version)},"added":[{",".join(added.values())}],'
+            f'"changed":[{",".join(changed.values())}],"removed":{json.dumps(removed)}}}'
+        )
+
+    @classmethod
+    def between(cls, from_version: str, version: str, previous_rows: dict[str, str], rows: dict[str, str]):
+        return cls(
+            from_version, version,
+            {key: text for key, text in rows.items() if key not in previous_rows},
+            {key: text for key, text in rows.items() if key in previous_rows and previous_rows[key] != text},
+            [key for key in previous_rows if key not in rows],
+        )
+
+    @classmethod
+    def combine(cls, diffs: list["SnapshotDiff"]):
+        """One diff equivalent to applying consecutive diffs in order."""
+        added: dict[str, str] = {}
+        changed: dict[str, str] = {}
+        removed: dict[str, None] = {} # ordered set
+        for diff in diffs:
+            for key in diff.removed:
+                if key in added: # added and removed within the range: the client never sees it
+                    del added[key]
+                else:
+                    changed.pop(key, None)
+                    removed[key] = None
+            for key, text in diff.added.items():
+                if key in removed: # removed and added back: the client still has the old row
+                    del removed[key]
+                    changed[key] = text
+                else:
+                    added[key] = text
+            for key, text in diff.changed.items():
+                if key in added:
+                    added[key] = text
+                else:
+                    changed[key] = text
+        return cls(diffs[0].from_version, diffs[-1].version, added, changed, list(removed))
+
+class SnapshotPublisher:
+    """
+    Holds the current Snapshot; publishing identical data keeps the current version (and ETag).
+    Each new version is diffed against the previous one by ticket, and subscribers get (snapshot, diff), in order.
+    The last `history` diffs are kept so a client can catch up from a recent version (changes_since); with no
+    history and no subscribers, diffs aren't computed. field names the list in the served body.
+    Publishing is serialized, so update() can patch the last published rows without racing a refresh's publish.
+
+    Versions are "<epoch>.<n>" tokens. The epoch is random per publisher, so a version from before a restart, or
+    from another worker process, never matches one of ours and the client gets the full snapshot instead.
+    """
+
+    def __init__(self, history: int = 200, field: str = "result"):
+        self.field = field
+        self.epoch = secrets.token_hex(6)
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._publish_lock = threading.RLock() # held across serializing and swapping in a version (and by update())
+        self._current: Snapshot = None
+        self._result: list = None # the rows last published
+        self._rows: dict[str, str] = {} # row_key -> serialized row of the current snapshot
+        self._history: deque[SnapshotDiff] = deque(maxlen=history)
+        self._subscribers = []
+
+    def subscribe(self, subscriber):
+        """Call subscriber(snapshot, diff) after every new version (diff is None for the first one)."""
+        self._subscribers.append(subscriber)
+
+    def publish(self, result: list):
+        with self._publish_lock:
+            return self._publish(result)
+
+    def update(self, change):
+        """
+        Publish change(rows) for the rows last published, e.g. to patch one ticket between refreshes. Nothing else
+        publishes meanwhile, so older rows can't be put back over a newer version. change must return a new list and
+        copy any row it edits (the published rows are shared). Returns the new current Snapshot (None before the first).
+        """
+        with self._publish_lock:
+            if self._result is None:
+                return None
+            return self._publish(change(self._result))
+
+    def _publish(self, result: list):
+        texts = serialize_rows(result)
+        text = "[" + ",".join(texts) + "]"
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        tracked = bool(self._history.maxlen or self._subscribers)
+        rows = {row_key(row): row_text for row, row_text in zip(result, texts)} if tracked else {}
+        self._result = result
+        with self._lock:
+            if self._current is not None and self._current.digest == digest:
+                return self._current
+            previous = self._current
+            self._sequence += 1
+            version = f"{self.epoch}.{self._sequence}"
+            self._current = Snapshot(text, version, digest, self.field)
+            diff = SnapshotDiff.between(previous.version, version, self._rows, rows) if previous is not None and tracked else None
+            self._rows = rows
+            if diff is not None:
+                self._history.append(diff)
+            for subscriber in self._subscribers: # under the lock, so subscribers see versions in order
+                try:
+                    subscriber(self._current, diff)
+                except Exception as e:
+                    print(f"Error notifying snapshot subscriber: {e}")
+            return self._current
+
+    def current(self):
+        return self._current
+
+    def changes_since(self, version: str):
+        """
+        A SnapshotDiff from `version` to the current version, or None if that version aged out of the history or
+        isn't one of this publisher's (another process, or before a restart).
+        """
+        with self._lock:
+            current = self._current
+            diffs = list(self._history)
+        if current is None:
+            return None
+        if version == current.version:
+            return SnapshotDiff(version, version, {}, {}, [])
+        start = next((index for index, diff in enumerate(diffs) if diff.from_version == version), None)
+        return SnapshotDiff.combine(diffs[start:]) if start is not None else None
+
+ticket_snapshots = SnapshotPublisher(history=config.get("ticket_sync", {}).get("diff_history", 200))
+loaner_snapshots = SnapshotPublisher(history=0, field="loaners") # /get-loaner-data body: {"loaners": [...], "version": "<epoch>.<n>"}
+
+def diff_response(diff: SnapshotDiff, headers: dict[str, str] = None):
+    """Serve a diff for /get-data?since=; it depends on the query, so it isn't cached."""
+    response_headers = {"Cache-Control": "no-store", "X-Snapshot-Version": diff.version, **(headers or {})}
+    return Response(diff.text, status=200, mimetype="application/json", headers=response_headers)
+
+def extended_snapshot_response(snapshot: Snapshot, extra: dict[str, any], headers: dict[str, str] = None):
+    """
+    Serve a snapshot with extra top-level keys in the body (e.g. /refresh-data's throttled / next_allowed_in).
+    The body changes per request, so it is built (and gzipped) here and not cached.
+    """
+    body = snapshot.body[:-1] + b"," + json.dumps(extra, separators=(",", ":"))[1:].encode("utf-8")
+    response_headers = {"Cache-Control": "no-store", "Vary": "Accept-Encoding", "X-Snapshot-Version": snapshot.version, **(headers or {})}
+    if request.accept_encodings["gzip"]:
+        body, response_headers["Content-Encoding"] = gzip.compress(body, compresslevel=6), "gzip"
+    return Response(body, status=200, mimetype="application/json", headers=response_headers)
+
+def snapshot_response(snapshot: Snapshot, headers: dict[str, str] = None):
+    """
+    Serve a snapshot for the current Flask request: 304 when If-None-Match already has its ETag, otherwise
+    the pre-compressed body for the best encoding the client accepts (br, then gzip, then identity).
+    """
+    response_headers = {
+        "ETag": f'"{snapshot.etag}"',
+        "Cache-Control": "no-cache", # always revalidate, which is a cheap 304 while the snapshot is unchanged
+        "Vary": "Accept-Encoding",
+        "X-Snapshot-Version": snapshot.version,
+        **(headers or {}),
+    }
+    if snapshot.etag in request.if_none_match:
+        return Response(status=304, headers=response_headers)
+
+    accepted = request.accept_encodings
+    if snapshot.brotli_body is not None and accepted["br"]:
+        body, response_headers["Content-Encoding"] = snapshot.brotli_body, "br"
+    elif accepted["gzip"]:
+        body, response_headers["Content-Encoding"] = snapshot.gzip_body, "gzip"
+    else:
+        body = snapshot.body
+    return Response(body, status=200, mimetype="application/json", headers=response_headers)
@@ -19,6 +19,9 @@
     filter: 'all',      // 'computer' | 'incident' | 'phone' | 'all'
     category: 'all',    // 'elitebooks'|'zbooks'|'toughbooks'|'repaired'|'desktops'|'phones'|'all'
     location: 'all',    // 'all'|'PAB'|'SSW'|'EVS'|'WVS'|'TSC'|'XCT'
+    version: null,      // snapshot version currently rendered (an opaque "<epoch>.<n>" token from the server)
+    rows: new Map(),    // rows of that version by ticket number, so pushed diffs can be applied to them
+    live: false,        // Socket.IO connected: diffs are pushed and polling pauses
     idSeq: 0
   };
 
@@ -447,10 +450,17 @@
       el.refresh.textContent = 'Refreshing...';
 
       fetch(`${window.location.origin}/refresh-data`)
-        .then(res => res.json())
-        .then(json => {
-          const rows = json.result || [];
-          renderTable(rows);
+        .then(res => res.json().then(json => ({
+          json,
+          refreshing: res.headers.get('X-Refresh-In-Progress') === 'true'
+        })))
+        .then(({ json, refreshing }) => {
+          showSnapshot(json);
+
+          // The server didn't finish the refresh within its wait, it keeps going and the next poll picks up the new version
+          if (refreshing) {
+            console.info('Refresh still running on the server, the table will update on the next poll');
+          }
 
           // If throttled, let the user know when they can refresh again
           if (json.throttled && typeof json.next_allowed_in === 'number') {
@@ -547,29 +557,7 @@
       return;
     }
 
-    data.forEach(item => {
-      let type = "computer";
-      let incident = false;
-      if (String(item.number).includes("INC")) {
-        type = "incident";
-        incident = true;
-      }
-      else if (String(item.short_description).includes("Ready for Pickup")) {
-        type = "phone";
-      }
-      addDeviceRow({
-        user: item.requested_for || '', // maps to 'user'
-        slot: item.slot || '',          // if you have slot info, otherwise ''
-        ticket: item.number || '',      // maps to 'ticket'
-        ucd: item.ucd || '',       // maps to 'ucd'
-        configItem: item.cmdb_ci || '', // maps to 'configItem'
-        location: item.location || 'PAB',
-        type: type,               // or infer from your data if available
-        incident: incident,                // or infer from your data if available
-        category: '',                    // or infer from your data if available
-        sys_id: item.sys_id || '' // sys_id for task to set link for task to serviceNow
-      });
-    });
+    data.forEach(item => addDeviceRow(rowFromItem(item)));
 
     if (sortState.column !== null) {
       applySort(parseInt(sortState.column), sortState.direction);
@@ -578,19 +566,117 @@
 
   }
 
+  // Maps a ticket from the server to addDeviceRow's fields
+  function rowFromItem(item) {
+    let type = "computer";
+    let incident = false;
+    if (String(item.number).includes("INC")) {
+      type = "incident";
+      incident = true;
+    }
+    else if (String(item.short_description).includes("Ready for Pickup")) {
+      type = "phone";
+    }
+    return {
+      user: item.requested_for || '', // maps to 'user'
+      slot: item.slot || '',          // if you have slot info, otherwise ''
+      ticket: item.number || '',      // maps to 'ticket'
+      ucd: item.ucd || '',       // maps to 'ucd'
+      configItem: item.cmdb_ci || '', // maps to 'configItem'
+      location: item.location || 'PAB',
+      type: type,               // or infer from your data if available
+      incident: incident,                // or infer from your data if available
+      category: '',                    // or infer from your data if available
+      sys_id: item.sys_id || '' // sys_id for task to set link for task to serviceNow
+    };
+  }
+
+  // ---------- Live updates ----------
+  function rowKey(item) {
+    return String(item.number || item.sys_id || '');
+  }
+
+  function showSnapshot(json) {
+    state.version = json.version;
+    state.rows = new Map((json.result || []).map(item => [rowKey(item), item]));
+    renderTable(Array.from(state.rows.values()));
+  }
+
+  function findRow(key) {
+    return Array.from(el.rows.children).find(tr => tr.dataset.ticket === key) || null;
+  }
+
+  // Patches only the rows a diff touches (the rest of the table, filters and sort order stay as they are)
+  function applyDiff(diff) {
+    diff.removed.forEach(key => {
+      state.rows.delete(key);
+      const tr = findRow(key);
+      if (tr) tr.remove();
+    });
+    diff.changed.forEach(item => {
+      const key = rowKey(item);
+      const old = findRow(key);
+      state.rows.set(key, item);
+      const tr = document.getElementById(addDeviceRow(rowFromItem(item)));
+      if (old) old.replaceWith(tr); // keep the row where it was
+    });
+    diff.added.forEach(item => {
+      state.rows.set(rowKey(item), item);
+      addDeviceRow(rowFromItem(item));
+    });
+    state.version = diff.version;
+    recount();
+    applyFilters();
+    if (sortState.column !== null && (diff.changed.length || diff.added.length)) {
+      applySort(parseInt(sortState.column), sortState.direction);
+      updateIndicators();
+    }
+  }
+
+  // The server pushes a diff for every new snapshot version. After a (re)connect the client reports its version
+  // and gets the whole snapshot if it fell behind; a diff that doesn't follow the rendered version asks for the same.
+  function connectLiveUpdates() {
+    if (typeof window.io !== 'function') return; // Socket.IO client not available, keep polling
+    const socket = window.io();
+    socket.on('connect', () => {
+      state.live = true;
+      socket.emit('resync', { version: state.version });
+    });
+    socket.on('disconnect', () => { state.live = false; });
+    socket.on('connect_error', () => { state.live = false; });
+    socket.on('ticket_diff', (text) => {
+      const diff = JSON.parse(text);
+      if (diff.version === state.version) return; // already rendered
+      if (diff.from !== state.version) {
+        socket.emit('resync', { version: state.version });
+        return;
+      }
+      applyDiff(diff);
+    });
+    socket.on('ticket_snapshot', (text) => showSnapshot(JSON.parse(text)));
+  }
+
+  // Fallback while no socket is connected: asks only for the changes since the rendered version. The server
+  // answers with the full snapshot instead when that version is too old for its diff history
   setInterval(() => {
-    fetch(`${window.location.origin}/get-data`)
+    if (state.live) return;
+    const since = state.version !== null ? `?since=${encodeURIComponent(state.version)}` : '';
+    fetch(`${window.location.origin}/get-data${since}`)
       .then(res => res.json())
       .then(json => {
+        if (json.version !== undefined && json.version === state.version) return;
         if (json.result) {
-          renderTable(json.result);
+          showSnapshot(json);
+        } else if (json.from === state.version) {
+          applyDiff(json);
         } else {
-          renderTable([]); // fallback to empty
+          state.version = null; // unexpected base, the next poll downloads the full snapshot
         }
       });
   }, 5000);
 
-  renderTable(initialData.rows.result);
+  showSnapshot(initialData.rows);
+  connectLiveUpdates();
 
   if (sortState.column !== null) {
     applySort(parseInt(sortState.column), sortState.direction);
@@ -4,13 +4,18 @@ import smtplib
 from email.message import EmailMessage
 
 from app_helpers import assign_device_to_shelf
-from api_client import call_api
+from api_client import call_api, run_sync, run_multiple_calls
+from cache_helper import TTLCache
 import yaml
-import asyncio
 
 with open("config.yaml", "r") as f:
     config = yaml.safe_load(f)
 
+user_cache_config = config.get("user_cache", {})
+
+# ServiceNow user name (lowercased) -> [email, ...] ([] when no user has that name)
+user_cache = TTLCache(max_entries=user_cache_config.get("max_entries", 2000), ttl=user_cache_config.get("ttl_seconds", 3600))
+
 LOCATION_BY_ASSIGNMENT_GROUP = {
     "PAB TechStop Support": "PAB",
     "SSW Mobile TechStop": "SSW",
@@ -26,7 +31,7 @@ def slot_new_device(task: dict):
     Wrapper function for auto-assign mode (backward compatibility).
     Uses assign_device_to_shelf with override_mode=False to let shelf choose slot.
     """
-    return asyncio.run(assign_device_to_shelf(task, override_mode=False))
+    return run_sync(assign_device_to_shelf(task, override_mode=False))
 
 def normalize_optional_email(value: str = None):
     """Normalize optional email strings from URL/JS placeholders."""
@@ -54,6 +59,68 @@ def get_pickup_location(assignment_group):
 def is_true_slotting_group(assignment_group):
     return get_pickup_location(assignment_group) in TRUE_SLOTTING_LOCATIONS
 
+def normalize_user_name(value):
+    if isinstance(value, dict):
+        return str(value.get("display_value") or value.get("value") or "").strip()
+    return str(value or "").strip()
+
+def _user_spec(query: str, names: list[str]):
+    return {
+        "url": "http://configurationitem/table/user?SystemID=SOAP-UI&ReferenceID=*&MaxRows=1000",
+        "headers": {
+            "accept": "application/json",
+            "QueryParams": f"sysparm_query={query}"
+        },
+        "method": "GET",
+        "names": names
+    }
+
+async def resolve_user_emails(names: list[str]):
+    """
+    Resolve ServiceNow user names to their email addresses, from user_cache where possible.
+    Uncached names are looked up in batches with nameIN... (a name containing a comma gets its own name= lookup).
+    Unknown names are cached as [] for negative_ttl_seconds.
+
+    Returns {name: [email, ...]}; a name is None if its lookup failed (nothing is cached for it).
+    """
+    keys = {name: name.lower() for name in (normalize_user_name(n) for n in names) if name}
+    found, missing = user_cache.get_many(set(keys.values()))
+    resolved = {name: found.get(key) for name, key in keys.items()}
+    if not missing:
+        return resolved
+
+    missing_names = sorted({name for name, key in keys.items() if key in missing})
+    in_list_names = [name for name in missing_names if "," not in name]
+    batch_size = user_cache_config.get("batch_size", 50)
+    specs = [_user_spec(f"nameIN{','.join(in_list_names[i:i + batch_size])}", in_list_names[i:i + batch_size]) for i in range(0, len(in_list_names), batch_size)]
+    specs += [_user_spec(f"name={name}", [name]) for name in missing_names if "," in name]
+
+    results = await run_multiple_calls(specs)
+    for spec, result in zip(specs, results):
+        if result["status"] != "ok" or not isinstance(result["data"], dict):
+            continue # leave unresolved (None) and uncached so the next lookup retries
+        emails_by_key: dict[str, list] = {keys[name]: [] for name in spec["names"]}
+        for user in result["data"].get("result", []):
+            key = normalize_user_name(user.get("name")).lower()
+            if len(spec["names"]) == 1 and key not in emails_by_key:
+                key = keys[spec["names"][0]]
+            if key in emails_by_key and user.get("email"):
+                emails_by_key[key].append(user["email"])
+        for name in spec["names"]:
+            emails = emails_by_key[keys[name]]
+            user_cache.set(keys[name], emails, ttl=None if emails else user_cache_config.get("negative_ttl_seconds", 300))
+            resolved[name] = emails
+    return resolved
+
+def prefetch_requesters(tickets: list[dict]):
+    """Warm user_cache with the requester of every active ticket, so a Notify click doesn't wait on a ServiceNow user-table lookup."""
+    if not user_cache_config.get("prefetch", True):
+        return
+    names = {normalize_user_name(ticket.get("requested_for")) for ticket in tickets}
+    names.discard("")
+    if names:
+        run_sync(resolve_user_emails(sorted(names)))
+
 def email(
     Machine: str = "Undefined",
     RITM: str = "RITM0000000",
@@ -62,25 +129,17 @@ def email(
     pickup_location: str = "PAB",
 ):
 
-    spec = {
-        "url": "http://configurationitem/table/user?SystemID=SOAP-UI&ReferenceID=*&MaxRows=100",
-        "headers": {
-            "accept": "application/json",
-            "QueryParams": f"sysparm_query=name={Name}"
-        },
-        "method": "GET"
-    }
-
-    response = asyncio.run(call_api(spec["url"], headers=spec["headers"], method=spec["method"]))
-    userFound = response["result"]
+    userFound = run_sync(resolve_user_emails([Name])).get(normalize_user_name(Name))
+    if userFound is None:
+        raise RuntimeError(f"Could not look up ServiceNow user {Name}")
+    if len(userFound) == 0:
+        raise ValueError(f"No ServiceNow user found named {Name}")
     sendTo = ""
 
     if len(userFound) > 1:
-        sendTo = []
-        for user in userFound:
-            sendTo.append(user["email"])
+        sendTo = list(userFound)
     else:
-        sendTo = userFound[0]["email"]
+        sendTo = userFound[0]
 
     today = datetime.now()
     twoWeeks = today + timedelta(weeks=2)
@@ -136,7 +195,7 @@ def update_snow_ticket(sysID: str = None, shortDescription: str = None):
         },
         "method": "PUT"
     }
-    asyncio.run(call_api(spec["url"], params=spec["params"], headers=spec["headers"], method=spec["method"]))
+    run_sync(call_api(spec["url"], params=spec["params"], headers=spec["headers"], method=spec["method"]))
 
 def slot_new_device_task(task: str = None, userEmail : str = None):
     if task is None:
@@ -152,7 +211,7 @@ def slot_new_device_task(task: str = None, userEmail : str = None):
         "method": "GET"
     }
     
-    response = asyncio.run(call_api(spec["url"], headers=spec["headers"], method=spec["method"]))
+    response = run_sync(call_api(spec["url"], headers=spec["headers"], method=spec["method"]))
     task_found = response["result"][0]
     assignment_group = task_found.get("assignment_group")
     pickup_location = get_pickup_location(assignment_group)
@@ -1,6 +1,9 @@
+from app_helpers import assign_device_to_shelf, resolve_computers, ci_display_name, find_key_words, extract_ucd_slot, slot_placement
+from shelves_helper import apply_slot_placements, report_placement
+from api_client import iter_calls_sync, run_sync
+from query_planner import ticket_query, to_call_spec, plan_queries, savings_report, query_matches, unplanned_ticket_bytes
+from ticket_store import ticket_store, is_closed_state, shift_sn_time
 import asyncio
-from app_helpers import assign_device_to_shelf
-from api_client import run_calls_sync
 import yaml
 
 with open("config.yaml", "r") as f:
@@ -14,6 +17,8 @@ MOBILE_ASSIGNMENT_GROUPS = [
     "XCT Mobile TechStop",
 ]
 
+last_plan_report: dict[str, any] = None # savings reported by the query planner for the most recent get_tickets()
+
 LOCATION_BY_ASSIGNMENT_GROUP = {
     "PAB TechStop Support": "PAB",
     "SSW Mobile TechStop": "SSW",
@@ -50,84 +55,154 @@ async def assign_task_slot(task: dict):
         return True
     return False
 
+def build_ticket_queries():
+    """Every logical ticket query the dashboard needs, before planning."""
+    slotted_groups = ["PAB TechStop Support", "TechStop Hardware Support"]
+    queries = []
+    for table, sys_class_name in (("task", "Catalog Task"), ("incident", "Incident")): # TASKs and INCIDENTs already slotted
+        for assignment_group in slotted_groups:
+            queries.append(ticket_query(table, assignment_group, "slot", sys_class_name))
+
+    for key_words in config["key_words"]: # TASKs waiting to be slotted/notified in every TechStop group
+        for assignment_group in [*slotted_groups, *MOBILE_ASSIGNMENT_GROUPS]:
+            queries.append(ticket_query("task", assignment_group, key_words, "Catalog Task"))
+    return queries
+
+class TicketFetch:
+    """
+    The (table, ticket) records of the (planned) ticket queries, yielded one at a time as the responses are parsed,
+    so no list of every record is ever built. Iterate it once; complete is set when the records run out and is
+    False if any upstream query failed or was cut short (the records it did return are still yielded).
+    """
+
+    def __init__(self, updated_since: str = None, known_sys_ids: dict[str, list[str]] = None):
+        self.updated_since = updated_since
+        self.queries = build_ticket_queries()
+        planner_config = config.get("query_planner", {})
+        if planner_config.get("enabled", True) or updated_since:
+            self.planned = plan_queries(self.queries, combine_with_nq=planner_config.get("combine_with_nq", True), updated_since=updated_since, known_sys_ids=known_sys_ids,
+                                        sys_ids_per_call=config.get("ticket_sync", {}).get("sys_ids_per_call", 100))
+        else:
+            self.planned = [{"table": query["table"], "spec": to_call_spec(query), "queries": [query]} for query in self.queries]
+        self.complete = False
+
+    def __iter__(self):
+        global last_plan_report
+        results = []
+        estimated_ticket_bytes = 0
+        for index, ticket in iter_calls_sync([plan["spec"] for plan in self.planned], results):
+            plan = self.planned[index]
+            if not self.updated_since: # deltas aren't comparable with the unplanned fan-out
+                estimated_ticket_bytes += unplanned_ticket_bytes(ticket, plan["queries"])
+            ticket["location"] = get_pickup_location(ticket.get("assignment_group"))
+            yield plan["table"], ticket
+
+        self.complete = True
+        for plan, result in zip(self.planned, results):
+            if result["status"] != "ok":
+                print(f"Incomplete ticket query ({result['status']}): {plan['spec']['headers'].get('QueryParams')}")
+                self.complete = False
+
+        if not self.updated_since:
+            last_plan_report = savings_report(self.queries, self.planned, results, estimated_ticket_bytes)
+            print(f"Ticket query plan: {last_plan_report['planned_calls']} call(s) instead of {last_plan_report['unplanned_calls']}, "
+                  f"~{last_plan_report['estimated_bytes_saved']} bytes saved")
+
+def fetch_ticket_records(updated_since: str = None, known_sys_ids: dict[str, list[str]] = None):
+    """Stream the ticket queries' records (see TicketFetch); check .complete once they have been read."""
+    return TicketFetch(updated_since=updated_since, known_sys_ids=known_sys_ids)
+
 def get_tickets():
-    call_specs = [
-        { # Rest Call to get TASKs in PAB TechStop Support slotted
-            "url": "http://configurationitem/table/task?SystemID=SOAP-UI&ReferenceID=*&MaxRows=1000&KeyName=assignment_group&KeyValue=PAB TechStop Support",
-            "headers": {
-                "accept": "application/json",
-                "QueryParams": "sysparm_query=short_descriptionLIKEslot&active=true&sys_class_name=Catalog Task"
-            },
-            "method": "GET"
-        },
-        { # Rest Call to get TASKs in TechStop Hardware Support slotted
-            "url": "http://configurationitem/table/task?SystemID=SOAP-UI&ReferenceID=*&MaxRows=1000&KeyName=assignment_group&KeyValue=TechStop Hardware Support",
-            "headers": {
-                "accept": "application/json",
-                "QueryParams": "sysparm_query=short_descriptionLIKEslot&active=true&sys_class_name=Catalog Task"
-            },
-            "method": "GET"
-        },
-        { # Rest call to get INCIDENTs in PAB TechStop Support
-            "url": "http://configurationitem/table/incident?SystemID=SOAP-UI&ReferenceID=*&MaxRows=1000&KeyName=assignment_group&KeyValue=PAB TechStop Support",
-            "headers": {
-                    "accept": "application/json",
-                    "QueryParams": "sysparm_query=short_descriptionLIKEslot&active=true&sys_class_name=Incident"
-            },
-            "method": "GET"
-        },
-        { # Rest call to get INCIDENTs in TechStop Hardware Support
-            "url": "http://configurationitem/table/incident?SystemID=SOAP-UI&ReferenceID=*&MaxRows=1000&KeyName=assignment_group&KeyValue=TechStop Hardware Support",
-            "headers": {
-                    "accept": "application/json",
-                    "QueryParams": "sysparm_query=short_descriptionLIKEslot&active=true&sys_class_name=Incident"
-            },
-            "method": "GET"
-        }
-    ]
-    
-    for key_words in config["key_words"]:
-        assignment_groups = ["PAB TechStop Support", "TechStop Hardware Support", *MOBILE_ASSIGNMENT_GROUPS]
-        for assignment_group in assignment_groups:
-            spec = {
-                "url": f"http://configurationitem/table/task?SystemID=SOAP-UI&ReferenceID=*&MaxRows=1000&KeyName=assignment_group&KeyValue={assignment_group}",
-                "headers": {
-                    "accept": "application/json",
-                    "QueryParams": f"sysparm_query=short_descriptionLIKE{key_words}&active=true&sys_class_name=Catalog Task"
-                },
-                "method": "GET"
-            }
-            call_specs.append(spec)
-
-    results = run_calls_sync(call_specs=call_specs)
+    records = fetch_ticket_records()
 
     #tickets: list[dict[str, any]] = []
     unique_tickets_by_sys_id: dict[str, any] = {}
 
-    for result in results:
-        for ticket in result["result"]:
-            if str(ticket["state"]).lower() in ["resolved", "closed"]: # if the ticket is cancelled it will not be active so it won't show up in the list, so we only check for resolved and closed
-                print(f"Skipping ticket {ticket['number']} because it is in a closed state")
-                continue
-            ticket["location"] = get_pickup_location(ticket.get("assignment_group"))
-            unique_tickets_by_sys_id[ticket["sys_id"]] = ticket
+    for _, ticket in records:
+        if is_closed_state(ticket): # if the ticket is cancelled it will not be active so it won't show up in the list, so we only check for resolved and closed
+            print(f"Skipping ticket {ticket['number']} because it is in a closed state")
+            continue
+        unique_tickets_by_sys_id[ticket["sys_id"]] = ticket
         #tickets.extend(result.get("result", []))
 
     #tickets = unique_tickets_by_sys_id(tickets)
     return list(unique_tickets_by_sys_id.values())
 
+def is_dashboard_ticket(ticket: dict, queries: list[dict] = None):
+    """Whether a ticket matches any of the dashboard's ticket queries (used to drop records edited out of scope)."""
+    return any(query_matches(ticket, query) for query in (queries or build_ticket_queries()))
+
+def sync_tickets(force_full: bool = False):
+    """
+    Bring ticket_store up to date and return its tickets.
+
+    With ticket_sync.incremental on, only records updated since the store's watermark are fetched (minus a small
+    overlap so same-second updates aren't missed), and a full reconciliation runs every full_reconcile_minutes.
+    Otherwise, or when no watermark is known yet, every refresh is a full sync.
+    """
+    sync_config = config.get("ticket_sync", {})
+    reconcile_seconds = sync_config.get("full_reconcile_minutes", 60) * 60
+
+    if force_full or not sync_config.get("incremental", False) or ticket_store.needs_full_sync(reconcile_seconds):
+        records = fetch_ticket_records()
+        upserted, removed = ticket_store.replace_all(records, complete=lambda: records.complete)
+        print(f"Full ticket sync: {upserted} active ticket(s), {removed} removed{'' if records.complete else ' (partial, some queries failed)'}")
+        return ticket_store.tickets()
+
+    since = shift_sn_time(ticket_store.watermark, -sync_config.get("watermark_overlap_seconds", 60))
+    records = fetch_ticket_records(updated_since=since, known_sys_ids=ticket_store.sys_ids_by_table())
+    upserted, removed = ticket_store.apply_delta(records, lambda ticket: is_dashboard_ticket(ticket, records.queries), advance_watermark=lambda: records.complete)
+    if upserted or removed:
+        print(f"Delta ticket sync since {since}: {upserted} upserted, {removed} removed")
+    return ticket_store.tickets()
+
+async def prefetch_computers(tickets):
+    """
+    Warm the CMDB computer cache for every PAB ticket still waiting on a Notify click (key words, no slot yet),
+    so the click itself doesn't need a gateway round-trip. Uncached CIs are resolved in one batched lookup.
+    """
+    display_names = []
+    for ticket in tickets:
+        if get_pickup_location(ticket.get("assignment_group")) != "PAB":
+            continue
+        slot, _ = extract_ucd_slot(ticket.get("short_description"))
+        key_words_found, _ = find_key_words(ticket)
+        if slot is None and key_words_found and ci_display_name(ticket.get("cmdb_ci")):
+            display_names.append(ticket.get("cmdb_ci"))
+    if display_names:
+        await resolve_computers(display_names)
+
 async def process_tickets(tickets):
-    tasks = []
+    """
+    Slot every PAB task/incident that has a slot in its short description (override mode).
+    Placements are collected first and applied per shelf in one batch, so a refresh loads and saves each shelf at
+    most once. Returns {ticket_number: {"shelf", "slot", "status"}}; tickets without a slot are "skipped", and a
+    ticket listed more than once keeps its most significant status (an "assigned" isn't overwritten by "present").
+    """
+    await prefetch_computers(tickets)
+    placements = []
+    report = {}
     for ticket in tickets:
         # Only PAB tickets participate in true slotting.
         if get_pickup_location(ticket.get("assignment_group")) != "PAB":
             continue
-        if "TASK" in str(ticket["number"]):
-            tasks.append(assign_task_slot(ticket))
-        elif "INC" in str(ticket["number"]):
-            tasks.append(assign_task_slot(ticket))  # incidents reuse same logic
-    results = await asyncio.gather(*tasks)
-    return results
-
-def process_slot_tickets():
-    return asyncio.run(process_tickets(get_tickets()))
+        if "TASK" not in str(ticket["number"]) and "INC" not in str(ticket["number"]): # incidents reuse same logic
+            continue
+        placement = slot_placement(ticket)
+        if placement is None:
+            report_placement(report, str(ticket["number"]), {"shelf": None, "slot": None, "status": "skipped"})
+            continue
+        placements.append(placement)
+
+    for ticket_number, entry in (await asyncio.to_thread(apply_slot_placements, placements)).items(): # shelf I/O off the event loop
+        report_placement(report, ticket_number, entry)
+    assigned = [number for number, result in report.items() if result["status"] == "assigned"]
+    if assigned:
+        print(f"Slotted {len(assigned)} ticket(s) from {len(placements)} placement(s): {', '.join(assigned)}")
+    return report
+
+def process_slot_tickets(tickets: list[dict] = None):
+    """Slot every PAB ticket with a slot in its description. Runs from ticket_store unless tickets are passed in."""
+    if tickets is None:
+        tickets = ticket_store.tickets() if ticket_store.version else sync_tickets()
+    return run_sync(process_tickets(tickets))
@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The app's modules read config.yaml (and ShelfJSON/) from the working directory when they are imported
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
@@ -0,0 +1,81 @@
+import json
+
+import httpx
+import pytest
+
+import api_client
+
+def page_body(records):
+    return json.dumps({"result": records}).encode()
+
+@pytest.fixture
+def gateway(monkeypatch):
+    """Route the shared client to handler(offset, request) -> httpx.Response; yields a dict to set the handler in."""
+    state = {"handler": None, "requests": 0}
+    def handle(request):
+        state["requests"] += 1
+        query_params = request.headers.get("QueryParams", "")
+        offset = int(query_params.split("sysparm_offset=")[1]) if "sysparm_offset=" in query_params else 0
+        return state["handler"](offset, request)
+    monkeypatch.setattr(api_client, "build_client", lambda: httpx.AsyncClient(transport=httpx.MockTransport(handle)))
+    monkeypatch.setattr(api_client, "_client", None)
+    monkeypatch.setenv("tibco_read_auth_token", "token")
+    monkeypatch.setitem(api_client.api_config, "max_retries", 1)
+    monkeypatch.setitem(api_client.api_config, "backoff_max", 0)
+    monkeypatch.setattr(api_client, "_scheduler", None)
+    yield state
+
+SPEC = {"url": "http://gateway/table/task?MaxRows=2", "headers": {"QueryParams": "sysparm_query=active=true"}, "stream": True, "fields": ["sys_id"]}
+
+def stream(specs):
+    results = []
+    records = list(api_client.iter_calls_sync(specs, results))
+    return records, results
+
+def test_pages_are_followed_and_streamed(gateway):
+    rows = [{"sys_id": str(i), "other": "x"} for i in range(5)]
+    gateway["handler"] = lambda offset, request: httpx.Response(200, content=page_body(rows[offset:offset + 2]))
+    records, results = stream([SPEC])
+    assert records == [(0, {"sys_id": str(i)}) for i in range(5)]
+    assert results[0]["status"] == "ok" and results[0]["data"] is None
+    assert gateway["requests"] == 3
+
+def test_a_gateway_ignoring_the_offset_stops_after_one_repeat(gateway):
+    gateway["handler"] = lambda offset, request: httpx.Response(200, content=page_body([{"sys_id": "a"}, {"sys_id": "b"}]))
+    records, results = stream([SPEC])
+    assert [record for _, record in records] == [{"sys_id": "a"}, {"sys_id": "b"}]
+    assert results[0]["status"] == "partial"
+    assert gateway["requests"] == 2
+
+def test_max_pages_marks_the_result_partial(gateway, monkeypatch):
+    monkeypatch.setitem(api_client.api_config, "max_pages", 3)
+    gateway["handler"] = lambda offset, request: httpx.Response(200, content=page_body([{"sys_id": str(offset)}, {"sys_id": str(offset + 1)}]))
+    records, results = stream([SPEC])
+    assert len(records) == 6
+    assert results[0]["status"] == "partial"
+    assert "3 page(s)" in results[0]["error"]
+
+def test_a_retried_page_does_not_repeat_delivered_records(gateway):
+    class Broken(httpx.AsyncByteStream):
+        async def __aiter__(self):
+            yield b'{"result": [{"sys_id": "a"},'
+            raise httpx.ReadError("connection reset")
+    calls = {"n": 0}
+    def handler(offset, request):
+        calls["n"] += 1
+        if calls["n"] == 1:
+            return httpx.Response(200, stream=Broken())
+        return httpx.Response(200, content=page_body([{"sys_id": "a"}]))
+    gateway["handler"] = handler
+    records, results = stream([SPEC])
+    assert [record for _, record in records] == [{"sys_id": "a"}]
+    assert results[0]["status"] == "ok" and results[0]["attempts"] == 2
+
+def test_other_exceptions_become_error_results(gateway):
+    def handler(offset, request):
+        raise TypeError("Header value must be str or bytes")
+    gateway["handler"] = handler
+    records, results = stream([SPEC, {**SPEC, "url": "http://gateway/table/incident?MaxRows=2"}])
+    assert records == []
+    assert [result["status"] for result in results] == ["error", "error"]
+    assert results[0]["attempts"] == 1
@@ -0,0 +1,24 @@
+from cache_helper import SingleFlight
+
+def test_failures_back_off_and_a_success_resets():
+    outcomes = [RuntimeError("down"), RuntimeError("still down"), None]
+    def refresh():
+        outcome = outcomes.pop(0)
+        if outcome:
+            raise outcome
+    flight = SingleFlight(refresh, backoff=10, max_backoff=15)
+    assert flight.due(600)
+
+    assert flight.wait(5)
+    assert flight.failures == 1 and flight.last_attempt > 0 and flight.last_success == 0
+    assert 9 < flight.retry_in() <= 10
+    assert not flight.due(600) # stale, but backing off
+
+    flight.last_attempt -= 10
+    assert flight.due(600)
+    assert flight.wait(5)
+    assert flight.retry_delay() == 15 # doubled, capped at max_backoff
+
+    assert flight.wait(5) # an explicit wait still runs
+    assert flight.failures == 0 and flight.retry_in() == 0 and flight.last_error is None
+    assert not flight.due(600) and flight.due(-1)
@@ -0,0 +1,108 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+from ldap3.core.exceptions import LDAPException
+
+import ldap_helper
+from cache_helper import TTLCache
+from ldap_helper import LdapConnectionPool, mock_connection_factory, get_email_for_samaccount, resolve_dc_host
+
+DIRECTORY = {"cn=jdoe,dc=srp,dc=gov": {"sAMAccountName": "jdoe", "mail": "jdoe@srpnet.com", "objectClass": "person"}}
+
+@pytest.fixture
+def pool():
+    pool = LdapConnectionPool(mock_connection_factory(DIRECTORY), size=2, acquire_timeout=0.1)
+    yield pool
+    pool.close()
+
+def test_connections_are_returned_and_reused(pool):
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        assert second is first
+    with pool.connection() as a, pool.connection() as b:
+        assert a is not b
+        with pytest.raises(TimeoutError): # both slots are checked out
+            with pool.connection():
+                pass
+    assert pool.stats() == {"idle": 2, "created": 2, "rebinds": 0, "discarded": 0}
+
+def test_a_connection_that_raised_is_discarded(pool):
+    with pytest.raises(LDAPException):
+        with pool.connection() as broken:
+            raise LDAPException("connection reset")
+    assert broken.closed
+    with pool.connection() as conn:
+        assert conn is not broken
+    assert pool.stats()["discarded"] == 1 and pool.stats()["created"] == 2
+
+def test_idle_connections_are_checked_before_reuse(pool):
+    with pool.connection() as conn:
+        pass
+    conn.unbind() # closed while idle: rebound and reused
+    with pool.connection() as again:
+        assert again is conn and again.bound
+    assert pool.stats()["rebinds"] == 1
+
+    pool.health_check_seconds = 0
+    def dropped():
+        raise LDAPException("socket closed by the DC")
+    conn.extend.standard.who_am_i = dropped # the probe fails: replaced by a new connection
+    with pool.connection() as replacement:
+        assert replacement is not conn
+    assert pool.stats()["discarded"] == 1
+
+@pytest.fixture
+def srv(monkeypatch):
+    """Answer SRV lookups from state["answers"] (None raises), counting them; TTLs are shortened for the test."""
+    state = {"answers": None, "lookups": 0}
+    def resolve(name, record_type):
+        state["lookups"] += 1
+        if state["answers"] is None:
+            raise OSError("no DNS")
+        return state["answers"]
+    monkeypatch.setattr(ldap_helper.dns.resolver, "resolve", resolve)
+    monkeypatch.setattr(ldap_helper, "_srv_cache", {"host": None, "expires": 0.0})
+    monkeypatch.setitem(ldap_helper.ldap_config, "srv_min_ttl_seconds", 0)
+    monkeypatch.setitem(ldap_helper.ldap_config, "srv_failure_ttl_seconds", 0.1)
+    return state
+
+class Answers(list):
+    """Stands in for a dns.resolver answer: SRV records plus the rrset TTL."""
+
+    def __init__(self, ttl, *records):
+        super().__init__(SimpleNamespace(priority=priority, weight=weight, target=f"{target}.") for priority, weight, target in records)
+        self.rrset = SimpleNamespace(ttl=ttl)
+
+def test_srv_answer_is_reused_until_its_ttl_expires(srv):
+    srv["answers"] = Answers(0.1, (10, 50, "dc2.srp.gov"), (0, 10, "dc3.srp.gov"), (0, 90, "dc1.srp.gov"))
+    assert resolve_dc_host("srp.gov") == "dc1.srp.gov" # lowest priority, then highest weight
+    assert resolve_dc_host("srp.gov") == "dc1.srp.gov"
+    assert srv["lookups"] == 1
+    time.sleep(0.15)
+    srv["answers"] = Answers(0.1, (0, 10, "dc3.srp.gov"))
+    assert resolve_dc_host("srp.gov") == "dc3.srp.gov"
+    assert srv["lookups"] == 2
+
+def test_failed_srv_lookup_falls_back_for_the_failure_ttl(srv):
+    assert resolve_dc_host("srp.gov") is None
+    assert ldap_helper.build_ldap_server().host == ldap_helper.ldap_server # the configured server is used meanwhile
+    assert srv["lookups"] == 1
+    time.sleep(0.15)
+    srv["answers"] = Answers(60, (0, 10, "dc1.srp.gov"))
+    assert resolve_dc_host("srp.gov") == "dc1.srp.gov"
+    assert srv["lookups"] == 2
+
+def test_unknown_users_are_remembered_for_the_negative_ttl(pool, monkeypatch):
+    monkeypatch.setattr(ldap_helper, "email_cache", TTLCache(ttl=60))
+    monkeypatch.setitem(ldap_helper.ldap_config, "email_negative_ttl_seconds", 0.1)
+    assert get_email_for_samaccount("SRP\\jdoe", pool) == "jdoe@srpnet.com"
+    assert get_email_for_samaccount("asmith", pool) is None
+
+    with pool.connection() as conn: # asmith shows up in AD after the first lookup
+        conn.strategy.add_entry("cn=asmith,dc=srp,dc=gov", {"sAMAccountName": "asmith", "mail": "asmith@srpnet.com", "objectClass": "person"})
+    assert get_email_for_samaccount("asmith", pool) is None # still the cached miss
+    time.sleep(0.15)
+    assert get_email_for_samaccount("asmith", pool) == "asmith@srpnet.com"
+    assert ldap_helper.email_cache.get("srp\\jdoe") == "jdoe@srpnet.com" # found emails keep the normal TTL
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from lock_helper import ShelfLock, LockTimeout
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+def test_read_and_write_are_reentrant():
+    lock = ShelfLock("test", timeout=1)
+    with lock.write():
+        with lock.write(), lock.read():
+            pass
+    with lock.read(), lock.read():
+        pass
+    assert lock._writer is None and not lock._readers
+
+def test_waiting_writer_blocks_new_readers():
+    lock = ShelfLock("test", timeout=2)
+    order = []
+    reader_holds = threading.Event()
+    release_reader = threading.Event()
+
+    def first_reader():
+        with lock.read():
+            reader_holds.set()
+            release_reader.wait()
+            with lock.read(): # a reader that already holds the lock may re-enter past the waiting writer
+                order.append("reader re-entered")
+
+    def writer():
+        with lock.write():
+            order.append("writer")
+
+    def late_reader():
+        with lock.read():
+            order.append("late reader")
+
+    threads = [threading.Thread(target=first_reader)]
+    threads[0].start()
+    reader_holds.wait(2)
+    threads.append(threading.Thread(target=writer))
+    threads[1].start()
+    wait_for(lambda: lock._writers_waiting == 1)
+
+    with pytest.raises(LockTimeout): # new readers queue behind the waiting writer
+        with lock.read(timeout=0.2):
+            pass
+    threads.append(threading.Thread(target=late_reader))
+    threads[2].start()
+    time.sleep(0.1)
+    release_reader.set()
+    for thread in threads:
+        thread.join(5)
+    assert order == ["reader re-entered", "writer", "late reader"]
+    assert lock._writers_waiting == 0
+
+def test_timed_out_writer_stops_blocking_readers():
+    lock = ShelfLock("test", timeout=2)
+    holding = threading.Event()
+    done = threading.Event()
+    def reader():
+        with lock.read():
+            holding.set()
+            done.wait(5)
+    thread = threading.Thread(target=reader)
+    thread.start()
+    holding.wait(2)
+    with pytest.raises(LockTimeout):
+        with lock.write(timeout=0.1):
+            pass
+    with lock.read(timeout=0.5): # no writer is waiting any more
+        pass
+    done.set()
+    thread.join(5)
+
+def test_async_writer_is_preferred_too():
+    lock = ShelfLock("test", timeout=2)
+
+    async def main():
+        order = []
+        async def hold_read():
+            async with lock.read_async():
+                await asyncio.sleep(0.2)
+        async def write():
+            await asyncio.sleep(0.05)
+            async with lock.write_async():
+                order.append("writer")
+        async def late_read():
+            await asyncio.sleep(0.1)
+            async with lock.read_async():
+                order.append("late reader")
+        await asyncio.gather(hold_read(), write(), late_read())
+        return order
+
+    assert asyncio.run(main()) == ["writer", "late reader"]
+    assert lock._writers_waiting == 0
@@ -0,0 +1,190 @@
+import random
+import re
+from urllib.parse import urlparse, parse_qs
+
+from query_planner import ticket_query, to_call_spec, plan_queries
+from techstop_shelf_assignment import build_ticket_queries, config, MOBILE_ASSIGNMENT_GROUPS
+
+GROUPS = ["PAB TechStop Support", "TechStop Hardware Support", *MOBILE_ASSIGNMENT_GROUPS, "Service Desk"]
+WORDS = ["slot", "Slot 12", "techstop asset pickup", "READY FOR PICKUP", "techstop computer pickup", "laptop", "ucd"]
+
+def baseline_call_specs():
+    """The 25 calls get_tickets sent before query planning, built exactly as it built them."""
+    call_specs = [
+        { # Rest Call to get TASKs in PAB TechStop Support slotted
+            "url": "http://configurationitem/table/task?SystemID=SOAP-UI&ReferenceID=*&MaxRows=1000&KeyName=assignment_group&KeyValue=PAB TechStop Support",
+            "headers": {
+                "accept": "application/json",
+                "QueryParams": "sysparm_query=short_descriptionLIKEslot&active=true&sys_class_name=Catalog Task"
+            },
+            "method": "GET"
+        },
+        { # Rest Call to get TASKs in TechStop Hardware Support slotted
+            "url": "http://configurationitem/table/task?SystemID=SOAP-UI&ReferenceID=*&MaxRows=1000&KeyName=assignment_group&KeyValue=TechStop Hardware Support",
+            "headers": {
+                "accept": "application/json",
+                "QueryParams": "sysparm_query=short_descriptionLIKEslot&active=true&sys_class_name=Catalog Task"
+            },
+            "method": "GET"
+        },
+        { # Rest call to get INCIDENTs in PAB TechStop Support
+            "url": "http://configurationitem/table/incident?SystemID=SOAP-UI&ReferenceID=*&MaxRows=1000&KeyName=assignment_group&KeyValue=PAB TechStop Support",
+            "headers": {
+                    "accept": "application/json",
+                    "QueryParams": "sysparm_query=short_descriptionLIKEslot&active=true&sys_class_name=Incident"
+            },
+            "method": "GET"
+        },
+        { # Rest call to get INCIDENTs in TechStop Hardware Support
+            "url": "http://configurationitem/table/incident?SystemID=SOAP-UI&ReferenceID=*&MaxRows=1000&KeyName=assignment_group&KeyValue=TechStop Hardware Support",
+            "headers": {
+                    "accept": "application/json",
+                    "QueryParams": "sysparm_query=short_descriptionLIKEslot&active=true&sys_class_name=Incident"
+            },
+            "method": "GET"
+        }
+    ]
+
+    for key_words in config["key_words"]:
+        assignment_groups = ["PAB TechStop Support", "TechStop Hardware Support", *MOBILE_ASSIGNMENT_GROUPS]
+        for assignment_group in assignment_groups:
+            spec = {
+                "url": f"http://configurationitem/table/task?SystemID=SOAP-UI&ReferenceID=*&MaxRows=1000&KeyName=assignment_group&KeyValue={assignment_group}",
+                "headers": {
+                    "accept": "application/json",
+                    "QueryParams": f"sysparm_query=short_descriptionLIKE{key_words}&active=true&sys_class_name=Catalog Task"
+                },
+                "method": "GET"
+            }
+            call_specs.append(spec)
+    return call_specs
+
+def field_value(record, field, encoded):
+    if field == "assignment_group.name":
+        return record["assignment_group"]["display_value"]
+    if field == "sys_class_name": # the gateway matches name=value parameters by label, encoded queries compare the value
+        return record["sys_class_name"]["value" if encoded else "display_value"]
+    return str(record[field])
+
+def condition_matches(record, condition, encoded=True):
+    field, op, value = re.fullmatch(r"([a-z_.]+)(LIKE|IN|>=|=)(.*)", condition).groups()
+    actual = field_value(record, field, encoded)
+    if op == "LIKE":
+        return value.lower() in actual.lower()
+    if op == "IN":
+        return actual in value.split(",")
+    if op == ">=":
+        return actual >= value
+    return actual == value
+
+def encoded_query_matches(record, query):
+    """Enough of ServiceNow's encoded query semantics for the planner: ^ is AND, ^OR joins the previous term, ^NQ ORs queries."""
+    for part in query.split("^NQ"):
+        groups = []
+        for term in part.split("^"):
+            if term.startswith("OR") and groups:
+                groups[-1].append(term[2:])
+            else:
+                groups.append([term])
+        if all(any(condition_matches(record, condition) for condition in group) for group in groups):
+            return True
+    return False
+
+def call_returns(spec, records):
+    """sys_ids the gateway would return for a call spec: KeyName/KeyValue and &-separated name=value filters are ANDed."""
+    url = urlparse(spec["url"])
+    table = url.path.rsplit("/", 1)[-1]
+    params = parse_qs(url.query)
+    query_params = spec["headers"]["QueryParams"].split("&")
+    query = query_params[0].removeprefix("sysparm_query=")
+    returned = set()
+    for record in records[table]:
+        if "KeyName" in params and field_value(record, params["KeyName"][0] + ".name", False) != params["KeyValue"][0]:
+            continue
+        if not all(condition_matches(record, condition, encoded=False) for condition in query_params[1:]):
+            continue
+        if encoded_query_matches(record, query):
+            returned.add(record["sys_id"])
+    return returned
+
+def random_records(seed, count=400):
+    rng = random.Random(seed)
+    records = {"task": [], "incident": []}
+    for i in range(count):
+        table = rng.choice(["task", "incident"])
+        sys_class_name = "incident" if table == "incident" else rng.choice(["sc_task", "sc_task", "change_task"])
+        label = {"sc_task": "Catalog Task", "change_task": "Change Task", "incident": "Incident"}[sys_class_name]
+        records[table].append({
+            "sys_id": f"id{i}",
+            "sys_class_name": {"display_value": label, "value": sys_class_name},
+            "assignment_group": {"display_value": rng.choice(GROUPS), "value": "group-sys-id"},
+            "short_description": " ".join(rng.sample(WORDS, rng.randint(0, 3))),
+            "active": rng.choice(["true", "true", "false"]),
+            "sys_updated_on": f"2024-05-{rng.randint(1, 28):02d} 12:00:00",
+        })
+    return records
+
+def union(specs, records):
+    return set().union(*(call_returns(spec, records) for spec in specs))
+
+def test_unplanned_calls_are_the_original_calls_word_for_word():
+    specs = [to_call_spec(query) for query in build_ticket_queries()]
+    assert [(spec["url"], spec["headers"], spec["method"]) for spec in specs] == [
+        (spec["url"], spec["headers"], spec["method"]) for spec in baseline_call_specs()]
+
+def test_planned_calls_return_the_same_tickets_as_the_original_calls():
+    queries = build_ticket_queries()
+    assert len(queries) == 25
+    for seed in range(5):
+        records = random_records(seed)
+        expected = union(baseline_call_specs(), records)
+        assert expected # the fixture actually exercises the queries
+        for combine_with_nq in (True, False):
+            planned = plan_queries(queries, combine_with_nq=combine_with_nq)
+            assert union([plan["spec"] for plan in planned], records) == expected
+
+def test_combined_plan_is_one_call_per_table_and_class():
+    planned = plan_queries(build_ticket_queries())
+    assert sorted(plan["table"] for plan in planned) == ["incident", "task"]
+    assert sum(len(plan["queries"]) for plan in planned) == 25
+
+def test_plan_output():
+    queries = [
+        ticket_query("task", "A", "slot", "Catalog Task"),
+        ticket_query("task", "B", "slot", "Catalog Task"),
+        ticket_query("task", "B", "pickup", "Catalog Task"),
+    ]
+    planned = plan_queries(queries, combine_with_nq=False)
+    assert [plan["spec"]["headers"]["QueryParams"] for plan in planned] == [
+        "sysparm_query=active=true^sys_class_name=sc_task^assignment_group.nameINA,B^short_descriptionLIKEslot",
+        "sysparm_query=active=true^sys_class_name=sc_task^assignment_group.nameINB^short_descriptionLIKEpickup",
+    ]
+    assert planned[0]["queries"] == queries[:2]
+    assert "KeyName" not in planned[0]["spec"]["url"]
+
+    combined = plan_queries(queries)
+    assert len(combined) == 1
+    assert "^NQactive=true^" in combined[0]["spec"]["headers"]["QueryParams"]
+
+def test_delta_plan_returns_updated_records_including_inactive():
+    queries = build_ticket_queries()
+    since = "2024-05-15 00:00:00"
+    records = random_records(7)
+    expected = set()
+    for table_records in records.values():
+        for record in table_records:
+            active = dict(record, active="true")
+            if record["sys_updated_on"] >= since and union(baseline_call_specs(), {"task": [active], "incident": [active]}):
+                expected.add(record["sys_id"])
+    planned = plan_queries(queries, updated_since=since)
+    assert union([plan["spec"] for plan in planned], records) == expected
+
+def test_delta_known_sys_ids_are_chunked_into_separate_calls():
+    queries = build_ticket_queries()
+    known = {"task": [f"id{i:03d}" for i in range(250)], "incident": ["inc1"]}
+    planned = plan_queries(queries, updated_since="2024-05-15 00:00:00", known_sys_ids=known, sys_ids_per_call=100)
+    sys_id_calls = [plan for plan in planned if "sys_idIN" in plan["spec"]["headers"]["QueryParams"]]
+    assert [(plan["table"], plan["spec"]["headers"]["QueryParams"].count(",") + 1) for plan in sys_id_calls] == [
+        ("task", 100), ("task", 100), ("task", 50), ("incident", 1)]
+    assert all("^NQ" not in plan["spec"]["headers"]["QueryParams"] for plan in sys_id_calls)
+    assert all(plan["queries"] == [] for plan in sys_id_calls)
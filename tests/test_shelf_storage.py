@@ -0,0 +1,125 @@
+import json
+import threading
+
+import pytest
+
+import shelves_helper
+from shelf_storage import JsonShelfStorage, SqliteShelfStorage, migrate_json_to_sqlite
+from slot_model import Occupant
+
+LEGACY_SLOTS = [None, "PC1", {"device": "PC2", "ticket": "SCTASK2"}, [{"device": "PC3", "ticket": "SCTASK3"}, "PC4"], []]
+SLOTS = [[], [Occupant("PC1")], [Occupant("PC2", "SCTASK2")], [Occupant("PC3", "SCTASK3"), Occupant("PC4")], []]
+
+@pytest.fixture
+def json_storage(tmp_path):
+    (tmp_path / "shelf_a").write_text(json.dumps(LEGACY_SLOTS))
+    return JsonShelfStorage(str(tmp_path))
+
+@pytest.fixture
+def sqlite_storage(tmp_path, json_storage):
+    return SqliteShelfStorage(str(tmp_path / "shelves.db"), busy_timeout=1, legacy=json_storage)
+
+def test_json_reads_legacy_formats_and_writes_the_canonical_one(json_storage, tmp_path):
+    _, slots = json_storage.read("shelf_a", 5)
+    assert slots == SLOTS
+    assert json_storage.write("shelf_a", slots) == json_storage.version("shelf_a")
+    assert json.loads((tmp_path / "shelf_a").read_text()) == [[], ["PC1"], [["PC2", "SCTASK2"]], [["PC3", "SCTASK3"], "PC4"], []]
+    with pytest.raises(ValueError):
+        json_storage.read("shelf_a", 6)
+    assert json_storage.read("missing", 5) == (None, None)
+
+def test_migration_imports_json_once(json_storage, tmp_path):
+    target = SqliteShelfStorage(str(tmp_path / "shelves.db"), busy_timeout=1)
+    assert migrate_json_to_sqlite(["shelf_a", "missing"], json_storage, target) == ["shelf_a"]
+    version, slots = target.read("shelf_a", 5)
+    assert slots == SLOTS
+
+    target.write("shelf_a", [[], [], [], [], [Occupant("PC9", "SCTASK9")]])
+    assert migrate_json_to_sqlite(["shelf_a"], json_storage, target) == [] # already imported, left alone
+    assert target.read("shelf_a", 5)[1][4] == [Occupant("PC9", "SCTASK9")]
+    assert migrate_json_to_sqlite(["shelf_a"], json_storage, target, overwrite=True) == ["shelf_a"]
+    assert target.read("shelf_a", 5)[1] == SLOTS
+
+def test_sqlite_imports_a_missing_shelf_on_first_read(sqlite_storage):
+    version, slots = sqlite_storage.read("shelf_a", 5)
+    assert slots == SLOTS
+    assert sqlite_storage.version("shelf_a") == version
+
+def test_sqlite_back_to_json_round_trip(sqlite_storage, tmp_path):
+    _, slots = sqlite_storage.read("shelf_a", 5)
+    slots[0].append(Occupant("PC5", "SCTASK5"))
+    sqlite_storage.write("shelf_a", slots, {0})
+    exported = JsonShelfStorage(str(tmp_path / "export"))
+    (tmp_path / "export").mkdir()
+    exported.write("shelf_a", sqlite_storage.read("shelf_a", 5)[1])
+    assert exported.read("shelf_a", 5)[1] == slots
+
+def test_sqlite_writes_only_changed_slots_and_bumps_the_version(sqlite_storage):
+    version, slots = sqlite_storage.read("shelf_a", 5)
+    slots[4].append(Occupant("PC6", "SCTASK6"))
+    slots[1].append(Occupant("NOT_SAVED"))
+    assert sqlite_storage.write("shelf_a", slots, {4}) == version + 1
+    assert sqlite_storage.read("shelf_a", 5)[1] == SLOTS[:4] + [[Occupant("PC6", "SCTASK6")]]
+
+def test_sqlite_transaction_rolls_back_every_shelf(sqlite_storage):
+    sqlite_storage.write("shelf_b", [[], []])
+    before = {name: sqlite_storage.read(name, size) for name, size in (("shelf_a", 5), ("shelf_b", 2))}
+    with pytest.raises(RuntimeError):
+        with sqlite_storage.transaction(["shelf_a", "shelf_b"]):
+            sqlite_storage.write("shelf_a", [[Occupant("X")]] * 5)
+            with sqlite_storage.transaction(["shelf_b"]): # nested blocks join the outer transaction
+                sqlite_storage.write("shelf_b", [[Occupant("Y")], []])
+            raise RuntimeError("abort")
+    assert {name: sqlite_storage.read(name, size) for name, size in (("shelf_a", 5), ("shelf_b", 2))} == before
+
+def test_sqlite_transaction_commits_together(sqlite_storage):
+    sqlite_storage.write("shelf_b", [[], []])
+    with sqlite_storage.transaction(["shelf_a", "shelf_b"]):
+        sqlite_storage.write("shelf_a", [[Occupant("X")], [], [], [], []])
+        sqlite_storage.write("shelf_b", [[Occupant("Y")], []])
+    assert sqlite_storage.read("shelf_a", 5)[1][0] == [Occupant("X")]
+    assert sqlite_storage.read("shelf_b", 2)[1][0] == [Occupant("Y")]
+
+def test_json_transaction_excludes_other_writers(json_storage):
+    _, slots = json_storage.read("shelf_a", 5)
+    order = []
+    def other_writer():
+        json_storage.write("shelf_a", slots)
+        order.append("other")
+    with json_storage.transaction(["shelf_a"]):
+        thread = threading.Thread(target=other_writer)
+        thread.start()
+        thread.join(0.3)
+        order.append("transaction")
+    thread.join(5)
+    assert order == ["transaction", "other"]
+
+@pytest.fixture(params=["json", "sqlite"])
+def shelves(request, monkeypatch, json_storage, sqlite_storage):
+    """Two Shelf objects over a temporary backend, in file mode."""
+    json_storage.write("shelf_b", [[], [], []])
+    storage = json_storage if request.param == "json" else sqlite_storage
+    monkeypatch.setattr(shelves_helper, "shelf_storage", storage)
+    monkeypatch.setattr(shelves_helper, "IN_MEMORY_MODE", False)
+    monkeypatch.setattr(shelves_helper, "shelf_journal", None)
+    return shelves_helper.Shelf(5, "shelf_a", 100, "pc", 1), shelves_helper.Shelf(3, "shelf_b", 200, "pc", 1), storage
+
+def test_shelf_transaction_rolls_back_both_shelves(shelves):
+    shelf_a, shelf_b, storage = shelves
+    with pytest.raises(RuntimeError):
+        with shelves_helper.shelf_transaction(shelf_a, shelf_b):
+            assert shelf_a.assignDevice("NEW1", "SCTASK7") == 0
+            assert shelf_b.assignDevice("NEW2", "SCTASK7") == 0
+            raise RuntimeError("abort")
+    assert storage.read("shelf_a", 5)[1] == SLOTS
+    assert storage.read("shelf_b", 3)[1] == [[], [], []]
+    assert shelf_a.findDevice("NEW1") == [] and shelf_b.findDevice("NEW2") == []
+
+def test_shelf_transaction_saves_both_shelves(shelves):
+    shelf_a, shelf_b, storage = shelves
+    with shelves_helper.shelf_transaction(shelf_a, shelf_b):
+        shelf_a.assignDevice("NEW1", "SCTASK7")
+        shelf_b.assignDevice("NEW2", "SCTASK7")
+    assert storage.read("shelf_a", 5)[1][0] == [Occupant("NEW1", "SCTASK7")]
+    assert storage.read("shelf_b", 3)[1][0] == [Occupant("NEW2", "SCTASK7")]
+    assert shelves_helper.Shelf(5, "shelf_a", 100, "pc", 1).findTicket("SCTASK7") == [(100, 0)]
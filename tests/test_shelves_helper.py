@@ -0,0 +1,70 @@
+import pytest
+
+import shelves_helper
+from shelf_storage import JsonShelfStorage, SqliteShelfStorage
+from slot_model import Occupant, over_capacity
+
+@pytest.fixture(params=["json", "sqlite"])
+def storage(request, tmp_path, monkeypatch):
+    json_storage = JsonShelfStorage(str(tmp_path))
+    json_storage.write("shelf", [[Occupant("OLD", "SCTASK0")], [], [], [], []])
+    storage = json_storage if request.param == "json" else SqliteShelfStorage(str(tmp_path / "shelves.db"), busy_timeout=1, legacy=json_storage)
+    monkeypatch.setattr(shelves_helper, "shelf_storage", storage)
+    monkeypatch.setattr(shelves_helper, "IN_MEMORY_MODE", True)
+    monkeypatch.setattr(shelves_helper, "shelf_journal", None)
+    monkeypatch.setattr(shelves_helper.shelf_persister, "durability", "shutdown")
+    return storage
+
+def worker():
+    """A Shelf as another worker process would hold it (same storage, its own in-memory state)."""
+    return shelves_helper.Shelf(5, "shelf", 100, "pc", 1)
+
+def test_memory_mode_flush_merges_instead_of_overwriting(storage, capsys):
+    mine, other = worker(), worker()
+    mine.assignDeviceWithSlot("MINE", 102, "SCTASK1")
+    mine.assignDeviceWithSlot("BOTH", 104, "SCTASK3")
+    mine.removeDevice(0)
+
+    other.assignDeviceWithSlot("THEIRS", 102, "SCTASK2") # same slot as MINE
+    other.assignDeviceWithSlot("BOTH", 103, "SCTASK3")   # same device, another slot
+    other.flush()
+    mine.flush()
+
+    _, slots = storage.read("shelf", 5)
+    assert slots == [[], [], [Occupant("THEIRS", "SCTASK2"), Occupant("MINE", "SCTASK1")], [Occupant("BOTH", "SCTASK3")], []]
+    assert mine.findDevice("BOTH") == [(103, 0)]
+    assert "slot 102 of shelf holds 2 device(s) after merging both processes' placements, max is 1" in capsys.readouterr().out
+
+def test_memory_mode_load_merges_pending_changes(storage):
+    mine, other = worker(), worker()
+    mine.assignDeviceWithSlot("MINE", 101, "SCTASK1")
+    other.assignDeviceWithSlot("THEIRS", 102, "SCTASK2")
+    other.flush()
+    assert mine.findDevice("THEIRS") == [(102, 0)] # picked up without dropping MINE
+    assert mine.findDevice("MINE") == [(101, 0)]
+    mine.flush()
+    assert storage.read("shelf", 5)[1][1:3] == [[Occupant("MINE", "SCTASK1")], [Occupant("THEIRS", "SCTASK2")]]
+
+def test_memory_mode_auto_assign_never_double_books(storage):
+    mine, other = worker(), worker()
+    assert mine.nextFreeSlot() == other.nextFreeSlot() == 101 # both workers' copies show slot 101 free
+    mine.assignDeviceWithSlot("PENDING", 104, "SCTASK9") # an unsaved change, merged before the pick
+    assert mine.assignDevice("A", "SCTASK1") == 1
+    assert other.assignDevice("B", "SCTASK2") == 2 # sees A's claim, not its stale copy
+    mine.flush()
+    other.flush()
+    _, slots = storage.read("shelf", 5)
+    assert slots == [[Occupant("OLD", "SCTASK0")], [Occupant("A", "SCTASK1")], [Occupant("B", "SCTASK2")], [], [Occupant("PENDING", "SCTASK9")]]
+
+def test_capacity_is_enforced_by_auto_assignment_only(storage, capsys):
+    shelf = shelves_helper.Shelf(5, "shelf", 100, "phone", 2)
+    picked = [shelf.assignDevice(f"P{n}", f"SCTASK{n}") for n in range(9)]
+    assert picked == [0, 1, 1, 2, 2, 3, 3, 4, 4] # slot 0 already holds OLD
+    assert shelf.assignDevice("FULL", "SCTASK9") is None
+
+    assert shelf.assignDeviceWithSlot("EXTRA", 101, "SCTASK10") == 1 # an override may go past the capacity
+    assert "Adding anyway (override mode)" in capsys.readouterr().out
+    assert over_capacity(shelf.slots, 2) == [1]
+    shelf.removeDevice(2)
+    assert shelf.assignDevice("NEXT", "SCTASK11") == 2 # the overfilled slot is never picked
+    assert max(len(occupants) for occupants in shelf.slots) == 3
@@ -0,0 +1,104 @@
+import json
+import random
+
+from flask import Flask
+
+from snapshot_helper import SnapshotPublisher, extended_snapshot_response
+
+def rows_of(snapshot_text):
+    return {row["number"]: row for row in json.loads(snapshot_text)["result"]}
+
+def apply(rows, diff_text):
+    """What home.js does with a diff: every key must be added, changed or removed relative to what the client has."""
+    diff = json.loads(diff_text)
+    rows = dict(rows)
+    for key in diff["removed"]:
+        assert key in rows
+        del rows[key]
+    for row in diff["added"]:
+        assert row["number"] not in rows
+        rows[row["number"]] = row
+    for row in diff["changed"]:
+        assert row["number"] in rows
+        rows[row["number"]] = row
+    return rows
+
+def random_result(rng):
+    return [{"number": f"SCTASK{n}", "state": rng.choice(["Open", "Work in Progress"])} for n in sorted(rng.sample(range(12), rng.randint(0, 8)))]
+
+def test_changes_since_catches_up_from_every_version_in_the_history():
+    rng = random.Random(3)
+    publisher = SnapshotPublisher(history=50)
+    seen = {}
+    for _ in range(40):
+        snapshot = publisher.publish(random_result(rng))
+        seen[snapshot.version] = rows_of(snapshot.text())
+    current = publisher.current()
+    assert len(seen) > 20 # most publishes were real changes
+    for version, rows in seen.items():
+        diff = publisher.changes_since(version)
+        assert (diff.from_version, diff.version) == (version, current.version)
+        assert apply(rows, diff.text) == seen[current.version]
+
+def test_a_ticket_removed_and_added_back_is_a_change():
+    publisher = SnapshotPublisher(history=10)
+    publisher.publish([{"number": "SCTASK1", "state": "Open"}, {"number": "SCTASK2", "state": "Open"}])
+    publisher.publish([{"number": "SCTASK2", "state": "Open"}])
+    publisher.publish([{"number": "SCTASK1", "state": "Closed"}, {"number": "SCTASK2", "state": "Open"}, {"number": "SCTASK3", "state": "Open"}])
+    publisher.publish([{"number": "SCTASK1", "state": "Closed"}, {"number": "SCTASK2", "state": "Open"}])
+    diff = json.loads(publisher.changes_since(f"{publisher.epoch}.1").text)
+    assert diff["added"] == [] and diff["removed"] == [] # SCTASK3 came and went in between
+    assert diff["changed"] == [{"number": "SCTASK1", "state": "Closed"}]
+
+def test_changes_since_the_current_version_is_empty():
+    publisher = SnapshotPublisher(history=10)
+    first = f"{publisher.epoch}.1"
+    assert publisher.changes_since(first) is None # nothing published yet
+    publisher.publish([{"number": "SCTASK1"}])
+    assert publisher.publish([{"number": "SCTASK1"}]).version == first # identical data keeps the version
+    diff = json.loads(publisher.changes_since(first).text)
+    assert diff == {"from": first, "version": first, "added": [], "changed": [], "removed": []}
+
+def test_versions_outside_the_history_need_the_full_snapshot():
+    publisher = SnapshotPublisher(history=3)
+    for n in range(6):
+        publisher.publish([{"number": f"SCTASK{n}"}])
+    assert publisher.changes_since(f"{publisher.epoch}.2") is None # aged out
+    assert publisher.changes_since(f"{publisher.epoch}.3") is not None
+    assert publisher.changes_since(f"{publisher.epoch}.99") is None
+    assert publisher.changes_since(3) is None # not a version token
+    assert SnapshotPublisher(history=0).changes_since(f"{publisher.epoch}.1") is None
+
+def test_versions_from_a_restarted_publisher_need_the_full_snapshot():
+    before = SnapshotPublisher(history=10)
+    for n in range(3):
+        before.publish([{"number": f"SCTASK{n}"}])
+    old_version = before.current().version
+
+    after = SnapshotPublisher(history=10) # the process restarted (or another worker): same data, counting from 1 again
+    for n in range(4):
+        after.publish([{"number": f"SCTASK{n}"}])
+    assert after.epoch != before.epoch
+    assert after.current().version.split(".")[1] == "4" and old_version.split(".")[1] == "3"
+    assert after.changes_since(old_version) is None # would otherwise be a diff from after's own version 3
+    assert after.changes_since(f"{after.epoch}.3") is not None
+
+def test_update_patches_a_copy_of_the_latest_rows():
+    publisher = SnapshotPublisher(history=10)
+    assert publisher.update(lambda rows: rows) is None # nothing published yet
+    publisher.publish([{"number": "SCTASK1", "slot": ""}])
+    newer = [{"number": "SCTASK1", "slot": ""}, {"number": "SCTASK2", "slot": ""}]
+    publisher.publish(newer) # a refresh landing before the patch
+    snapshot = publisher.update(lambda rows: [dict(row, slot="12") if row["number"] == "SCTASK2" else row for row in rows])
+    assert rows_of(snapshot.text()) == {"SCTASK1": {"number": "SCTASK1", "slot": ""}, "SCTASK2": {"number": "SCTASK2", "slot": "12"}}
+    assert newer[1]["slot"] == "" # the refresh's rows are left alone
+    assert json.loads(publisher.changes_since(f"{publisher.epoch}.2").text)["changed"] == [{"number": "SCTASK2", "slot": "12"}]
+
+def test_extended_response_adds_keys_to_the_snapshot_body():
+    publisher = SnapshotPublisher(history=0)
+    snapshot = publisher.publish([{"number": "SCTASK1"}])
+    with Flask(__name__).test_request_context(headers={"Accept-Encoding": "identity"}):
+        response = extended_snapshot_response(snapshot, {"throttled": True, "next_allowed_in": 12})
+    assert json.loads(response.get_data()) == {"result": [{"number": "SCTASK1"}], "version": f"{publisher.epoch}.1", "throttled": True, "next_allowed_in": 12}
+    assert response.headers["Cache-Control"] == "no-store"
+    assert response.headers["X-Snapshot-Version"] == snapshot.version
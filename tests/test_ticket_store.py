@@ -0,0 +1,132 @@
+import pytest
+
+import techstop_shelf_assignment
+from ticket_store import TicketStore, parse_sn_time, shift_sn_time
+
+def ticket(sys_id, updated="2024-05-01 10:00:00", **fields):
+    return {"sys_id": sys_id, "number": f"SCTASK{sys_id}", "state": "Open", "active": "true", "sys_updated_on": updated, **fields}
+
+def numbers(store):
+    return sorted(t["number"] for t in store.tickets())
+
+def test_full_sync_replaces_the_store():
+    store = TicketStore()
+    assert store.replace_all([("task", ticket("1")), ("task", ticket("2")), ("task", ticket("3", state="Closed"))]) == (2, 0)
+    assert numbers(store) == ["SCTASK1", "SCTASK2"]
+    assert store.watermark == "2024-05-01 10:00:00"
+
+    assert store.replace_all([("task", ticket("2", "2024-05-01 11:00:00"))]) == (1, 1)
+    assert numbers(store) == ["SCTASK2"]
+    assert store.watermark == "2024-05-01 11:00:00"
+    assert store.sys_ids_by_table() == {"task": ["2"]}
+
+def test_incomplete_full_sync_keeps_missing_tickets_and_the_watermark():
+    store = TicketStore()
+    store.replace_all([("task", ticket("1")), ("task", ticket("2"))])
+    assert store.replace_all([("task", ticket("3", "2024-06-01 00:00:00"))], complete=False) == (1, 0)
+    assert numbers(store) == ["SCTASK1", "SCTASK2", "SCTASK3"]
+    assert store.watermark == "2024-05-01 10:00:00"
+    assert not store.last_sync_complete
+
+def test_delta_upserts_and_removes():
+    store = TicketStore()
+    store.replace_all([("task", ticket("1")), ("task", ticket("2")), ("incident", ticket("3"))])
+    version = store.version
+    records = [
+        ("task", ticket("1", "2024-05-01 10:05:00", short_description="edited")), # updated
+        ("task", ticket("2", "2024-05-01 10:06:00", active="false")),             # closed
+        ("incident", ticket("3", "2024-05-01 10:07:00", out_of_scope=True)),      # edited out of the queries
+        ("task", ticket("4", "2024-05-01 10:08:00")),                             # new
+    ]
+    assert store.apply_delta(records, lambda t: not t.get("out_of_scope")) == (2, 2)
+    assert numbers(store) == ["SCTASK1", "SCTASK4"]
+    assert {t["sys_id"]: t.get("short_description") for t in store.tickets()}["1"] == "edited"
+    assert store.watermark == "2024-05-01 10:08:00"
+    assert store.version == version + 1
+
+def test_failed_delta_does_not_advance_the_watermark():
+    store = TicketStore()
+    store.replace_all([("task", ticket("1"))])
+    store.apply_delta([("task", ticket("2", "2024-05-02 00:00:00"))], lambda t: True, advance_watermark=False)
+    assert store.watermark == "2024-05-01 10:00:00"
+    assert numbers(store) == ["SCTASK1", "SCTASK2"]
+
+def test_watermark_compares_times_not_strings():
+    store = TicketStore()
+    store.replace_all([("task", ticket("1", "2024-05-01 09:00:00")), ("task", ticket("2", {"value": "2024-05-01 10:00:00", "display_value": "05/01/2024 10:00:00 AM"}))])
+    assert store.watermark == "2024-05-01 10:00:00"
+
+def test_unparseable_watermark_falls_back_to_full_sync():
+    store = TicketStore()
+    store.replace_all([("task", ticket("1"))])
+    assert not store.needs_full_sync(3600)
+    store.apply_delta([("task", ticket("2", "05/01/2024 11:00:00 AM"))], lambda t: True)
+    assert store.watermark is None
+    assert store.needs_full_sync(3600)
+
+def test_sn_time_helpers():
+    assert parse_sn_time("2024-05-01 10:00:00").hour == 10
+    assert parse_sn_time("01-05-2024 10:00") is None
+    assert parse_sn_time(None) is None
+    assert shift_sn_time("2024-05-01 00:00:30", -60) == "2024-04-30 23:59:30"
+
+class FakeFetch:
+    """Stands in for TicketFetch: yields canned records one at a time and only knows complete once they are read."""
+
+    def __init__(self, records, complete):
+        self.records = records
+        self.queries = []
+        self.complete = False
+        self._complete = complete
+
+    def __iter__(self):
+        yield from self.records
+        self.complete = self._complete
+
+@pytest.fixture
+def sync(monkeypatch):
+    """sync_tickets against a fresh store, with fetch_ticket_records replaced by a recorder returning canned records."""
+    store = TicketStore()
+    calls = []
+    responses = []
+    def fake_fetch(updated_since=None, known_sys_ids=None):
+        calls.append((updated_since, known_sys_ids))
+        return FakeFetch(*responses.pop(0))
+    monkeypatch.setattr(techstop_shelf_assignment, "ticket_store", store)
+    monkeypatch.setattr(techstop_shelf_assignment, "fetch_ticket_records", fake_fetch)
+    monkeypatch.setattr(techstop_shelf_assignment, "is_dashboard_ticket", lambda t, queries=None: True)
+    monkeypatch.setitem(techstop_shelf_assignment.config, "ticket_sync", {"incremental": True, "full_reconcile_minutes": 60, "watermark_overlap_seconds": 60})
+    return store, calls, responses
+
+def test_sync_tickets_runs_a_full_sync_then_deltas(sync):
+    store, calls, responses = sync
+    responses.append(([("task", ticket("1")), ("task", ticket("2"))], True))
+    assert len(techstop_shelf_assignment.sync_tickets()) == 2
+    assert calls[-1] == (None, None)
+
+    responses.append(([("task", ticket("2", "2024-05-01 10:30:00", state="Resolved"))], True))
+    assert [t["sys_id"] for t in techstop_shelf_assignment.sync_tickets()] == ["1"]
+    assert calls[-1] == ("2024-05-01 09:59:00", {"task": ["1", "2"]})
+    assert store.watermark == "2024-05-01 10:30:00"
+
+    responses.append(([("task", ticket("3"))], True))
+    techstop_shelf_assignment.sync_tickets(force_full=True)
+    assert calls[-1] == (None, None)
+    assert numbers(store) == ["SCTASK3"]
+
+def test_sync_tickets_goes_back_to_full_sync_without_a_usable_watermark(sync):
+    store, calls, responses = sync
+    responses.append(([("task", ticket("1", "1 May 2024"))], True))
+    techstop_shelf_assignment.sync_tickets()
+    responses.append(([("task", ticket("1"))], True))
+    techstop_shelf_assignment.sync_tickets()
+    assert calls == [(None, None), (None, None)]
+    assert store.watermark == "2024-05-01 10:00:00"
+
+def test_store_reads_records_once_as_a_stream():
+    store = TicketStore()
+    store.replace_all([("task", ticket("1"))])
+    fetch = FakeFetch([("task", ticket("2")), ("task", ticket("3"))], complete=False)
+    assert store.replace_all(iter(fetch), complete=lambda: fetch.complete) == (2, 0)
+    assert numbers(store) == ["SCTASK1", "SCTASK2", "SCTASK3"] # incomplete, known only after the stream ended
+    assert not store.last_sync_complete
@@ -0,0 +1,164 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+SN_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def is_closed_state(ticket: dict):
+    return str(ticket.get("state", "")).lower() in ["resolved", "closed"]
+
+def is_inactive(ticket: dict):
+    return str(ticket.get("active", "true")).strip().lower() in ["false", "0"]
+
+def parse_sn_time(value):
+    """
+    The datetime of a ServiceNow "YYYY-MM-DD HH:MM:SS" timestamp, or None if value isn't one (e.g. a display value
+    in a user's date format). A {"value", "display_value"} pair is read from its raw value.
+    """
+    if isinstance(value, dict):
+        value = value.get("value")
+    try:
+        return datetime.strptime(str(value).strip(), SN_TIME_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+def shift_sn_time(value: str, seconds: int):
+    """Shift a ServiceNow "YYYY-MM-DD HH:MM:SS" timestamp by seconds (returned unchanged if it can't be parsed)."""
+    try:
+        return (datetime.strptime(value, SN_TIME_FORMAT) + timedelta(seconds=seconds)).strftime(SN_TIME_FORMAT)
+    except (TypeError, ValueError):
+        return value
+
+class StampTracker:
+    """The newest parseable sys_updated_on among the tickets it has seen, and the first one that didn't parse."""
+
+    def __init__(self):
+        self.newest: datetime = None
+        self.unparsed = None
+
+    def see(self, ticket: dict):
+        stamp = ticket.get("sys_updated_on")
+        if not stamp:
+            return
+        parsed = parse_sn_time(stamp)
+        if parsed is None:
+            if self.unparsed is None:
+                self.unparsed = stamp
+        elif self.newest is None or parsed > self.newest:
+            self.newest = parsed
+
+class TicketStore:
+    """
+    Local copy of every active dashboard ticket, keyed by sys_id.
+
+    The watermark is the newest sys_updated_on seen from ServiceNow (server time, so local clock skew doesn't matter).
+    It is only kept while every stamp parses as a raw "YYYY-MM-DD HH:MM:SS" value: if the gateway returns something
+    else (a display value in another format), comparing against it would skip updates, so the watermark is dropped
+    and the next refresh is a full sync.
+    Deltas fetched since the watermark are applied as upserts or deactivations; a full sync replaces the store.
+    Readers get shallow copies of the ticket list, so they never see a half-applied sync.
+    """
+
+    def __init__(self):
+        self._tickets: dict[str, dict] = {}
+        self._tables: dict[str, str] = {} # sys_id -> ServiceNow table the ticket was read from
+        self._lock = threading.Lock()
+        self.watermark: str = None
+        self.last_full_sync: float = 0.0
+        self.last_sync_complete = False # False until a sync finished with every upstream query succeeding
+        self.version = 0
+
+    def _advance_watermark(self, stamps: "StampTracker"):
+        if stamps.unparsed is not None:
+            print(f"Unrecognized sys_updated_on {stamps.unparsed!r}, falling back to full ticket syncs")
+            self.watermark = None
+            return
+        if stamps.newest is not None and (self.watermark is None or stamps.newest > parse_sn_time(self.watermark)):
+            self.watermark = stamps.newest.strftime(SN_TIME_FORMAT)
+
+    def replace_all(self, records, complete=True):
+        """
+        Apply a full sync of (table, ticket) records. records is read once, as it arrives (it may be a stream), and
+        only the new store contents are kept. complete may be a callable, checked once the records are read.
+        When it is False (some query failed) tickets missing from the records are kept rather than dropped, and the
+        watermark is left alone. Returns (upserted, removed).
+        """
+        fresh = {}
+        tables = {}
+        stamps = StampTracker()
+        for table, ticket in records: # read outside the lock, readers keep the current tickets meanwhile
+            stamps.see(ticket)
+            if is_inactive(ticket) or is_closed_state(ticket):
+                continue
+            fresh[ticket["sys_id"]] = ticket
+            tables[ticket["sys_id"]] = table
+        complete = complete() if callable(complete) else complete
+
+        with self._lock:
+            removed = 0
+            self.last_sync_complete = complete
+            if complete:
+                removed = len(self._tickets.keys() - fresh.keys())
+                self._tickets = fresh
+                self._tables = tables
+                self._advance_watermark(stamps)
+                self.last_full_sync = time.time()
+            else:
+                self._tickets.update(fresh)
+                self._tables.update(tables)
+            self.version += 1
+            return len(fresh), removed
+
+    def apply_delta(self, records, is_member, advance_watermark=True):
+        """
+        Apply (table, ticket) records updated since the watermark, read once as they arrive.
+        is_member(ticket) decides whether a returned record still belongs on the dashboard; records that are
+        inactive, resolved/closed or no longer members are removed. advance_watermark may be a callable, checked
+        once the records are read. Returns (upserted, removed).
+        """
+        changes: dict[str, tuple[str, dict]] = {} # sys_id -> (table, ticket), or (table, None) to remove; the last record wins
+        stamps = StampTracker()
+        for table, ticket in records:
+            stamps.see(ticket)
+            keep = not (is_inactive(ticket) or is_closed_state(ticket) or not is_member(ticket))
+            changes[ticket["sys_id"]] = (table, ticket if keep else None)
+        advance_watermark = advance_watermark() if callable(advance_watermark) else advance_watermark
+
+        with self._lock:
+            upserted = 0
+            removed = 0
+            for sys_id, (table, ticket) in changes.items():
+                if ticket is None:
+                    if self._tickets.pop(sys_id, None) is not None:
+                        self._tables.pop(sys_id, None)
+                        removed += 1
+                    continue
+                self._tickets[sys_id] = ticket
+                self._tables[sys_id] = table
+                upserted += 1
+            self.last_sync_complete = advance_watermark
+            if advance_watermark:
+                self._advance_watermark(stamps)
+            if upserted or removed:
+                self.version += 1
+            return upserted, removed
+
+    def needs_full_sync(self, reconcile_seconds: float):
+        return self.watermark is None or (time.time() - self.last_full_sync) >= reconcile_seconds
+
+    def tickets(self):
+        with self._lock:
+            return list(self._tickets.values())
+
+    def active_ticket_numbers(self):
+        with self._lock:
+            return {str(ticket["number"]) for ticket in self._tickets.values()}
+
+    def sys_ids_by_table(self):
+        with self._lock:
+            by_table: dict[str, list[str]] = {}
+            for sys_id, table in self._tables.items():
+                by_table.setdefault(table, []).append(sys_id)
+            return by_table
+
+ticket_store = TicketStore()